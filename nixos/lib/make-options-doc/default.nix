@@ -96,25 +96,23 @@ let
 in rec {
   inherit optionsNix;
 
-  optionsAsciiDoc = pkgs.runCommand "options.adoc" {
+  # AsciiDoc and CommonMark are rendered from the same input with the same
+  # settings, so a single nixos-render-docs run writes both.
+  optionsRendered = pkgs.runCommand "options" {
+    outputs = [ "asciidoc" "commonmark" ];
     nativeBuildInputs = [ pkgs.nixos-render-docs ];
   } ''
-    nixos-render-docs -j $NIX_BUILD_CORES options asciidoc \
+    nixos-render-docs -j $NIX_BUILD_CORES options multi \
       --manpage-urls ${pkgs.path + "/doc/manpage-urls.json"} \
       --revision ${lib.escapeShellArg revision} \
-      ${optionsJSON}/share/doc/nixos/options.json \
-      $out
+      --asciidoc $asciidoc \
+      --commonmark $commonmark \
+      ${optionsJSON}/share/doc/nixos/options.json
   '';
 
-  optionsCommonMark = pkgs.runCommand "options.md" {
-    nativeBuildInputs = [ pkgs.nixos-render-docs ];
-  } ''
-    nixos-render-docs -j $NIX_BUILD_CORES options commonmark \
-      --manpage-urls ${pkgs.path + "/doc/manpage-urls.json"} \
-      --revision ${lib.escapeShellArg revision} \
-      ${optionsJSON}/share/doc/nixos/options.json \
-      $out
-  '';
+  optionsAsciiDoc = optionsRendered.asciidoc;
+
+  optionsCommonMark = optionsRendered.commonmark;
 
   optionsJSON = pkgs.runCommand "options.json"
     { meta.description = "List of NixOS options in JSON format";
@@ -3,11 +3,22 @@ import re
 import signal
 import tempfile
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Union
-
-from test_driver.logger import rootlog
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    TypeVar,
+    Union,
+)
+
+from test_driver.logger import LogBuffer, rootlog
 from test_driver.machine import Machine, NixStartScript, retry
 from test_driver.polling_condition import PollingCondition
 from test_driver.vlan import VLan
@@ -35,6 +46,9 @@ def pythonize_name(name: str) -> str:
     return re.sub(r"^[^A-z_]|[^A-z0-9_]", "_", name)
 
 
+T = TypeVar("T")
+
+
 class Driver:
     """A handle to the driver that sets up the environment
     and runs the tests"""
@@ -90,8 +104,7 @@ class Driver:
     def __exit__(self, *_: Any) -> None:
         with rootlog.nested("cleanup"):
             self.race_timer.cancel()
-            for machine in self.machines:
-                machine.release()
+            self.parallel(lambda machine: machine.release())
 
     def subtest(self, name: str) -> Iterator[None]:
         """Group logs under a given test name"""
@@ -158,21 +171,47 @@ class Driver:
         self.race_timer.start()
         self.test_script()
         # TODO: Collect coverage data
-        for machine in self.machines:
-            if machine.is_up():
-                machine.execute("sync")
+        self.parallel(
+            lambda machine: machine.execute("sync") if machine.is_up() else None
+        )
+
+    def parallel(
+        self, fn: Callable[[Machine], T], machines: Optional[List[Machine]] = None
+    ) -> List[T]:
+        """Call `fn` on each of `machines` (all machines by default) in a
+        thread of its own and return the results in the same order, e.g.
+        `driver.parallel(lambda m: m.wait_for_unit("multi-user.target"))`.
+
+        The log output of each machine is written out as a whole once all
+        calls have returned. If any of the calls raised, the exception of
+        the first such machine is raised after all calls have finished.
+        """
+        if machines is None:
+            machines = self.machines
+        if len(machines) <= 1:
+            return [fn(machine) for machine in machines]
+
+        buffers = [LogBuffer() for _ in machines]
+
+        def run(i: int) -> T:
+            with rootlog.buffered(buffers[i]):
+                return fn(machines[i])
+
+        with ThreadPoolExecutor(max_workers=len(machines)) as executor:
+            futures = [executor.submit(run, i) for i in range(len(machines))]
+        for buffer in buffers:
+            rootlog.write_buffer(buffer)
+        return [future.result() for future in futures]
 
     def start_all(self) -> None:
         """Start all machines"""
         with rootlog.nested("start all VMs"):
-            for machine in self.machines:
-                machine.start()
+            self.parallel(lambda machine: machine.start())
 
     def join_all(self) -> None:
         """Wait for all machines to shut down"""
         with rootlog.nested("wait for all VMs to finish"):
-            for machine in self.machines:
-                machine.wait_for_shutdown()
+            self.parallel(lambda machine: machine.wait_for_shutdown())
             self.race_timer.cancel()
 
     def terminate_test(self) -> None:
@@ -4,35 +4,89 @@
 import codecs
 import os
 import sys
+import threading
 import time
 import unicodedata
 from contextlib import contextmanager
 from queue import Empty, Queue
-from typing import Any, Dict, Iterator
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 from xml.sax.saxutils import XMLGenerator
 
 from colorama import Fore, Style
 
 
+class LogBuffer:
+    """Log file output of a thread that runs alongside others, kept apart
+    so it can be written to the log file in one piece (see `Logger.buffered`).
+    """
+
+    def __init__(self) -> None:
+        self.events: List[Tuple[str, Tuple[Any, ...]]] = []
+        self.depth = 0
+
+    def startElement(self, name: str, attrs: Dict[str, str]) -> None:  # noqa: N802
+        self.events.append(("startElement", (name, attrs)))
+        self.depth += 1
+
+    def characters(self, content: str) -> None:
+        self.events.append(("characters", (content,)))
+
+    def endElement(self, name: str) -> None:  # noqa: N802
+        self.events.append(("endElement", (name,)))
+        self.depth -= 1
+
+
 class Logger:
     def __init__(self) -> None:
         self.logfile = os.environ.get("LOGFILE", "/dev/null")
         self.logfile_handle = codecs.open(self.logfile, "wb")
-        self.xml = XMLGenerator(self.logfile_handle, encoding="utf-8")
+        self.file_xml = XMLGenerator(self.logfile_handle, encoding="utf-8")
         self.queue: "Queue[Dict[str, str]]" = Queue()
 
-        self.xml.startDocument()
-        self.xml.startElement("logfile", attrs={})
+        self.file_xml.startDocument()
+        self.file_xml.startElement("logfile", attrs={})
 
         self._print_serial_logs = True
+        self._print_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _eprint(self, *args: object, **kwargs: Any) -> None:
+        with self._print_lock:
+            print(*args, file=sys.stderr, **kwargs)
+
+    @property
+    def buffer(self) -> Optional[LogBuffer]:
+        return getattr(self._local, "buffer", None)
 
-    @staticmethod
-    def _eprint(*args: object, **kwargs: Any) -> None:
-        print(*args, file=sys.stderr, **kwargs)
+    @property
+    def xml(self) -> Union[XMLGenerator, LogBuffer]:
+        return self.buffer or self.file_xml
+
+    @contextmanager
+    def buffered(self, buffer: LogBuffer) -> Iterator[None]:
+        """Collect the log file output of the current thread in `buffer`
+        instead of writing it out, see `write_buffer`. Output to stderr is
+        not delayed.
+        """
+        self._local.buffer = buffer
+        try:
+            yield
+        finally:
+            self._local.buffer = None
+
+    def write_buffer(self, buffer: LogBuffer) -> None:
+        """Write out what was logged into `buffer`. Elements left open
+        by an exception are closed.
+        """
+        xml = self.xml
+        for method, args in buffer.events:
+            getattr(xml, method)(*args)
+        for _ in range(buffer.depth):
+            xml.endElement("nest")
 
     def close(self) -> None:
-        self.xml.endElement("logfile")
-        self.xml.endDocument()
+        self.file_xml.endElement("logfile")
+        self.file_xml.endDocument()
         self.logfile_handle.close()
 
     def sanitise(self, message: str) -> str:
@@ -72,6 +126,10 @@ class Logger:
         self.queue.put(item)
 
     def drain_log_queue(self) -> None:
+        # serial output belongs to no particular part of a buffered thread's
+        # log, leave it for the thread that writes the log file.
+        if self.buffer is not None:
+            return
         try:
             while True:
                 item = self.queue.get_nowait()
@@ -99,7 +157,7 @@ class Logger:
         yield
         self.drain_log_queue()
         toc = time.time()
-        self.log(f"(finished: {message}, in {toc - tic:.2f} seconds)")
+        self.log(f"(finished: {message}, in {toc - tic:.2f} seconds)", attributes)
 
         self.xml.endElement("nest")
 
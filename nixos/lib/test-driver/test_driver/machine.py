@@ -1,5 +1,7 @@
 import base64
+import hashlib
 import io
+import math
 import os
 import queue
 import re
@@ -7,15 +9,18 @@ import select
 import shlex
 import shutil
 import socket
+import struct
 import subprocess
 import sys
 import tempfile
 import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import _GeneratorContextManager, nullcontext
 from pathlib import Path
 from queue import Queue
-from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from test_driver.logger import rootlog
 
@@ -89,12 +94,57 @@ def make_command(args: list) -> str:
     return " ".join(map(shlex.quote, (map(str, args))))
 
 
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Lines in the format of `sha256sum`, which escapes backslashes and line
+# breaks in file names and marks such lines with a leading backslash.
+def _sha256sum_line(digest: str, name: str) -> str:
+    escaped = name.replace("\\", "\\\\").replace("\n", "\\n")
+    prefix = "\\" if escaped != name else ""
+    return f"{prefix}{digest}  {escaped}\n"
+
+
+def _parse_sha256sum_line(line: str) -> Tuple[str, str]:
+    if not line.startswith("\\"):
+        return (line[:64], line[66:])
+    unescape = {"\\\\": "\\", "\\n": "\n", "\\r": "\r"}
+    return (line[1:65], re.sub(r"\\.", lambda m: unescape[m[0]], line[67:]))
+
+
+# OCR results of recent screendumps by the hash of the screendump and the
+# model id, the screen often doesn't change while waiting for text.
+OCR_CACHE_SIZE = 32
+_ocr_cache: "OrderedDict[Tuple[str, int], str]" = OrderedDict()
+_ocr_cache_lock = threading.Lock()
+
+
 def _perform_ocr_on_screenshot(
     screenshot_path: str, model_ids: Iterable[int]
 ) -> List[str]:
     if shutil.which("tesseract") is None:
         raise Exception("OCR requested but enableOCR is false")
 
+    model_ids = list(model_ids)
+    with open(screenshot_path, "rb") as f:
+        frame = hashlib.sha256(f.read()).hexdigest()
+    with _ocr_cache_lock:
+        results = {
+            model_id: _ocr_cache[(frame, model_id)]
+            for model_id in model_ids
+            if (frame, model_id) in _ocr_cache
+        }
+        for model_id in results:
+            _ocr_cache.move_to_end((frame, model_id))
+    missing = [model_id for model_id in model_ids if model_id not in results]
+    if not missing:
+        return [results[model_id] for model_id in model_ids]
+
     magick_args = (
         "-filter Catrom -density 72 -resample 300 "
         + "-contrast -normalize -despeckle -type grayscale "
@@ -104,36 +154,102 @@ def _perform_ocr_on_screenshot(
 
     tess_args = "-c debug_file=/dev/null --psm 11"
 
-    cmd = f"convert {magick_args} '{screenshot_path}' 'tiff:{screenshot_path}.tiff'"
+    tiff_path = f"{screenshot_path}.tiff"
+    cmd = f"convert {magick_args} '{screenshot_path}' 'tiff:{tiff_path}'"
     ret = subprocess.run(cmd, shell=True, capture_output=True)
     if ret.returncode != 0:
         raise Exception(f"TIFF conversion failed with exit code {ret.returncode}")
 
-    model_results = []
-    for model_id in model_ids:
-        cmd = f"tesseract '{screenshot_path}.tiff' - {tess_args} --oem '{model_id}'"
-        ret = subprocess.run(cmd, shell=True, capture_output=True)
+    # the models run at the same time, keep each one from starting a
+    # thread per core
+    env = dict(os.environ, OMP_THREAD_LIMIT="1") if len(missing) > 1 else None
+
+    def ocr(model_id: int) -> str:
+        cmd = f"tesseract '{tiff_path}' - {tess_args} --oem '{model_id}'"
+        ret = subprocess.run(cmd, shell=True, capture_output=True, env=env)
         if ret.returncode != 0:
             raise Exception(f"OCR failed with exit code {ret.returncode}")
-        model_results.append(ret.stdout.decode("utf-8"))
+        return ret.stdout.decode("utf-8")
+
+    with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+        results.update(zip(missing, executor.map(ocr, missing)))
 
-    return model_results
+    with _ocr_cache_lock:
+        for model_id in missing:
+            _ocr_cache[(frame, model_id)] = results[model_id]
+        while len(_ocr_cache) > OCR_CACHE_SIZE:
+            _ocr_cache.popitem(last=False)
+
+    return [results[model_id] for model_id in model_ids]
 
 
 def retry(fn: Callable, timeout: int = 900) -> None:
-    """Call the given function repeatedly, with 1 second intervals,
-    until it returns True or a timeout is reached.
+    """Call the given function repeatedly until it returns True or a timeout
+    is reached. The first calls follow each other quickly, the intervals
+    then grow up to 1 second. The function is called at least `timeout`
+    times, as with the former 1 second intervals, even when the calls
+    themselves are slow.
     """
 
-    for _ in range(timeout):
+    deadline = time.monotonic() + timeout
+    delay = 0.1
+    attempts = 0
+    while attempts < timeout or time.monotonic() < deadline:
         if fn(False):
             return
-        time.sleep(1)
+        attempts += 1
+        remaining = deadline - time.monotonic()
+        time.sleep(min(delay, remaining) if remaining > 0 else delay)
+        delay = min(delay * 2, 1)
 
     if not fn(True):
         raise Exception(f"action timed out after {timeout} seconds")
 
 
+# Waits that only need a cheap shell command to succeed poll it in the guest,
+# which notices changes much sooner than a round-trip per poll could. The guest
+# hands control back after this many seconds so that callbacks like polling
+# conditions keep running at their usual (default 2 seconds) interval.
+GUEST_WAIT_SLICE = 2
+
+
+def _guest_wait_command(condition: str, seconds: int) -> str:
+    """A shell command that runs `condition` until it succeeds, for up to
+    `seconds` seconds, with intervals growing from 10ms to 500ms.
+    """
+    return (
+        # $SECONDS only counts whole seconds, the deadline would be off by
+        # up to a second. $EPOCHREALTIME has microseconds, so times and
+        # delays are counted in microseconds.
+        f"end=$((${{EPOCHREALTIME/[.,]/}} + {seconds} * 1000000)); "
+        "delays=(10000 20000 50000 100000 200000); i=0; "
+        f"until {{ {condition}; }}; do "
+        "left=$((end - ${EPOCHREALTIME/[.,]/})); (( left > 0 )) || exit 1; "
+        # the last sleep ends at the deadline rather than overshooting it
+        "delay=${delays[i]:-500000}; (( delay < left )) || delay=$left; "
+        'printf -v frac %06d $((delay % 1000000)); sleep "$((delay / 1000000)).$frac"; '
+        "i=$((i + 1)); "
+        "done"
+    )
+
+
+# Frames exchanged with the guest agent (nixos/modules/testing/nixos-test-agent.c):
+# a type byte, the request id and the payload length, followed by the payload.
+AGENT_FRAME = struct.Struct(">BII")
+AGENT_HELLO = "nixos-test-agent 1"
+
+
+class _AgentRequest:
+    """A request sent to the guest agent. Its frames are collected by
+    whichever thread reads from the agent, and handled by the thread that
+    waits for the request.
+    """
+
+    def __init__(self) -> None:
+        self.frames: List[Tuple[str, bytes]] = []
+        self.lost = False
+
+
 class StartCommand:
     """The Base Start Command knows how to append the necessary
     runtime qemu options as determined by a particular test driver
@@ -328,9 +444,13 @@ class Machine:
     qmp_client: Optional[QMPSession]
     shell: Optional[socket.socket]
     serial_thread: Optional[threading.Thread]
+    shell_lock: threading.RLock
+    monitor_lock: threading.RLock
 
     booted: bool
     connected: bool
+    # Whether commands are run by the guest agent instead of the shell
+    agent: bool
     # Store last serial console lines for use
     # of wait_for_console_text
     last_lines: Queue = Queue()
@@ -373,9 +493,19 @@ class Machine:
         self.qmp_client = None
         self.shell = None
         self.serial_thread = None
+        # Held while talking to the shell or monitor, the machine may be
+        # used from several threads (see Driver.parallel).
+        self.shell_lock = threading.RLock()
+        self.monitor_lock = threading.RLock()
+        # Guards the state of the requests sent to the guest agent
+        self.agent_cond = threading.Condition()
+        self.agent_reading = False
+        self.agent_requests: Dict[int, _AgentRequest] = {}
+        self.agent_next_id = 0
 
         self.booted = False
         self.connected = False
+        self.agent = False
 
     @staticmethod
     def create_startcommand(args: Dict[str, str]) -> StartCommand:
@@ -433,9 +563,10 @@ class Machine:
         """
         self.run_callbacks()
         message = f"{command}\n".encode()
-        assert self.monitor is not None
-        self.monitor.send(message)
-        return self.wait_for_monitor_prompt()
+        with self.monitor_lock:
+            assert self.monitor is not None
+            self.monitor.send(message)
+            return self.wait_for_monitor_prompt()
 
     def wait_for_unit(
         self, unit: str, user: Optional[str] = None, timeout: int = 900
@@ -462,11 +593,18 @@ class Machine:
 
             return state == "active"
 
+        # the guest only waits for states that end the wait, check_active
+        # decides whether the unit can still become active otherwise.
+        show = self._systemctl_command(
+            f'--no-pager show "{unit}" --property=ActiveState --value', user
+        )
+        settled = f'[[ "$({show})" =~ ^(active|failed)$ ]]'
+
         with self.nested(
             f"waiting for unit {unit}"
             + (f" with user {user}" if user is not None else "")
         ):
-            retry(check_active, timeout)
+            self._wait_in_guest(settled, timeout, check_active)
 
     def get_unit_info(self, unit: str, user: Optional[str] = None) -> Dict[str, str]:
         status, lines = self.systemctl(f'--no-pager show "{unit}"', user)
@@ -533,14 +671,17 @@ class Machine:
         machine.systemctl("list-jobs --no-pager", "any-user")
         ```
         """
+        return self.execute(self._systemctl_command(q, user))
+
+    def _systemctl_command(self, q: str, user: Optional[str] = None) -> str:
         if user is not None:
             q = q.replace("'", "\\'")
-            return self.execute(
+            return (
                 f"su -l {user} --shell /bin/sh -c "
                 "$'XDG_RUNTIME_DIR=/run/user/`id -u` "
                 f"systemctl --user {q}'"
             )
-        return self.execute(f"systemctl {q}")
+        return f"systemctl {q}"
 
     def require_unit_state(self, unit: str, require_state: str = "active") -> None:
         with self.nested(
@@ -576,6 +717,7 @@ class Machine:
         check_return: bool = True,
         check_output: bool = True,
         timeout: Optional[int] = 900,
+        output_callback: Optional[Callable[[bytes], None]] = None,
     ) -> Tuple[int, str]:
         """
         Execute a shell command, returning a list `(status, stdout)`.
@@ -608,9 +750,18 @@ class Machine:
         A timeout for the command can be specified (in seconds) using the optional
         `timeout` parameter, e.g., `execute(cmd, timeout=10)` or
         `execute(cmd, timeout=None)`. The default is 900 seconds.
+
+        The optional `output_callback` is called with each chunk of stdout as
+        it arrives, e.g. to follow long running commands. stderr goes to the
+        serial console as usual. NixOS guests run commands in a guest agent,
+        which allows several commands to run at the same time from different
+        threads. On other guests commands run one after another and the
+        callback is called once with all of stdout when the command has
+        finished.
         """
         self.run_callbacks()
-        self.connect()
+        with self.shell_lock:
+            self.connect()
 
         # Always run command with shell opts
         command = f"set -euo pipefail; {command}"
@@ -621,27 +772,141 @@ class Machine:
 
         # While sh is bash on NixOS, this is not the case for every distro.
         # We explicitly call bash here to allow for the driver to boot other distros as well.
-        out_command = (
-            f"{timeout_str} bash -c {shlex.quote(command)} | (base64 -w 0; echo)\n"
-        )
+        command = f"{timeout_str} bash -c {shlex.quote(command)}"
 
-        assert self.shell
-        self.shell.send(out_command.encode())
+        if self.agent:
+            return self._execute_in_agent(
+                command, check_return, check_output, output_callback
+            )
+
+        with self.shell_lock:
+            assert self.shell
+            self.shell.send(f"{command} | (base64 -w 0; echo)\n".encode())
 
-        if not check_output:
+            if not check_output:
+                return (-2, "")
+
+            # Get the output
+            output = base64.b64decode(self._next_newline_closed_block_from_shell())
+            if output_callback is not None:
+                output_callback(output)
+
+            if not check_return:
+                return (-1, output.decode())
+
+            # Get the return code
+            self.shell.send(b"echo ${PIPESTATUS[0]}\n")
+            rc = int(self._next_newline_closed_block_from_shell().strip())
+
+            return (rc, output.decode(errors="replace"))
+
+    def _execute_in_agent(
+        self,
+        command: str,
+        check_return: bool,
+        check_output: bool,
+        output_callback: Optional[Callable[[bytes], None]],
+    ) -> Tuple[int, str]:
+        request = _AgentRequest() if check_output else None
+        self._send_agent_request("x", command.encode(), request)
+        if request is None:
             return (-2, "")
 
-        # Get the output
-        output = base64.b64decode(self._next_newline_closed_block_from_shell())
+        output = io.BytesIO()
+        rc = -1
+        for kind, payload in self._agent_frames(request):
+            if kind == "o":
+                output.write(payload)
+                if output_callback is not None:
+                    output_callback(payload)
+            elif kind == "x":
+                rc = int.from_bytes(payload, "big")
 
         if not check_return:
-            return (-1, output.decode())
+            return (-1, output.getvalue().decode())
+        return (rc, output.getvalue().decode(errors="replace"))
+
+    def _send_agent_request(
+        self, kind: str, payload: bytes, request: Optional[_AgentRequest]
+    ) -> None:
+        with self.agent_cond:
+            self.agent_next_id += 1
+            request_id = self.agent_next_id
+            if request is not None:
+                self.agent_requests[request_id] = request
+        with self.shell_lock:
+            assert self.shell
+            self.shell.sendall(
+                AGENT_FRAME.pack(ord(kind), request_id, len(payload)) + payload
+            )
+
+    def _agent_frames(self, request: _AgentRequest) -> Iterator[Tuple[str, bytes]]:
+        """The frames of `request` until its final frame. Waiting threads
+        take turns reading from the agent, the reading thread hands frames
+        of other requests to the threads waiting for them.
+        """
+        while True:
+            with self.agent_cond:
+                while not request.frames and not request.lost and self.agent_reading:
+                    self.agent_cond.wait()
+                frames, request.frames = request.frames, []
+                read = not frames and not request.lost
+                if read:
+                    self.agent_reading = True
+
+            for kind, payload in frames:
+                yield (kind, payload)
+                if kind in ("x", "s"):
+                    return
+            if request.lost:
+                raise Exception("lost the connection to the guest agent")
+
+            if read:
+                try:
+                    self._read_agent_frame()
+                finally:
+                    with self.agent_cond:
+                        self.agent_reading = False
+                        self.agent_cond.notify_all()
+
+    def _read_agent_frame(self) -> None:
+        header = self._recv_exactly(AGENT_FRAME.size)
+        kind, request_id, size = AGENT_FRAME.unpack(header or bytes(AGENT_FRAME.size))
+        payload = self._recv_exactly(size) if chr(kind) in "oxs" else None
+        if header is None or payload is None:
+            self.log(f"unexpected data from the guest agent: {header!r}")
+            with self.agent_cond:
+                for request in self.agent_requests.values():
+                    request.lost = True
+                self.agent_requests.clear()
+                self.agent = False
+            return
 
-        # Get the return code
-        self.shell.send(b"echo ${PIPESTATUS[0]}\n")
-        rc = int(self._next_newline_closed_block_from_shell().strip())
+        with self.agent_cond:
+            waiting = self.agent_requests.get(request_id)
+            if waiting is not None:
+                waiting.frames.append((chr(kind), payload))
+                if chr(kind) in ("x", "s"):
+                    del self.agent_requests[request_id]
 
-        return (rc, output.decode(errors="replace"))
+    def _recv_exactly(self, size: int) -> Optional[bytes]:
+        assert self.shell
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.shell.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return bytes(data)
+
+    def _start_agent(self) -> bool:
+        """Replace the backdoor shell by the guest agent, if the guest has one."""
+        assert self.shell
+        self.shell.send(
+            b'if [ -x "${NIXOS_TEST_AGENT-}" ]; then exec "$NIXOS_TEST_AGENT"; fi; '
+            b"echo no agent\n"
+        )
+        return self._next_newline_closed_block_from_shell().strip() == AGENT_HELLO
 
     def shell_interact(self, address: Optional[str] = None) -> None:
         """
@@ -652,6 +917,14 @@ class Machine:
         """
         self.connect()
 
+        if self.agent:
+            # hand the console back to a shell
+            request = _AgentRequest()
+            self._send_agent_request("s", b"", request)
+            for _ in self._agent_frames(request):
+                pass
+            self.agent = False
+
         if address is None:
             address = "READLINE,prompt=$ "
             self.log("Terminal is ready (there is no initial prompt):")
@@ -723,9 +996,12 @@ class Machine:
 
     def wait_until_succeeds(self, command: str, timeout: int = 900) -> str:
         """
-        Repeat a shell command with 1-second intervals until it succeeds.
+        Repeat a shell command until it succeeds. The command is repeated
+        quickly at first, the intervals then grow up to 1 second.
         Has a default timeout of 900 seconds which can be modified, e.g.
-        `wait_until_succeeds(cmd, timeout=10)`. See `execute` for details on
+        `wait_until_succeeds(cmd, timeout=10)`. The command is tried at least
+        `timeout` times, even if that takes longer than `timeout` seconds
+        because the command itself is slow. See `execute` for details on
         command execution.
         Throws an exception on timeout.
         """
@@ -767,6 +1043,7 @@ class Machine:
             self.pid = None
             self.booted = False
             self.connected = False
+            self.agent = False
 
     def wait_for_qmp_event(
         self, event_filter: Callable[[dict[str, Any]], bool], timeout: int = 60 * 10
@@ -834,12 +1111,8 @@ class Machine:
         Waits until the file exists in the machine's file system.
         """
 
-        def check_file(_: Any) -> bool:
-            status, _ = self.execute(f"test -e {filename}")
-            return status == 0
-
         with self.nested(f"waiting for file '{filename}'"):
-            retry(check_file, timeout)
+            self._wait_in_guest(f"test -e {filename}", timeout)
 
     def wait_for_open_port(
         self, port: int, addr: str = "localhost", timeout: int = 900
@@ -849,12 +1122,8 @@ class Machine:
         (default `localhost`).
         """
 
-        def port_is_open(_: Any) -> bool:
-            status, _ = self.execute(f"nc -z {addr} {port}")
-            return status == 0
-
         with self.nested(f"waiting for TCP port {port} on {addr}"):
-            retry(port_is_open, timeout)
+            self._wait_in_guest(f"nc -z {addr} {port}", timeout)
 
     def wait_for_open_unix_socket(
         self, addr: str, is_datagram: bool = False, timeout: int = 900
@@ -869,14 +1138,10 @@ class Machine:
             "-uU" if is_datagram else "-U",
         ]
 
-        def socket_is_open(_: Any) -> bool:
-            status, _ = self.execute(f"nc {' '.join(nc_flags)} {addr}")
-            return status == 0
-
         with self.nested(
             f"waiting for UNIX-domain {'datagram' if is_datagram else 'stream'} on '{addr}'"
         ):
-            retry(socket_is_open, timeout)
+            self._wait_in_guest(f"nc {' '.join(nc_flags)} {addr}", timeout)
 
     def wait_for_closed_port(
         self, port: int, addr: str = "localhost", timeout: int = 900
@@ -886,12 +1151,8 @@ class Machine:
         (default `localhost`).
         """
 
-        def port_is_closed(_: Any) -> bool:
-            status, _ = self.execute(f"nc -z {addr} {port}")
-            return status != 0
-
         with self.nested(f"waiting for TCP port {port} on {addr} to be closed"):
-            retry(port_is_closed, timeout)
+            self._wait_in_guest(f"! nc -z {addr} {port}", timeout)
 
     def start_job(self, jobname: str, user: Optional[str] = None) -> Tuple[int, str]:
         return self.systemctl(f"start {jobname}", user)
@@ -902,6 +1163,29 @@ class Machine:
     def wait_for_job(self, jobname: str) -> None:
         self.wait_for_unit(jobname)
 
+    def _wait_in_guest(
+        self,
+        condition: str,
+        timeout: int,
+        check: Optional[Callable[[bool], bool]] = None,
+    ) -> None:
+        """Wait until the shell command `condition` succeeds in the guest.
+        The guest polls the condition itself and returns as soon as it holds,
+        or after `GUEST_WAIT_SLICE` seconds. If `check` is given it decides
+        whether the wait is over after each slice, it may raise to fail the
+        wait early. It is passed True on its last call.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            last = remaining <= 0
+            seconds = max(0, min(GUEST_WAIT_SLICE, math.ceil(remaining)))
+            status, _ = self.execute(_guest_wait_command(condition, seconds))
+            if check(last) if check is not None else status == 0:
+                return
+            if last:
+                raise Exception(f"action timed out after {timeout} seconds")
+
     def connect(self) -> None:
         def shell_ready(timeout_secs: int) -> bool:
             """We sent some data from the backdoor service running on the guest
@@ -938,9 +1222,14 @@ class Machine:
                 if b"Spawning backdoor root shell..." in chunk:
                     break
 
+            self.agent = self._start_agent()
             toc = time.time()
 
-            self.log("connected to guest root shell")
+            self.log(
+                "connected to guest agent"
+                if self.agent
+                else "connected to guest root shell"
+            )
             self.log(f"(connecting took {toc - tic:.2f} seconds)")
             self.connected = True
 
@@ -1033,6 +1322,107 @@ class Machine:
             else:
                 shutil.copy(intermediate, abs_target)
 
+    def sync_tree(self, host_dir: str, guest_dir: str) -> None:
+        """
+        Copies the contents of a directory from the host into a directory on
+        the machine, e.g., `sync_tree("./fixtures", "/var/lib/fixtures")`.
+        The directory on the machine is created if needed. Files that exist
+        in both are overwritten, other files on the machine are kept.
+
+        Unlike `copy_from_host`, the whole tree is copied via the
+        `shared_dir` with a single command on the machine, and the copied
+        files are checked against the checksums of the host files. Access
+        rights bits and modification times are kept, user:group will be
+        root:root.
+        """
+        source = Path(host_dir)
+        with tempfile.TemporaryDirectory(dir=self.shared_dir) as shared_td:
+            shared_temp = Path(shared_td)
+            vm_shared_temp = Path("/tmp/shared") / shared_temp.name
+
+            shutil.copytree(source, shared_temp / "tree", symlinks=True)
+            with open(shared_temp / "sha256sums", "w") as sums:
+                for root, _, files in os.walk(source):
+                    for name in files:
+                        path = Path(root) / name
+                        if path.is_file() and not path.is_symlink():
+                            rel = str(path.relative_to(source))
+                            sums.write(_sha256sum_line(_sha256(path), rel))
+
+            self.succeed(
+                make_command(["mkdir", "-p", guest_dir])
+                + " && "
+                + make_command(
+                    [
+                        "cp",
+                        "-RT",
+                        "--preserve=mode,timestamps",
+                        vm_shared_temp / "tree",
+                        guest_dir,
+                    ]
+                )
+                + " && "
+                + make_command(["cd", guest_dir])
+                # sha256sum fails on an empty list, trees without regular
+                # files have nothing to check
+                + " && { [ ! -s "
+                + make_command([vm_shared_temp / "sha256sums"])
+                + " ] || "
+                + make_command(
+                    ["sha256sum", "--quiet", "-c", vm_shared_temp / "sha256sums"]
+                )
+                + "; }"
+            )
+
+    def sync_tree_from_vm(self, guest_dir: str, target_dir: str = "") -> None:
+        """
+        Copies the contents of a directory on the machine into a directory
+        relative to `$out`, the reverse of `sync_tree`. The target directory
+        is created if needed, files that exist in both are overwritten.
+
+        The tree is copied via the `shared_dir` with a single command on the
+        machine, the copied files are checked against the checksums of the
+        files on the machine.
+        """
+        with tempfile.TemporaryDirectory(dir=self.shared_dir) as shared_td:
+            shared_temp = Path(shared_td)
+            vm_shared_temp = Path("/tmp/shared") / shared_temp.name
+
+            self.succeed(
+                make_command(
+                    [
+                        "cp",
+                        "-RT",
+                        "--preserve=mode,timestamps",
+                        guest_dir,
+                        vm_shared_temp / "tree",
+                    ]
+                )
+                + " && "
+                + make_command(["cd", guest_dir])
+                + " && find . -type f -exec sha256sum -- {} + > "
+                + make_command([vm_shared_temp / "sha256sums"])
+            )
+
+            abs_target = self.out_dir / target_dir
+            shutil.copytree(
+                shared_temp / "tree", abs_target, symlinks=True, dirs_exist_ok=True
+            )
+            mismatches = []
+            # sha256sum only escapes backslashes, \n and \r in names. Other
+            # characters that splitlines() or universal newlines would break
+            # lines at stay as they are, so split at \n only.
+            with open(shared_temp / "sha256sums", newline="") as f:
+                lines = f.read().split("\n")[:-1]
+            for line in lines:
+                digest, name = _parse_sha256sum_line(line)
+                if _sha256(abs_target / name) != digest:
+                    mismatches.append(name)
+            if mismatches:
+                raise Exception(
+                    f"checksum mismatch after copying from the VM: {', '.join(mismatches)}"
+                )
+
     def dump_tty_contents(self, tty: str) -> None:
         """Debugging: Dump the contents of the TTY<n>"""
         self.execute(f"fold -w 80 /dev/vcs{tty} | systemd-cat")
@@ -1102,24 +1492,20 @@ class Machine:
         # Buffer the console output, this is needed
         # to match multiline regexes.
         console = io.StringIO()
-
-        def console_matches(_: Any) -> bool:
-            nonlocal console
-            try:
-                # This will return as soon as possible and
-                # sleep 1 second.
-                console.write(self.last_lines.get(block=False))
-            except queue.Empty:
-                pass
-            console.seek(0)
-            matches = re.search(regex, console.read())
-            return matches is not None
+        deadline = time.monotonic() + timeout if timeout is not None else None
 
         with self.nested(f"waiting for {regex} to appear on console"):
-            if timeout is not None:
-                retry(console_matches, timeout)
-            else:
-                while not console_matches(False):
+            while re.search(regex, console.getvalue()) is None:
+                # Block until the next line arrives instead of polling, the
+                # wait ends as soon as a matching line is read.
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Exception(f"action timed out after {timeout} seconds")
+                try:
+                    console.write(self.last_lines.get(timeout=remaining))
+                except queue.Empty:
                     pass
 
     def send_key(
@@ -1220,8 +1606,11 @@ class Machine:
         if not self.booted:
             return
 
-        assert self.shell
-        self.shell.send(b"poweroff\n")
+        if self.agent:
+            self._send_agent_request("x", b"poweroff", None)
+        else:
+            assert self.shell
+            self.shell.send(b"poweroff\n")
         self.wait_for_shutdown()
 
     def crash(self) -> None:
@@ -1243,25 +1632,22 @@ class Machine:
         """
         self.send_key("ctrl-alt-delete")
         self.connected = False
+        self.agent = False
 
     def wait_for_x(self, timeout: int = 900) -> None:
         """
         Wait until it is possible to connect to the X server.
         """
 
-        def check_x(_: Any) -> bool:
-            cmd = (
-                "journalctl -b SYSLOG_IDENTIFIER=systemd | "
-                + 'grep "Reached target Current graphical"'
-            )
-            status, _ = self.execute(cmd)
-            if status != 0:
-                return False
-            status, _ = self.execute("[ -e /tmp/.X11-unix/X0 ]")
-            return status == 0
+        x_ready = (
+            "journalctl -b SYSLOG_IDENTIFIER=systemd | "
+            # not grep -q, exiting early fails the pipeline with SIGPIPE
+            + 'grep "Reached target Current graphical" >/dev/null && '
+            + "[ -e /tmp/.X11-unix/X0 ]"
+        )
 
         with self.nested("waiting for the X11 server"):
-            retry(check_x, timeout)
+            self._wait_in_guest(x_ready, timeout)
 
     def get_window_names(self) -> List[str]:
         return self.succeed(
@@ -1347,4 +1733,5 @@ class Machine:
         )
         self.wait_for_console_text(r"systemd\[1\]:.*Switching root\.")
         self.connected = False
+        self.agent = False
         self.connect()
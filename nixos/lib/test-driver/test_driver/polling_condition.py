@@ -1,3 +1,4 @@
+import threading
 import time
 from math import isfinite
 from typing import Callable, Optional
@@ -16,6 +17,7 @@ class PollingCondition:
 
     last_called: float
     entry_count: int
+    lock: threading.RLock
 
     def __init__(
         self,
@@ -36,27 +38,35 @@ class PollingCondition:
 
         self.last_called = float("-inf")
         self.entry_count = 0
+        self.lock = threading.RLock()
 
     def check(self, force: bool = False) -> bool:
         if (self.entered or not self.overdue) and not force:
             return True
 
-        with self, rootlog.nested(self.nested_message):
-            time_since_last = time.monotonic() - self.last_called
-            last_message = (
-                f"Time since last: {time_since_last:.2f}s"
-                if isfinite(time_since_last)
-                else "(not called yet)"
-            )
-
-            rootlog.info(last_message)
-            try:
-                res = self.condition()  # type: ignore
-            except Exception:
-                res = False
-            res = res is None or res
-            rootlog.info(self.status_message(res))
-            return res
+        # machines used from several threads (see Driver.parallel) all run
+        # the polling conditions, only one of them needs to check.
+        if not self.lock.acquire(blocking=force):
+            return True
+        try:
+            with self, rootlog.nested(self.nested_message):
+                time_since_last = time.monotonic() - self.last_called
+                last_message = (
+                    f"Time since last: {time_since_last:.2f}s"
+                    if isfinite(time_since_last)
+                    else "(not called yet)"
+                )
+
+                rootlog.info(last_message)
+                try:
+                    res = self.condition()  # type: ignore
+                except Exception:
+                    res = False
+                res = res is None or res
+                rootlog.info(self.status_message(res))
+                return res
+        finally:
+            self.lock.release()
 
     def maybe_raise(self) -> None:
         if not self.check():
@@ -0,0 +1,298 @@
+/*
+ * Guest side of the test driver's command channel, see Machine.execute in
+ * nixos/lib/test-driver/test_driver/machine.py. The backdoor shell replaces
+ * itself with this agent once the driver has connected, with stdin and
+ * stdout on the console.
+ *
+ * Everything after the hello line is a frame: a type byte, a request id and
+ * the payload length (both 32 bit big endian), followed by the payload.
+ *
+ * Requests from the driver:
+ *   'x'  run the payload with `bash -c`, stdin is /dev/null and stderr is
+ *        left on the agent's stderr (the serial console) like the backdoor
+ *        shell does
+ *   's'  acknowledge with an empty 's' frame and turn into an interactive
+ *        backdoor shell, ending the agent
+ *
+ * Responses to a 'x' request, several commands may run at the same time:
+ *   'o'  a chunk of the command's stdout
+ *   'x'  the exit status as a 32 bit big endian integer, sent once stdout is
+ *        closed and the command has exited
+ */
+
+#define _GNU_SOURCE
+#include <errno.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <signal.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+#define HELLO "nixos-test-agent 1\n"
+#define HEADER_SIZE 9
+#define MAX_REQUEST (16 * 1024 * 1024)
+#define CHUNK_SIZE 65536
+
+struct command {
+	uint32_t id;
+	pid_t pid;
+	int out;
+	int status;
+	int exited;
+	struct command *next;
+};
+
+static struct command *commands;
+static int sigchld_pipe[2];
+
+static void die(const char *what)
+{
+	fprintf(stderr, "nixos-test-agent: %s: %s\n", what, strerror(errno));
+	exit(1);
+}
+
+static void write_all(const void *buf, size_t len)
+{
+	const char *p = buf;
+	while (len > 0) {
+		ssize_t n = write(STDOUT_FILENO, p, len);
+		if (n < 0) {
+			if (errno == EINTR)
+				continue;
+			die("write");
+		}
+		p += n;
+		len -= n;
+	}
+}
+
+static void put_u32(unsigned char *p, uint32_t v)
+{
+	p[0] = v >> 24;
+	p[1] = v >> 16;
+	p[2] = v >> 8;
+	p[3] = v;
+}
+
+static uint32_t get_u32(const unsigned char *p)
+{
+	return (uint32_t)p[0] << 24 | (uint32_t)p[1] << 16 | (uint32_t)p[2] << 8 | p[3];
+}
+
+static void send_frame(char type, uint32_t id, const void *payload, uint32_t len)
+{
+	unsigned char header[HEADER_SIZE];
+	header[0] = type;
+	put_u32(header + 1, id);
+	put_u32(header + 5, len);
+	write_all(header, sizeof(header));
+	write_all(payload, len);
+}
+
+static void on_sigchld(int sig)
+{
+	int saved = errno;
+	(void)sig;
+	if (write(sigchld_pipe[1], "", 1) < 0) {
+		/* the pipe is full, a wakeup is pending anyway */
+	}
+	errno = saved;
+}
+
+static void run_command(uint32_t id, const char *command)
+{
+	int out[2];
+	if (pipe2(out, O_CLOEXEC) < 0)
+		die("pipe");
+
+	pid_t pid = fork();
+	if (pid < 0)
+		die("fork");
+	if (pid == 0) {
+		int devnull = open("/dev/null", O_RDONLY);
+		if (devnull < 0 || dup2(devnull, STDIN_FILENO) < 0 ||
+		    dup2(out[1], STDOUT_FILENO) < 0)
+			_exit(127);
+		signal(SIGCHLD, SIG_DFL);
+		signal(SIGPIPE, SIG_DFL);
+		execlp("bash", "bash", "-c", command, (char *)NULL);
+		_exit(127);
+	}
+	close(out[1]);
+
+	struct command *c = calloc(1, sizeof(*c));
+	if (!c)
+		die("calloc");
+	c->id = id;
+	c->pid = pid;
+	c->out = out[0];
+	c->next = commands;
+	commands = c;
+}
+
+static void become_shell(uint32_t id)
+{
+	send_frame('s', id, "", 0);
+	signal(SIGCHLD, SIG_DFL);
+	signal(SIGPIPE, SIG_DFL);
+	setenv("PS1", "", 1);
+	/* like the backdoor, passing the console keeps bash non-interactive */
+	const char *console = ttyname(STDIN_FILENO);
+	execlp("bash", "bash", "--norc", console ? console : "/dev/stdin", (char *)NULL);
+	die("exec bash");
+}
+
+/* Handles all complete requests in buf, returns how many bytes were used. */
+static size_t handle_requests(unsigned char *buf, size_t len)
+{
+	size_t used = 0;
+	while (len - used >= HEADER_SIZE) {
+		unsigned char *header = buf + used;
+		uint32_t id = get_u32(header + 1);
+		uint32_t size = get_u32(header + 5);
+		if (size > MAX_REQUEST) {
+			fprintf(stderr, "nixos-test-agent: request of %u bytes is too large\n", size);
+			exit(1);
+		}
+		if (len - used - HEADER_SIZE < size)
+			break;
+
+		char *payload = (char *)header + HEADER_SIZE;
+		switch (header[0]) {
+		case 'x': {
+			char *command = strndup(payload, size);
+			if (!command)
+				die("strndup");
+			run_command(id, command);
+			free(command);
+			break;
+		}
+		case 's':
+			become_shell(id);
+			break;
+		default:
+			fprintf(stderr, "nixos-test-agent: unknown request type %d\n", header[0]);
+			exit(1);
+		}
+		used += HEADER_SIZE + size;
+	}
+	return used;
+}
+
+/* Forwards the command's stdout as 'o' frames, closing it at the end. */
+static void forward(struct command *c)
+{
+	static char chunk[CHUNK_SIZE];
+	ssize_t n = read(c->out, chunk, sizeof(chunk));
+	if (n < 0 && (errno == EINTR || errno == EAGAIN))
+		return;
+	if (n > 0) {
+		send_frame('o', c->id, chunk, n);
+		return;
+	}
+	close(c->out);
+	c->out = -1;
+}
+
+static void reap(void)
+{
+	char drain[64];
+	while (read(sigchld_pipe[0], drain, sizeof(drain)) > 0)
+		;
+
+	for (struct command *c = commands; c; c = c->next) {
+		int status;
+		if (c->exited || waitpid(c->pid, &status, WNOHANG) != c->pid)
+			continue;
+		c->exited = 1;
+		c->status = WIFEXITED(status) ? WEXITSTATUS(status) : 128 + WTERMSIG(status);
+	}
+}
+
+static void finish_commands(void)
+{
+	struct command **p = &commands;
+	while (*p) {
+		struct command *c = *p;
+		if (c->exited && c->out < 0) {
+			unsigned char status[4];
+			put_u32(status, c->status);
+			send_frame('x', c->id, status, sizeof(status));
+			*p = c->next;
+			free(c);
+			continue;
+		}
+		p = &c->next;
+	}
+}
+
+int main(void)
+{
+	if (pipe2(sigchld_pipe, O_CLOEXEC | O_NONBLOCK) < 0)
+		die("pipe");
+	struct sigaction sa = { .sa_handler = on_sigchld, .sa_flags = SA_RESTART };
+	sigaction(SIGCHLD, &sa, NULL);
+	signal(SIGPIPE, SIG_IGN);
+
+	write_all(HELLO, strlen(HELLO));
+
+	size_t cap = CHUNK_SIZE, len = 0;
+	unsigned char *buf = malloc(cap);
+	if (!buf)
+		die("malloc");
+
+	for (;;) {
+		size_t count = 2;
+		for (struct command *c = commands; c; c = c->next)
+			count++;
+		struct pollfd fds[count];
+		struct command *owners[count];
+		size_t n = 0;
+
+		fds[n++] = (struct pollfd){ .fd = STDIN_FILENO, .events = POLLIN };
+		fds[n++] = (struct pollfd){ .fd = sigchld_pipe[0], .events = POLLIN };
+		for (struct command *c = commands; c; c = c->next) {
+			if (c->out >= 0) {
+				owners[n] = c;
+				fds[n++] = (struct pollfd){ .fd = c->out, .events = POLLIN };
+			}
+		}
+
+		if (poll(fds, n, -1) < 0) {
+			if (errno == EINTR)
+				continue;
+			die("poll");
+		}
+
+		if (fds[0].revents) {
+			if (len == cap) {
+				cap *= 2;
+				buf = realloc(buf, cap);
+				if (!buf)
+					die("realloc");
+			}
+			ssize_t r = read(STDIN_FILENO, buf + len, cap - len);
+			if (r == 0)
+				return 0;
+			if (r < 0 && errno != EINTR && errno != EAGAIN)
+				die("read");
+			if (r > 0) {
+				len += r;
+				size_t used = handle_requests(buf, len);
+				memmove(buf, buf + used, len - used);
+				len -= used;
+			}
+		}
+		if (fds[1].revents)
+			reap();
+		for (size_t i = 2; i < n; i++) {
+			if (fds[i].revents)
+				forward(owners[i]);
+		}
+		finish_commands();
+	}
+}
@@ -10,6 +10,13 @@ let
 
   qemu-common = import ../../lib/qemu-common.nix { inherit lib pkgs; };
 
+  # Runs the commands of the test driver once it has connected to the
+  # backdoor shell, see nixos-test-agent.c.
+  testAgent = pkgs.runCommandCC "nixos-test-agent" { } ''
+    mkdir -p "$out/bin"
+    $CC -O2 -Wall ${./nixos-test-agent.c} -o "$out/bin/nixos-test-agent"
+  '';
+
   backdoorService = {
     requires = [ "dev-hvc0.device" "dev-${qemu-common.qemuSerialDevice}.device" ];
     after = [ "dev-hvc0.device" "dev-${qemu-common.qemuSerialDevice}.device" ];
@@ -29,6 +36,9 @@ let
         # interactively.
         export PAGER=
 
+        # The test driver replaces the shell by the agent if it is set.
+        export NIXOS_TEST_AGENT=${testAgent}/bin/nixos-test-agent
+
         cd /tmp
         exec < /dev/hvc0 > /dev/hvc0
         while ! exec 2> /dev/${qemu-common.qemuSerialDevice}; do sleep 0.1; done
@@ -122,6 +132,7 @@ in
         ];
 
         contents."/usr/bin/env".source = "${pkgs.coreutils}/bin/env";
+        storePaths = [ testAgent ];
       })
     ];
 
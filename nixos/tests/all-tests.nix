@@ -90,6 +90,8 @@ in {
     lib-extend = handleTestOn [ "x86_64-linux" "aarch64-linux" ] ./nixos-test-driver/lib-extend.nix {};
     node-name = runTest ./nixos-test-driver/node-name.nix;
     busybox = runTest ./nixos-test-driver/busybox.nix;
+    guest-agent = runTest ./nixos-test-driver/guest-agent.nix;
+    sync-tree = runTest ./nixos-test-driver/sync-tree.nix;
     driver-timeout = pkgs.runCommand "ensure-timeout-induced-failure" {
       failed = pkgs.testers.testBuildFailure ((runTest ./nixos-test-driver/timeout.nix).config.rawTestDerivation);
     } ''
@@ -0,0 +1,45 @@
+{
+  name = "nixos-test-driver.guest-agent";
+
+  nodes = {
+    machine = { };
+  };
+
+  testScript = ''
+    import threading
+    import time
+
+    start_all()
+    machine.wait_for_unit("multi-user.target")
+
+    with subtest("commands run at the same time"):
+        results: dict[int, str] = {}
+
+        def run(i: int) -> None:
+            results[i] = machine.succeed(f"sleep 5; echo {i}")
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(3)]
+        start = time.monotonic()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == {i: f"{i}\n" for i in range(3)}, results
+        assert time.monotonic() - start < 10, "commands did not overlap"
+
+    with subtest("output is streamed"):
+        chunks: list[bytes] = []
+        status, out = machine.execute(
+            "echo first; sleep 1; echo second", output_callback=chunks.append
+        )
+        assert status == 0 and out == "first\nsecond\n", (status, out)
+        assert chunks == [b"first\n", b"second\n"], chunks
+
+    with subtest("stderr goes to the serial console"):
+        machine.succeed("echo stderr-of-a-command >&2")
+        machine.wait_for_console_text("stderr-of-a-command")
+        machine.succeed("sh -c 'sleep 2; echo stderr-of-a-background-job >&2' >&2 &")
+        machine.wait_for_console_text("stderr-of-a-background-job")
+        assert machine.succeed("echo still-working") == "still-working\n"
+  '';
+}
@@ -0,0 +1,73 @@
+{
+  name = "nixos-test-driver.sync-tree";
+
+  nodes = {
+    machine = { };
+  };
+
+  testScript = ''
+    import os
+    import tempfile
+    from pathlib import Path
+
+
+    def tree(root: Path) -> dict[str, bytes]:
+        result = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in dirnames + filenames:
+                path = Path(dirpath) / name
+                rel = str(path.relative_to(root))
+                if path.is_symlink():
+                    result[rel] = b"-> " + os.readlink(path).encode()
+                elif path.is_dir():
+                    result[rel] = b"<dir>"
+                else:
+                    result[rel] = path.read_bytes() + oct(path.stat().st_mode).encode()
+        return result
+
+
+    start_all()
+    machine.wait_for_unit("multi-user.target")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp = Path(tmp_dir)
+
+        with subtest("round trip"):
+            src = tmp / "src"
+            (src / "sub" / "empty").mkdir(parents=True)
+            (src / "a").write_text("a\n")
+            (src / "sub" / "back\\slash").write_text("b\n")
+            (src / "sub" / "new\nline").write_text("c\n")
+            # line breaks to str.splitlines(), but not to sha256sum
+            (src / "sub" / "v\x0bf\x0cs\x1cn\x85u\u2028").write_text("d\n")
+            (src / "big").write_bytes(os.urandom(1 << 20))
+            (src / "link").symlink_to("a")
+            (src / "script").write_text("#!/bin/sh\n")
+            (src / "script").chmod(0o755)
+
+            machine.sync_tree(str(src), "/tmp/synced")
+            machine.succeed(
+                "test -x /tmp/synced/script",
+                "test -d /tmp/synced/sub/empty",
+                "test \"$(cat '/tmp/synced/sub/back\\slash')\" = b",
+                'test "$(readlink /tmp/synced/link)" = a',
+            )
+            machine.sync_tree_from_vm("/tmp/synced", str(tmp / "back"))
+            assert tree(tmp / "back") == tree(src)
+
+        with subtest("existing files are overwritten, others are kept"):
+            (src / "a").write_text("changed\n")
+            machine.succeed("echo keep > /tmp/synced/kept")
+            machine.sync_tree(str(src), "/tmp/synced")
+            assert (
+                machine.succeed("cat /tmp/synced/a /tmp/synced/kept") == "changed\nkeep\n"
+            )
+
+        with subtest("empty directories"):
+            (tmp / "empty").mkdir()
+            machine.sync_tree(str(tmp / "empty"), "/tmp/empty")
+            machine.succeed("test -d /tmp/empty")
+            machine.sync_tree_from_vm("/tmp/empty", str(tmp / "empty-back"))
+            assert tree(tmp / "empty-back") == {}
+  '';
+}
@@ -869,6 +869,11 @@ rec {
     , # We pick 100 to ensure there is plenty of room for extension. I
       # believe the actual maximum is 128.
       maxLayers ? 100
+    , # How to split the store paths in to at most maxLayers layers: "popularity"
+      # gives the most popular paths a layer each and puts the rest in the last
+      # one, "pull-cost" groups them to minimise the bytes pulled again when the
+      # image is rebuilt.
+      layeringStrategy ? "popularity"
     , # Whether to include store paths in the image. You generally want to leave
       # this on, but tooling may disable this to insert the store paths more
       # efficiently via other means, such as bind mounting the host store.
@@ -880,10 +885,14 @@ rec {
       assert
       (lib.assertMsg (maxLayers > 1)
         "the maxLayers argument of dockerTools.buildLayeredImage function must be greather than 1 (current value: ${toString maxLayers})");
+      assert lib.assertOneOf "layeringStrategy" layeringStrategy [ "popularity" "pull-cost" ];
       let
         baseName = baseNameOf name;
 
-        streamScript = writePython3 "stream" { } ./stream_layered_image.py;
+        streamScript = writePython3 "stream" {
+          # for OCI image layouts with zstd compressed layers
+          libraries = [ buildPackages.python3Packages.zstandard ];
+        } ./stream_layered_image.py;
         baseJson = writeText "${baseName}-base.json" (builtins.toJSON {
           inherit config architecture;
           os = "linux";
@@ -955,8 +964,19 @@ rec {
         # so they'll be excluded from the created images.
         unnecessaryDrvs = [ baseJson overallClosure customisationLayer ];
 
-        conf = runCommand "${baseName}-conf.json"
+        # The references graph of the closure, with the narSize of every path,
+        # for the "pull-cost" layering strategy.
+        closureGraph = runCommand "${baseName}-closure-graph.json"
           {
+            exportReferencesGraph.graph = overallClosure;
+            __structuredAttrs = true;
+            preferLocalBuild = true;
+          } ''
+          cp "$NIX_ATTRS_JSON_FILE" "''${outputs[out]}"
+        '';
+
+        conf = runCommand "${baseName}-conf.json"
+          ({
             inherit fromImage maxLayers created;
             imageName = lib.toLower name;
             preferLocalBuild = true;
@@ -965,9 +985,13 @@ rec {
               then tag
               else
                 lib.head (lib.strings.splitString "-" (baseNameOf conf.outPath));
+          } // (if layeringStrategy == "pull-cost" then {
+            graph = closureGraph;
+            nativeBuildInputs = [ jq buildPackages.python3 ];
+          } else {
             paths = buildPackages.referencesByPopularity overallClosure;
             nativeBuildInputs = [ jq ];
-          } ''
+          })) ''
           ${if (tag == null) then ''
             outName="$(basename "$out")"
             outHash=$(echo "$outName" | cut -d - -f 1)
@@ -1009,23 +1033,33 @@ rec {
           fi
           availableLayers=$(( maxLayers - usedLayers ))
 
-          # Create $maxLayers worth of Docker Layers, one layer per store path
-          # unless there are more paths than $maxLayers. In that case, create
-          # $maxLayers-1 for the most popular layers, and smush the remainaing
-          # store paths in to one final layer.
-          #
-          # The following code is fiddly w.r.t. ensuring every layer is
-          # created, and that no paths are missed. If you change the
-          # following lines, double-check that your code behaves properly
-          # when the number of layers equals:
-          #      maxLayers-1, maxLayers, and maxLayers+1, 0
-          paths |
-            jq -sR '
-              rtrimstr("\n") | split("\n")
-                | (.[:$maxLayers-1] | map([.])) + [ .[$maxLayers-1:] ]
-                | map(select(length > 0))
-              ' \
-              --argjson maxLayers "$availableLayers" > store_layers.json
+          ${if layeringStrategy == "pull-cost" then ''
+            # Group the store paths in to at most $maxLayers layers, keeping
+            # large paths which rarely change apart from the ones which do.
+            python3 ${../references-by-popularity/closure-graph.py} \
+              "$graph" graph \
+              --layers "$availableLayers" \
+              ${lib.concatMapStringsSep " " (path: "--exclude ${path}") unnecessaryDrvs} \
+              > store_layers.json
+          '' else ''
+            # Create $maxLayers worth of Docker Layers, one layer per store path
+            # unless there are more paths than $maxLayers. In that case, create
+            # $maxLayers-1 for the most popular layers, and smush the remainaing
+            # store paths in to one final layer.
+            #
+            # The following code is fiddly w.r.t. ensuring every layer is
+            # created, and that no paths are missed. If you change the
+            # following lines, double-check that your code behaves properly
+            # when the number of layers equals:
+            #      maxLayers-1, maxLayers, and maxLayers+1, 0
+            paths |
+              jq -sR '
+                rtrimstr("\n") | split("\n")
+                  | (.[:$maxLayers-1] | map([.])) + [ .[$maxLayers-1:] ]
+                  | map(select(length > 0))
+                ' \
+                --argjson maxLayers "$availableLayers" > store_layers.json
+          ''}
 
           # The index on $store_layers is necessary because the --slurpfile
           # automatically reads the file as an array.
@@ -3,7 +3,9 @@ This script generates a Docker image from a set of store paths. Uses
 Docker Image Specification v1.2 as reference [1].
 
 It expects a JSON file with the following properties and writes the
-image as an uncompressed tarball to stdout:
+image as an uncompressed tarball to stdout (or as an OCI image layout
+[3] with '--format oci', optionally with compressed layers; see
+'OciLayout'):
 
 * "architecture", "config", "os", "created", "repo_tag" correspond to
   the fields with the same name on the image spec [2].
@@ -26,39 +28,275 @@ on the first iteration we calculate the file size and the checksum,
 and on the second one we actually stream the contents. 'add_layer_dir'
 function does all this.
 
+Tarballs are written with 'TarWriter' rather than 'tarfile', so that
+whenever the contents of a file are written to stdout unmodified, they
+are copied by the kernel instead of passing through Python.
+
+Alternatively, with '--single-pass' each layer tarball is only created
+once, and spooled to a temporary file while its size and checksum are
+calculated. With '--cache-dir', the spooled layers are kept in the
+given directory and reused by later runs; see 'LayerCache'.
+
+Layer checksums and sizes can also be recorded in a digest index with
+'--digest-index', so later runs only have to archive those layers once
+when streaming them. With '--metadata-only', only the image JSON and
+'manifest.json' are written, which then doesn't need to read any store
+paths whose layers are already in the index; see 'LayerDigestIndex'.
+
 [1]: https://github.com/moby/moby/blob/master/image/spec/v1.2.md
 [2]: https://github.com/moby/moby/blob/4fb59c20a4fb54f944fe170d0ff1d00eb4a24d6f/image/spec/v1.2.md#image-json-field-descriptions
+[3]: https://github.com/opencontainers/image-spec/blob/v1.1.0/image-layout.md
 """  # noqa: E501
 
 
 import io
 import os
 import re
+import bz2
+import grp
+import pwd
 import sys
+import gzip
 import json
+import lzma
+import stat
+import zlib
+import errno
+import struct
 import hashlib
 import pathlib
 import tarfile
+import argparse
+import tempfile
+import functools
 import itertools
-import threading
+import posixpath
 from datetime import datetime, timezone
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+# Errors with which 'os.copy_file_range' and 'os.sendfile' signal that
+# they can't copy between the given file descriptors.
+KERNEL_COPY_UNSUPPORTED = {
+    errno.EBADF,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTSOCK,
+    errno.ENOTSUP,
+    errno.EOPNOTSUPP,
+    errno.ESPIPE,
+    errno.EXDEV,
+}
+
+
+def copy_file_range(src_fd, dst_fd, offset, count):
+    return os.copy_file_range(src_fd, dst_fd, count, offset_src=offset)
+
+
+def sendfile(src_fd, dst_fd, offset, count):
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+def kernel_copy(src_fd, dst_fd, offset, count):
+    """
+    Copies up to 'count' bytes from 'src_fd' at 'offset' to the current
+    position of 'dst_fd' without passing them through user space, using
+    'os.copy_file_range' between regular files and 'os.sendfile'
+    otherwise.
+
+    Returns: The number of bytes copied. This is less than 'count' if the
+             source is shorter, or if neither way of copying is supported
+             for these file descriptors.
+    """
+    copied = 0
+    copies = [sendfile]
+    if hasattr(os, "copy_file_range"):
+        copies.insert(0, copy_file_range)
+
+    for copy in copies:
+        try:
+            while copied < count:
+                n = copy(src_fd, dst_fd, offset + copied, count - copied)
+                if n == 0:
+                    return copied
+                copied += n
+            return copied
+        except OSError as e:
+            if e.errno not in KERNEL_COPY_UNSUPPORTED:
+                raise
+    return copied
+
+
+def copy_fileobj(src, dst, size):
+    """
+    Copies 'size' bytes from the current position of 'src' to 'dst'. If
+    both are backed by file descriptors, the bytes are copied by the
+    kernel where possible.
+    """
+    try:
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+    except (AttributeError, OSError):
+        pass
+    else:
+        dst.flush()
+        offset = src.tell()
+        copied = kernel_copy(src_fd, dst_fd, offset, size)
+        src.seek(offset + copied)
+        size -= copied
+
+    while size > 0:
+        buf = src.read(min(size, io.DEFAULT_BUFFER_SIZE * 16))
+        if not buf:
+            raise OSError("unexpected end of data")
+        dst.write(buf)
+        size -= len(buf)
+
+
+class TarWriter:
+    """
+    A minimal streaming tar writer, which produces the same output as
+    'tarfile.open(mode="w|")'.
+
+    Unlike 'tarfile', it copies the contents of files with 'copy_fileobj',
+    so they don't pass through Python when written to a file or socket.
+    It also has the same 'write' and 'copy_from' methods it expects from
+    the stream it writes to, so tarballs written into another tarball
+    get the same benefit.
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def write(self, data):
+        self._fileobj.write(data)
+        self.offset += len(data)
+
+    def copy_from(self, fileobj, size):
+        """
+        Writes 'size' bytes from the current position of 'fileobj'.
+        """
+        if hasattr(self._fileobj, "copy_from"):
+            self._fileobj.copy_from(fileobj, size)
+        else:
+            copy_fileobj(fileobj, self._fileobj, size)
+        self.offset += size
+
+    def _pad(self, size):
+        remainder = self.offset % size
+        if remainder > 0:
+            self.write(tarfile.NUL * (size - remainder))
+
+    def _write_header(self, tarinfo):
+        self.write(tarinfo.tobuf(
+            tarfile.DEFAULT_FORMAT,
+            tarfile.ENCODING,
+            "surrogateescape",
+        ))
+
+    def addfile(self, tarinfo, fileobj=None):
+        """
+        Adds the given 'tarfile.TarInfo' object, and 'tarinfo.size' bytes
+        from 'fileobj' as its contents if given.
+        """
+        self._write_header(tarinfo)
+        if fileobj is not None:
+            self.copy_from(fileobj, tarinfo.size)
+            self._pad(tarfile.BLOCKSIZE)
+
+    def addstream(self, tarinfo, write_contents):
+        """
+        Adds the given 'tarfile.TarInfo' object, with contents written by
+        calling 'write_contents' with this object as a stream. It must
+        write exactly 'tarinfo.size' bytes.
+        """
+        self._write_header(tarinfo)
+        start = self.offset
+        write_contents(self)
+        written = self.offset - start
+        assert written == tarinfo.size, \
+            f"Expected {tarinfo.size} bytes for {tarinfo.name}, got {written}"
+        self._pad(tarfile.BLOCKSIZE)
+
+    def close(self):
+        self.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        self._pad(tarfile.RECORDSIZE)
+
+
+@functools.lru_cache(maxsize=None)
+def uname(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ""
+
+
+@functools.lru_cache(maxsize=None)
+def gname(gid):
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ""
+
+
+FILE_TYPES = {
+    stat.S_IFREG: tarfile.REGTYPE,
+    stat.S_IFDIR: tarfile.DIRTYPE,
+    stat.S_IFLNK: tarfile.SYMTYPE,
+    stat.S_IFIFO: tarfile.FIFOTYPE,
+    stat.S_IFCHR: tarfile.CHRTYPE,
+    stat.S_IFBLK: tarfile.BLKTYPE,
+}
+
+
+def path_tarinfo(path, name=None):
+    """
+    Creates a 'tarfile.TarInfo' object for the given path, like
+    'tarfile.TarFile.gettarinfo'. Hardlinks are always represented as
+    regular files.
+
+    name: Name of the member, defaults to the absolute 'path'.
+    """
+    st = os.lstat(path)
+    file_type = FILE_TYPES.get(stat.S_IFMT(st.st_mode))
+    assert file_type is not None, f"Unsupported file type: {path}"
+
+    ti = tarfile.TarInfo(str(path) if name is None else name)
+    ti.mode = st.st_mode
+    ti.uid = st.st_uid
+    ti.gid = st.st_gid
+    ti.uname = uname(st.st_uid)
+    ti.gname = gname(st.st_gid)
+    ti.mtime = st.st_mtime
+    ti.type = file_type
+    if file_type == tarfile.REGTYPE:
+        ti.size = st.st_size
+    elif file_type == tarfile.SYMTYPE:
+        ti.linkname = os.readlink(path)
+    elif file_type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        ti.devmajor = os.major(st.st_rdev)
+        ti.devminor = os.minor(st.st_rdev)
+    return ti
 
 
 def archive_paths_to(obj, paths, mtime):
     """
     Writes the given store paths as a tar file to the given stream.
 
-    obj: Stream to write to. Should have a 'write' method.
+    obj: Stream to write to. Should have a 'write' method, and may have
+         a 'copy_from' method like 'TarWriter'.
     paths: List of store paths.
     """
 
-    # gettarinfo makes the paths relative, this makes them
-    # absolute again
-    def append_root(ti):
-        ti.name = "/" + ti.name
-        return ti
-
     def apply_filters(ti):
         ti.mtime = mtime
         ti.uid = 0
@@ -76,7 +314,7 @@ def archive_paths_to(obj, paths, mtime):
         ti.type = tarfile.DIRTYPE
         return ti
 
-    with tarfile.open(fileobj=obj, mode="w|") as tar:
+    with TarWriter(obj) as tar:
         # To be consistent with the docker utilities, we need to have
         # these directories first when building layer tarballs.
         tar.addfile(apply_filters(nix_root(dir("/nix"))))
@@ -90,15 +328,8 @@ def archive_paths_to(obj, paths, mtime):
                 files = itertools.chain([path], path.rglob("*"))
 
             for filename in sorted(files):
-                ti = append_root(tar.gettarinfo(filename))
-
-                # copy hardlinks as regular files
-                if ti.islnk():
-                    ti.type = tarfile.REGTYPE
-                    ti.linkname = ""
-                    ti.size = filename.stat().st_size
-
-                ti = apply_filters(ti)
+                # hardlinks are copied as regular files
+                ti = apply_filters(path_tarinfo(filename))
                 if ti.isfile():
                     with open(filename, "rb") as f:
                         tar.addfile(ti, f)
@@ -127,15 +358,446 @@ class ExtractChecksum:
         return (self._digest.hexdigest(), self._size)
 
 
-FromImage = namedtuple("FromImage", ["tar", "manifest_json", "image_json"])
+class SpoolChecksum(ExtractChecksum):
+    """
+    A writable stream which calculates the final file size and sha256sum
+    like 'ExtractChecksum', while also writing the contents to the given
+    spool file.
+    """
+
+    def __init__(self, spool):
+        super().__init__()
+        self._spool = spool
+
+    def write(self, data):
+        super().write(data)
+        self._spool.write(data)
+
+
+# Size of the blocks layers are split into to compress them in parallel.
+COMPRESSION_BLOCK_SIZE = 1024 * 1024
+
+
+class GzipBlocks:
+    """
+    Compresses a stream into a single gzip member, as independently
+    compressed blocks like pigz does. Each block is compressed with the
+    previous 32 KiB as its dictionary, and all but the last one end with
+    a sync flush, so the concatenated blocks form one deflate stream.
+    """
+
+    media_type_suffix = "+gzip"
+
+    def __init__(self):
+        self._crc = 0
+        self._size = 0
+        self._dictionary = b""
+
+    def header(self):
+        # No file name, an mtime of 0, no extra flags and an unknown OS,
+        # so the output only depends on the input.
+        return b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+    @staticmethod
+    def _compress(block, dictionary, last):
+        if dictionary:
+            compressor = zlib.compressobj(
+                wbits=-zlib.MAX_WBITS,
+                zdict=dictionary,
+            )
+        else:
+            compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        flush_mode = zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+        return compressor.compress(block) + compressor.flush(flush_mode)
+
+    def submit(self, pool, block, last):
+        """
+        Returns: A future of the compressed block.
+        """
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+        dictionary = self._dictionary
+        self._dictionary = (dictionary + block)[-32 * 1024:]
+        return pool.submit(self._compress, block, dictionary, last)
+
+    def trailer(self):
+        return struct.pack("<II", self._crc, self._size & 0xffffffff)
+
+
+class ZstdBlocks:
+    """
+    Compresses a stream into concatenated zstd frames, one for each
+    block, which decompress to the concatenated blocks.
+    """
+
+    media_type_suffix = "+zstd"
+
+    def __init__(self):
+        try:
+            # Python 3.14 and later
+            from compression.zstd import compress
+        except ImportError:
+            from zstandard import ZstdCompressor
+
+            def compress(block):
+                return ZstdCompressor().compress(block)
+
+        self._compress = compress
+
+    def header(self):
+        return b""
+
+    def submit(self, pool, block, last):
+        return pool.submit(self._compress, block)
+
+    def trailer(self):
+        return b""
+
+
+COMPRESSIONS = {
+    "none": None,
+    "gzip": GzipBlocks,
+    "zstd": ZstdBlocks,
+}
+
+
+class CompressChecksum:
+    """
+    A writable stream which compresses its contents with the given
+    'GzipBlocks' or 'ZstdBlocks' object, writing the result to the given
+    spool file. Blocks are compressed in parallel on the given thread
+    pool, and the final size and sha256sum of both the uncompressed and
+    the compressed contents are calculated along the way.
+    """
+
+    def __init__(self, spool, blocks, pool, max_pending):
+        self._uncompressed = ExtractChecksum()
+        self._compressed = SpoolChecksum(spool)
+        self._blocks = blocks
+        self._pool = pool
+        self._max_pending = max_pending
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._compressed.write(blocks.header())
+
+    def write(self, data):
+        self._uncompressed.write(data)
+        self._buffer += data
+        while len(self._buffer) >= COMPRESSION_BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:COMPRESSION_BLOCK_SIZE]))
+            del self._buffer[:COMPRESSION_BLOCK_SIZE]
+
+    def _submit(self, block, last=False):
+        self._pending.append(self._blocks.submit(self._pool, block, last))
+        while len(self._pending) > self._max_pending:
+            self._compressed.write(self._pending.popleft().result())
+
+    def close(self):
+        self._submit(bytes(self._buffer), last=True)
+        self._buffer.clear()
+        while self._pending:
+            self._compressed.write(self._pending.popleft().result())
+        self._compressed.write(self._blocks.trailer())
+
+    def extract(self):
+        """
+        Returns: Hex-encoded sha256sums and sizes of the uncompressed and
+                 compressed contents, as a tuple of tuples.
+        """
+        return (self._uncompressed.extract(), self._compressed.extract())
+
+
+def layer_key(paths, mtime):
+    """
+    Returns: A key identifying the layer tarball created from the given
+             store paths and mtime. Store paths are immutable, so the same
+             key always results in the same tarball. The order of the paths
+             is significant, as it determines the order of the files in the
+             tarball.
+    """
+    key = json.dumps({"paths": list(paths), "mtime": mtime})
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class LayerCache:
+    """
+    A persistent on-disk cache of layer tarballs, so unchanged layers do
+    not need to be archived again when an image is rebuilt.
+
+    Tarballs are stored content addressed as 'blobs/sha256/<checksum>',
+    and 'keys/<key>' holds the checksum of the tarball with the given
+    'layer_key'.
+    """
+
+    def __init__(self, directory):
+        self._blobs = os.path.join(directory, "blobs", "sha256")
+        self._keys = os.path.join(directory, "keys")
+        os.makedirs(self._blobs, exist_ok=True)
+        os.makedirs(self._keys, exist_ok=True)
+
+    def blob_path(self, checksum):
+        return os.path.join(self._blobs, checksum)
+
+    def lookup(self, key):
+        """
+        Returns: Hex-encoded sha256sum and size of the cached tarball as a
+                 tuple, or 'None' if there is no such layer in the cache.
+        """
+        try:
+            with open(os.path.join(self._keys, key)) as f:
+                checksum = f.read().strip()
+            size = os.stat(self.blob_path(checksum)).st_size
+        except FileNotFoundError:
+            return None
+        return (checksum, size)
+
+    def spool(self):
+        """
+        Returns: A new temporary file inside the cache, to be passed to
+                 'insert' once the layer tarball is written to it.
+        """
+        return tempfile.NamedTemporaryFile(
+            dir=self._blobs,
+            prefix=".tmp-",
+            delete=False,
+        )
+
+    def insert(self, key, spool_path, checksum):
+        """
+        Moves a spooled layer tarball into the cache, and records it
+        under the given key. Both steps are atomic, so concurrent or
+        interrupted runs never observe partially written entries.
+        """
+        os.replace(spool_path, self.blob_path(checksum))
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self._keys, prefix=".tmp-", delete=False
+        ) as f:
+            f.write(checksum)
+        os.replace(f.name, os.path.join(self._keys, key))
+
+
+class LayerDigestIndex:
+    """
+    A JSON file recording the checksum and size of layer tarballs by
+    their 'layer_key', without keeping the tarballs themselves.
+
+    Knowing the checksum and size of a layer up front means it only has
+    to be archived once to be streamed, and not at all if only the image
+    metadata is needed. Entries are trusted as is, like the checksum of
+    the customisation layer.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._modified = False
+        try:
+            with open(path) as f:
+                self._digests = json.load(f)
+        except FileNotFoundError:
+            self._digests = {}
+
+    def lookup(self, key):
+        """
+        Returns: Hex-encoded sha256sum and size of the layer tarball as a
+                 tuple, or 'None' if the layer is not in the index.
+        """
+        digest = self._digests.get(key)
+        if digest is None:
+            return None
+        return (digest["checksum"], digest["size"])
+
+    def insert(self, key, checksum, size):
+        if self._digests.get(key) != {"checksum": checksum, "size": size}:
+            self._digests[key] = {"checksum": checksum, "size": size}
+            self._modified = True
+
+    def save(self):
+        """
+        Writes the index back to its file, if any layers were added.
+        """
+        if not self._modified:
+            return
+        directory = os.path.dirname(os.path.abspath(self._path))
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, prefix=".tmp-", delete=False
+        ) as f:
+            json.dump(self._digests, f, indent=2, sort_keys=True)
+        os.replace(f.name, self._path)
+        self._modified = False
+
+
+def spool_layer(paths, mtime, cache=None, named=False):
+    """
+    Archives the given store paths once, writing the tarball to a spool
+    file while calculating its checksum and size.
+
+    paths: List of store paths.
+    mtime: 'mtime' of the added files.
+    cache: Optional 'LayerCache' object. If the layer is already in the
+           cache it is not archived again, otherwise it is added to it.
+    named: Whether the spool file should have a name and be kept after
+           it is closed, so it can be read by another process. Only
+           relevant without a cache.
+
+    Returns: Hex-encoded sha256sum, size and the spooled tarball (opened
+             for reading and positioned at its start) as a tuple.
+    """
+    if cache is None:
+        key = None
+        if named:
+            spool = tempfile.NamedTemporaryFile(prefix="layer-", delete=False)
+        else:
+            spool = tempfile.TemporaryFile()
+    else:
+        key = layer_key(paths, mtime)
+        cached = cache.lookup(key)
+        if cached is not None:
+            (checksum, size) = cached
+            print("Reusing cached layer", checksum, file=sys.stderr)
+            return (checksum, size, open(cache.blob_path(checksum), "rb"))
+        spool = cache.spool()
+
+    try:
+        spool_checksum = SpoolChecksum(spool)
+        archive_paths_to(
+            spool_checksum,
+            paths,
+            mtime=mtime,
+        )
+        (checksum, size) = spool_checksum.extract()
+        spool.flush()
+        if cache is not None:
+            cache.insert(key, spool.name, checksum)
+    except BaseException:
+        spool.close()
+        if cache is not None or named:
+            os.unlink(spool.name)
+        raise
+
+    spool.seek(0)
+    return (checksum, size, spool)
+
+
+def spool_layer_to_path(paths, mtime, cache=None):
+    """
+    Like 'spool_layer', but meant to run in a worker process, so returns
+    the path of the spooled tarball instead of an open file.
+
+    Returns: Hex-encoded sha256sum, size, path of the spooled tarball and
+             whether that path is a temporary file the caller should
+             remove once done with it, as a tuple.
+    """
+    (checksum, size, spool) = spool_layer(paths, mtime, cache, named=True)
+    spool.close()
+    if cache is None:
+        return (checksum, size, spool.name, True)
+    return (checksum, size, cache.blob_path(checksum), False)
+
+
+def layer_digest(paths, mtime, cache=None, index=None):
+    """
+    Calculates the checksum and size of the layer tarball for the given
+    store paths, without keeping the tarball itself. Nothing is read if
+    the layer is already in the given cache or index.
+
+    paths: List of store paths.
+    mtime: 'mtime' of the added files.
+    cache: Optional 'LayerCache' object to look the layer up in.
+    index: Optional 'LayerDigestIndex' object to look the layer up in,
+           and to record it in.
+
+    Returns: Hex-encoded sha256sum and size as a tuple.
+    """
+    key = layer_key(paths, mtime)
+    digest = None if index is None else index.lookup(key)
+    if digest is None and cache is not None:
+        digest = cache.lookup(key)
+    if digest is None:
+        extract_checksum = ExtractChecksum()
+        archive_paths_to(
+            extract_checksum,
+            paths,
+            mtime=mtime,
+        )
+        digest = extract_checksum.extract()
+
+    if index is not None:
+        index.insert(key, *digest)
+    return digest
+
+
+# 'file' is the uncompressed base image archive, and 'members' maps the
+# names of its members to their 'tarfile.TarInfo' objects.
+FromImage = namedtuple(
+    "FromImage",
+    ["file", "members", "manifest_json", "image_json"],
+)
 # Some metadata for a layer
 LayerInfo = namedtuple("LayerInfo", ["size", "checksum", "path", "paths"])
 
+# Magic numbers of the compression formats base images may come in.
+DECOMPRESSORS = {
+    b"\x1f\x8b": gzip.open,
+    b"BZh": bz2.open,
+    b"\xfd7zXZ\x00": lzma.open,
+}
+
+
+def open_uncompressed(path):
+    """
+    Opens the given file for reading. If it is compressed, it is
+    decompressed to a temporary file once, so that it can be read at
+    random offsets, without passing through Python.
+    """
+    f = open(path, "rb")
+    magic = f.read(6)
+    f.seek(0)
+
+    for prefix, decompressor in DECOMPRESSORS.items():
+        if magic.startswith(prefix):
+            with f, decompressor(f) as compressed:
+                uncompressed = tempfile.TemporaryFile()
+                copy_fileobj_until_eof(compressed, uncompressed)
+            uncompressed.seek(0)
+            return uncompressed
+    return f
+
+
+def copy_fileobj_until_eof(src, dst):
+    while buf := src.read(io.DEFAULT_BUFFER_SIZE * 16):
+        dst.write(buf)
+
+
+def read_member(from_image, name):
+    tarinfo = resolve_member(from_image, from_image.members[name])
+    from_image.file.seek(tarinfo.offset_data)
+    return from_image.file.read(tarinfo.size)
+
+
+def resolve_member(from_image, tarinfo):
+    """
+    Returns: The 'tarfile.TarInfo' object of the member which holds the
+             contents of the given one, following symlinks and hardlinks
+             (as 'docker save' uses them for duplicate layers).
+    """
+    while tarinfo.issym() or tarinfo.islnk():
+        if tarinfo.issym():
+            target = posixpath.join(posixpath.dirname(tarinfo.name),
+                                    tarinfo.linkname)
+        else:
+            target = tarinfo.linkname
+        tarinfo = from_image.members[posixpath.normpath(target)]
+    return tarinfo
+
 
 def load_from_image(from_image_str):
     """
     Loads the given base image, if any.
 
+    Only the headers of the members of the archive are read, by skipping
+    over their contents. The layers are later copied straight from the
+    archive by 'add_base_layers'.
+
     from_image_str: Path to the base image archive.
 
     Returns: A 'FromImage' object with references to the loaded base image,
@@ -144,25 +806,34 @@ def load_from_image(from_image_str):
     if from_image_str is None:
         return None
 
-    base_tar = tarfile.open(from_image_str)
-
-    manifest_json_tarinfo = base_tar.getmember("manifest.json")
-    with base_tar.extractfile(manifest_json_tarinfo) as f:
-        manifest_json = json.load(f)
+    base_file = open_uncompressed(from_image_str)
+    with tarfile.open(fileobj=base_file, mode="r:") as base_tar:
+        members = {
+            posixpath.normpath(member.name): member
+            for member in base_tar.getmembers()
+        }
 
-    image_json_tarinfo = base_tar.getmember(manifest_json[0]["Config"])
-    with base_tar.extractfile(image_json_tarinfo) as f:
-        image_json = json.load(f)
+    from_image = FromImage(base_file, members, None, None)
+    manifest_json = json.loads(read_member(from_image, "manifest.json"))
+    image_json = json.loads(
+        read_member(from_image, manifest_json[0]["Config"])
+    )
 
-    return FromImage(base_tar, manifest_json, image_json)
+    return from_image._replace(
+        manifest_json=manifest_json,
+        image_json=image_json,
+    )
 
 
-def add_base_layers(tar, from_image):
+def add_base_layers(layout, from_image, metadata_only=False):
     """
     Adds the layers from the given base image to the final image.
 
-    tar: 'tarfile.TarFile' object for new layers to be added to.
+    layout: 'DockerLayout' or 'OciLayout' object for new layers to be
+            added to.
     from_image: 'FromImage' object with references to the loaded base image.
+    metadata_only: Whether to only return the metadata of the layers,
+                   without adding them.
     """
     if from_image is None:
         print("No 'fromImage' provided", file=sys.stderr)
@@ -173,17 +844,27 @@ def add_base_layers(tar, from_image):
     layers_checksums = zip(layers, checksums)
 
     for num, (layer, checksum) in enumerate(layers_checksums, start=1):
-        layer_tarinfo = from_image.tar.getmember(layer)
+        layer_tarinfo = from_image.members[posixpath.normpath(layer)]
         checksum = re.sub(r"^sha256:", "", checksum)
 
-        tar.addfile(layer_tarinfo, from_image.tar.extractfile(layer_tarinfo))
         path = layer_tarinfo.path
         size = layer_tarinfo.size
 
         print("Adding base layer", num, "from", path, file=sys.stderr)
+        if not metadata_only:
+            # The layer is trusted to match its diff_id, and copied as
+            # is. Links are copied as links by 'DockerLayout'.
+            data_tarinfo = resolve_member(from_image, layer_tarinfo)
+            from_image.file.seek(data_tarinfo.offset_data)
+            path = layout.add_layer(
+                checksum,
+                data_tarinfo.size,
+                from_image.file,
+                tarinfo=layer_tarinfo,
+            )
         yield LayerInfo(size=size, checksum=checksum, path=path, paths=[path])
 
-    from_image.tar.close()
+    from_image.file.close()
 
 
 def overlay_base_config(from_image, final_config):
@@ -208,70 +889,408 @@ def overlay_base_config(from_image, final_config):
     return final_config
 
 
-def add_layer_dir(tar, paths, store_dir, mtime):
+def check_store_paths(paths, store_dir):
+    invalid_paths = [i for i in paths if not i.startswith(store_dir)]
+    assert len(invalid_paths) == 0, \
+        f"Expecting absolute paths from {store_dir}, but got: {invalid_paths}"
+
+
+def make_layer_tarinfo(checksum, size, mtime):
+    """
+    Returns: A 'tarfile.TarInfo' object for a layer tarball with the
+             given checksum and size in the outer tarball.
     """
-    Appends given store paths to a TarFile object as a new layer.
+    tarinfo = tarfile.TarInfo(f"{checksum}/layer.tar")
+    tarinfo.size = size
+    tarinfo.mtime = mtime
+    return tarinfo
+
+
+class DockerLayout:
+    """
+    Writes the image as a Docker Image Specification v1.2 tarball, with
+    each layer as an uncompressed '<checksum>/layer.tar'.
+    """
+
+    # Whether layers are spooled anyway, so their checksum and size need
+    # not be known up front.
+    spools_layers = False
+
+    def __init__(self, tar, mtime):
+        self._tar = tar
+        self._mtime = mtime
+
+    def add_layer(self, checksum, size, fileobj, tarinfo=None):
+        """
+        Adds an uncompressed layer tarball from the current position of
+        'fileobj'.
+
+        tarinfo: Header to add the tarball with, as is. Defaults to the
+                 one from 'make_layer_tarinfo'.
 
-    tar: 'tarfile.TarFile' object for the new layer to be added to.
+        Returns: The path of the layer in the image.
+        """
+        if tarinfo is None:
+            tarinfo = make_layer_tarinfo(checksum, size, self._mtime)
+        self._tar.addfile(tarinfo, fileobj)
+        return tarinfo.name
+
+    def add_layer_stream(self, checksum, size, write_contents):
+        """
+        Adds an uncompressed layer tarball written by 'write_contents',
+        see 'TarWriter.addstream'.
+
+        Returns: Hex-encoded sha256sum, size and path in the image of the
+                 layer as a tuple.
+        """
+        tarinfo = make_layer_tarinfo(checksum, size, self._mtime)
+        self._tar.addstream(tarinfo, write_contents)
+        return (checksum, size, tarinfo.name)
+
+    def add_metadata(self, layers, image_json, repo_tag):
+        """
+        Adds the image JSON and 'manifest.json' describing the image.
+
+        layers: List of 'LayerInfo' objects of the added layers.
+        image_json: 'dict' object of the image JSON.
+        repo_tag: Name and tag of the image.
+        """
+        image_json = json.dumps(image_json, indent=4).encode("utf-8")
+        image_json_checksum = hashlib.sha256(image_json).hexdigest()
+        image_json_path = f"{image_json_checksum}.json"
+        add_bytes(self._tar, image_json_path, image_json, mtime=self._mtime)
+
+        manifest_json = [
+            {
+                "Config": image_json_path,
+                "RepoTags": [repo_tag],
+                "Layers": [layer.path for layer in layers],
+            }
+        ]
+        manifest_json = json.dumps(manifest_json, indent=4).encode("utf-8")
+        add_bytes(self._tar, "manifest.json", manifest_json, mtime=self._mtime)
+
+    def close(self):
+        pass
+
+
+class OciLayout:
+    """
+    Writes the image as an OCI image layout tarball, with each layer as a
+    blob which is optionally compressed.
+
+    Compressed blobs are named after their own checksum, so they are
+    spooled to a temporary file while compressing them; see
+    'CompressChecksum'. The checksum of the uncompressed layer, which
+    ends up in the image JSON, is calculated at the same time.
+    """
+
+    def __init__(self, tar, mtime, compression, threads):
+        self._tar = tar
+        self._mtime = mtime
+        self._blocks = COMPRESSIONS[compression]
+        self._threads = threads
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._descriptors = []
+        self.spools_layers = self._blocks is not None
+
+    def _media_type(self):
+        media_type = "application/vnd.oci.image.layer.v1.tar"
+        if self._blocks is not None:
+            media_type += self._blocks.media_type_suffix
+        return media_type
+
+    def _add_blob(self, checksum, size, fileobj, media_type):
+        tarinfo = tarfile.TarInfo(f"blobs/sha256/{checksum}")
+        tarinfo.size = size
+        tarinfo.mtime = self._mtime
+        self._tar.addfile(tarinfo, fileobj)
+        self._descriptors.append({
+            "mediaType": media_type,
+            "digest": f"sha256:{checksum}",
+            "size": size,
+        })
+        return tarinfo.name
+
+    def _spool_blob(self, write_contents):
+        """
+        Spools the blob for a layer written by 'write_contents', and adds
+        it to the image.
+
+        Returns: Hex-encoded sha256sum, size and path in the image of the
+                 uncompressed layer as a tuple.
+        """
+        with tempfile.TemporaryFile() as spool:
+            if self._blocks is None:
+                stream = SpoolChecksum(spool)
+                write_contents(stream)
+                digest = blob_digest = stream.extract()
+            else:
+                stream = CompressChecksum(
+                    spool,
+                    self._blocks(),
+                    self._pool,
+                    max_pending=2 * self._threads,
+                )
+                write_contents(stream)
+                stream.close()
+                (digest, blob_digest) = stream.extract()
+
+            spool.seek(0)
+            path = self._add_blob(*blob_digest, spool, self._media_type())
+        return (*digest, path)
+
+    def add_layer(self, checksum, size, fileobj, tarinfo=None):
+        """
+        Adds an uncompressed layer tarball from the current position of
+        'fileobj', compressing it if needed. 'tarinfo' is ignored.
+
+        Returns: The path of the layer in the image.
+        """
+        if self._blocks is None:
+            return self._add_blob(checksum, size, fileobj, self._media_type())
+
+        (actual_checksum, _, path) = self._spool_blob(
+            lambda stream: copy_fileobj(fileobj, stream, size)
+        )
+        assert actual_checksum == checksum, \
+            f"Expected layer with checksum {checksum}, got {actual_checksum}"
+        return path
+
+    def add_layer_stream(self, checksum, size, write_contents):
+        """
+        Adds an uncompressed layer tarball written by 'write_contents',
+        compressing it if needed. Unless 'spools_layers' is set, its
+        checksum and size need to be given, see 'TarWriter.addstream'.
+
+        Returns: Hex-encoded sha256sum, size and path in the image of the
+                 uncompressed layer as a tuple.
+        """
+        if self.spools_layers or checksum is None:
+            return self._spool_blob(write_contents)
+
+        tarinfo = tarfile.TarInfo(f"blobs/sha256/{checksum}")
+        tarinfo.size = size
+        tarinfo.mtime = self._mtime
+        self._tar.addstream(tarinfo, write_contents)
+        self._descriptors.append({
+            "mediaType": self._media_type(),
+            "digest": f"sha256:{checksum}",
+            "size": size,
+        })
+        return (checksum, size, tarinfo.name)
+
+    def _add_json(self, value):
+        content = json.dumps(value, indent=4).encode("utf-8")
+        checksum = hashlib.sha256(content).hexdigest()
+        add_bytes(self._tar, f"blobs/sha256/{checksum}", content, self._mtime)
+        return {"digest": f"sha256:{checksum}", "size": len(content)}
+
+    def add_metadata(self, layers, image_json, repo_tag):
+        """
+        Adds the image configuration, manifest and index describing the
+        image, see 'DockerLayout.add_metadata'.
+        """
+        config = self._add_json(image_json)
+        manifest = self._add_json({
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.oci.image.manifest.v1+json",
+            "config": {
+                "mediaType": "application/vnd.oci.image.config.v1+json",
+                **config,
+            },
+            "layers": self._descriptors,
+        })
+        index = {
+            "schemaVersion": 2,
+            "mediaType": "application/vnd.oci.image.index.v1+json",
+            "manifests": [
+                {
+                    "mediaType": "application/vnd.oci.image.manifest.v1+json",
+                    **manifest,
+                    "annotations": {
+                        "io.containerd.image.name": repo_tag,
+                        "org.opencontainers.image.ref.name":
+                            repo_tag.rpartition(":")[2],
+                    },
+                }
+            ],
+        }
+        add_bytes(
+            self._tar,
+            "oci-layout",
+            json.dumps({"imageLayoutVersion": "1.0.0"}).encode("utf-8"),
+            mtime=self._mtime,
+        )
+        add_bytes(
+            self._tar,
+            "index.json",
+            json.dumps(index, indent=4).encode("utf-8"),
+            mtime=self._mtime,
+        )
+
+    def close(self):
+        self._pool.shutdown()
+
+
+def add_layer_dir(layout, paths, store_dir, mtime, single_pass=False,
+                  cache=None, index=None):
+    """
+    Appends given store paths to an image layout as a new layer.
+
+    layout: 'DockerLayout' or 'OciLayout' object for the new layer to be
+            added to.
     paths: List of store paths.
     store_dir: the root directory of the nix store
     mtime: 'mtime' of the added files and the layer tarball.
            Should be an integer representing a POSIX time.
+    single_pass: Whether to archive the layer only once, spooling it to a
+                 temporary file, instead of archiving it twice. Layouts
+                 which spool layers anyway always do this.
+    cache: Optional 'LayerCache' object to spool the layer to and reuse
+           it from. Implies 'single_pass'.
+    index: Optional 'LayerDigestIndex' object to record the layer in.
+           Unless spooling, a layer already in the index is only
+           archived once.
 
     Returns: A 'LayerInfo' object containing some metadata of
              the layer added.
     """
 
-    invalid_paths = [i for i in paths if not i.startswith(store_dir)]
-    assert len(invalid_paths) == 0, \
-        f"Expecting absolute paths from {store_dir}, but got: {invalid_paths}"
+    check_store_paths(paths, store_dir)
+    key = layer_key(paths, mtime)
+
+    if cache is not None or (single_pass and not layout.spools_layers):
+        (checksum, size, spool) = spool_layer(paths, mtime, cache)
+        if index is not None:
+            index.insert(key, checksum, size)
+        with spool:
+            path = layout.add_layer(checksum, size, spool)
+        return LayerInfo(
+            size=size,
+            checksum=checksum,
+            path=path,
+            paths=paths,
+        )
 
-    # First, calculate the tarball checksum and the size.
-    extract_checksum = ExtractChecksum()
-    archive_paths_to(
-        extract_checksum,
-        paths,
-        mtime=mtime,
-    )
-    (checksum, size) = extract_checksum.extract()
-
-    path = f"{checksum}/layer.tar"
-    layer_tarinfo = tarfile.TarInfo(path)
-    layer_tarinfo.size = size
-    layer_tarinfo.mtime = mtime
+    # First, calculate the tarball checksum and the size, unless we
+    # already know them, or the layout calculates them while spooling.
+    if layout.spools_layers:
+        (checksum, size) = (None, None)
+    else:
+        (checksum, size) = layer_digest(paths, mtime, index=index)
 
     # Then actually stream the contents to the outer tarball.
-    read_fd, write_fd = os.pipe()
-    with open(read_fd, "rb") as read, open(write_fd, "wb") as write:
-        def producer():
-            archive_paths_to(
-                write,
-                paths,
-                mtime=mtime,
-            )
-            write.close()
-
-        # Closing the write end of the fifo also closes the read end,
-        # so we don't need to wait until this thread is finished.
-        #
-        # Any exception from the thread will get printed by the default
-        # exception handler, and the 'addfile' call will fail since it
-        # won't be able to read required amount of bytes.
-        threading.Thread(target=producer).start()
-        tar.addfile(layer_tarinfo, read)
+    (checksum, size, path) = layout.add_layer_stream(
+        checksum,
+        size,
+        lambda stream: archive_paths_to(stream, paths, mtime=mtime),
+    )
+    if index is not None:
+        index.insert(key, checksum, size)
 
     return LayerInfo(size=size, checksum=checksum, path=path, paths=paths)
 
 
-def add_customisation_layer(target_tar, customisation_layer, mtime):
+def layer_dir_info(paths, store_dir, mtime, cache=None, index=None):
+    """
+    Returns: A 'LayerInfo' object for a layer with the given store paths,
+             like 'add_layer_dir', but without adding the layer anywhere.
+             See 'layer_digest' for the remaining arguments.
+    """
+    check_store_paths(paths, store_dir)
+    (checksum, size) = layer_digest(paths, mtime, cache, index)
+    return LayerInfo(
+        size=size,
+        checksum=checksum,
+        path=make_layer_tarinfo(checksum, size, mtime).name,
+        paths=paths,
+    )
+
+
+def add_layer_dirs_parallel(layout, store_layers, store_dir, mtime, jobs,
+                            start=1, cache=None, index=None):
+    """
+    Appends the given lists of store paths to an image layout as new
+    layers, archiving up to 'jobs' layers at the same time in worker
+    processes. Layers are still added in the given order; at most 'jobs'
+    layers are spooled ahead of the one currently being added, which
+    bounds the temporary disk space needed.
+
+    layout: 'DockerLayout' or 'OciLayout' object for the new layers to be
+            added to.
+    store_layers: List of layers, each being a list of store paths.
+    store_dir: the root directory of the nix store
+    mtime: 'mtime' of the added files and the layer tarballs.
+           Should be an integer representing a POSIX time.
+    jobs: Number of worker processes.
+    start: Number of the first layer, used for logging.
+    cache: Optional 'LayerCache' object to spool layers to and reuse
+           them from.
+    index: Optional 'LayerDigestIndex' object to record the layers in.
+
+    Returns: A generator of 'LayerInfo' objects, one for each layer
+             added.
+    """
+    for paths in store_layers:
+        check_store_paths(paths, store_dir)
+
+    todo = enumerate(store_layers, start=start)
+    pending = deque()
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        def submit(count):
+            for num, paths in itertools.islice(todo, count):
+                print("Creating layer", num, "from paths:", paths,
+                      file=sys.stderr)
+                future = pool.submit(spool_layer_to_path, paths, mtime, cache)
+                pending.append((paths, future))
+
+        try:
+            submit(jobs)
+            while pending:
+                (paths, future) = pending.popleft()
+                (checksum, size, path, temporary) = future.result()
+                submit(1)
+                if index is not None:
+                    index.insert(layer_key(paths, mtime), checksum, size)
+
+                try:
+                    with open(path, "rb") as spool:
+                        layer_path = layout.add_layer(checksum, size, spool)
+                finally:
+                    if temporary:
+                        os.unlink(path)
+
+                yield LayerInfo(
+                    size=size,
+                    checksum=checksum,
+                    path=layer_path,
+                    paths=paths,
+                )
+        finally:
+            # Don't leave spooled layers behind if we fail midway.
+            for (_, future) in pending:
+                if future.cancel() or future.exception() is not None:
+                    continue
+                (_, _, path, temporary) = future.result()
+                if temporary:
+                    os.unlink(path)
+
+
+def add_customisation_layer(layout, customisation_layer, mtime,
+                            metadata_only=False):
     """
     Adds the customisation layer as a new layer. This is layer is structured
     differently; given store path has the 'layer.tar' and corresponding
     sha256sum ready.
 
-    tar: 'tarfile.TarFile' object for the new layer to be added to.
+    layout: 'DockerLayout' or 'OciLayout' object for the new layer to be
+            added to.
     customisation_layer: Path containing the layer archive.
     mtime: 'mtime' of the added layer tarball.
+    metadata_only: Whether to only return the metadata of the layer,
+                   without adding it.
     """
 
     checksum_path = os.path.join(customisation_layer, "checksum")
@@ -282,12 +1301,12 @@ def add_customisation_layer(target_tar, customisation_layer, mtime):
     layer_path = os.path.join(customisation_layer, "layer.tar")
 
     path = f"{checksum}/layer.tar"
-    tarinfo = target_tar.gettarinfo(layer_path)
-    tarinfo.name = path
-    tarinfo.mtime = mtime
+    if not metadata_only:
+        tarinfo = path_tarinfo(layer_path, name=path)
+        tarinfo.mtime = mtime
 
-    with open(layer_path, "rb") as f:
-        target_tar.addfile(tarinfo, f)
+        with open(layer_path, "rb") as f:
+            path = layout.add_layer(checksum, tarinfo.size, f, tarinfo=tarinfo)
 
     return LayerInfo(
       size=None,
@@ -301,7 +1320,7 @@ def add_bytes(tar, path, content, mtime):
     """
     Adds a file to the tarball with given path and contents.
 
-    tar: 'tarfile.TarFile' object.
+    tar: 'TarWriter' object.
     path: Path of the file as a string.
     content: Contents of the file.
     mtime: 'mtime' of the file. Should be an integer representing a POSIX time.
@@ -314,8 +1333,70 @@ def add_bytes(tar, path, content, mtime):
     tar.addfile(ti, io.BytesIO(content))
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Streams a Docker image built from the store paths"
+                    " described by the given JSON file to stdout.",
+    )
+    parser.add_argument("conf", help="Path to the image configuration.")
+    parser.add_argument(
+        "--single-pass",
+        action="store_true",
+        help="Archive each layer only once, spooling it to a temporary"
+             " file instead of archiving it a second time.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Keep spooled layers in the given directory, and reuse them"
+             " when the image is streamed again. Implies --single-pass.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of layers to archive in parallel. Values above 1"
+             " imply --single-pass.",
+    )
+    parser.add_argument(
+        "--digest-index",
+        help="JSON file to record the checksums and sizes of layers in,"
+             " and to look them up from in later runs.",
+    )
+    parser.add_argument(
+        "--metadata-only",
+        action="store_true",
+        help="Only write the image JSON and manifest.json, without any"
+             " layers.",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["docker", "oci"],
+        default="docker",
+        help="Write a Docker image tarball, or an OCI image layout.",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=list(COMPRESSIONS),
+        default="none",
+        help="Compression of the layers of an OCI image layout.",
+    )
+    parser.add_argument(
+        "--compression-threads",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of threads to compress layers with.",
+    )
+    args = parser.parse_args()
+    if args.format != "oci" and args.compression != "none":
+        parser.error("--compression requires --format oci")
+    if args.format != "docker" and args.metadata_only:
+        parser.error("--metadata-only requires --format docker")
+    return args
+
+
 def main():
-    with open(sys.argv[1], "r") as f:
+    args = parse_args()
+    with open(args.conf, "r") as f:
         conf = json.load(f)
 
     created = (
@@ -327,25 +1408,83 @@ def main():
     store_dir = conf["store_dir"]
 
     from_image = load_from_image(conf["from_image"])
+    cache = None if args.cache_dir is None else LayerCache(args.cache_dir)
+    index = (
+      None
+      if args.digest_index is None
+      else LayerDigestIndex(args.digest_index)
+    )
+
+    with TarWriter(sys.stdout.buffer) as tar:
+        if args.format == "oci":
+            layout = OciLayout(
+                tar,
+                mtime,
+                args.compression,
+                args.compression_threads,
+            )
+        else:
+            layout = DockerLayout(tar, mtime)
 
-    with tarfile.open(mode="w|", fileobj=sys.stdout.buffer) as tar:
         layers = []
-        layers.extend(add_base_layers(tar, from_image))
+        layers.extend(add_base_layers(
+            layout,
+            from_image,
+            metadata_only=args.metadata_only,
+        ))
 
         start = len(layers) + 1
-        for num, store_layer in enumerate(conf["store_layers"], start=start):
-            print("Creating layer", num, "from paths:", store_layer,
-                  file=sys.stderr)
-            info = add_layer_dir(tar, store_layer, store_dir, mtime=mtime)
-            layers.append(info)
+        if args.metadata_only:
+            for num, store_layer in enumerate(conf["store_layers"],
+                                              start=start):
+                print("Calculating checksum of layer", num, "from paths:",
+                      store_layer, file=sys.stderr)
+                info = layer_dir_info(
+                    store_layer,
+                    store_dir,
+                    mtime=mtime,
+                    cache=cache,
+                    index=index,
+                )
+                layers.append(info)
+        elif args.jobs > 1:
+            layers.extend(add_layer_dirs_parallel(
+                layout,
+                conf["store_layers"],
+                store_dir,
+                mtime=mtime,
+                jobs=args.jobs,
+                start=start,
+                cache=cache,
+                index=index,
+            ))
+        else:
+            for num, store_layer in enumerate(conf["store_layers"],
+                                              start=start):
+                print("Creating layer", num, "from paths:", store_layer,
+                      file=sys.stderr)
+                info = add_layer_dir(
+                    layout,
+                    store_layer,
+                    store_dir,
+                    mtime=mtime,
+                    single_pass=args.single_pass,
+                    cache=cache,
+                    index=index,
+                )
+                layers.append(info)
+
+        if index is not None:
+            index.save()
 
         print("Creating layer", len(layers) + 1, "with customisation...",
               file=sys.stderr)
         layers.append(
           add_customisation_layer(
-            tar,
+            layout,
             conf["customisation_layer"],
-            mtime=mtime
+            mtime=mtime,
+            metadata_only=args.metadata_only,
           )
         )
 
@@ -369,20 +1508,8 @@ def main():
             ],
         }
 
-        image_json = json.dumps(image_json, indent=4).encode("utf-8")
-        image_json_checksum = hashlib.sha256(image_json).hexdigest()
-        image_json_path = f"{image_json_checksum}.json"
-        add_bytes(tar, image_json_path, image_json, mtime=mtime)
-
-        manifest_json = [
-            {
-                "Config": image_json_path,
-                "RepoTags": [conf["repo_tag"]],
-                "Layers": [layer.path for layer in layers],
-            }
-        ]
-        manifest_json = json.dumps(manifest_json, indent=4).encode("utf-8")
-        add_bytes(tar, "manifest.json", manifest_json, mtime=mtime)
+        layout.add_metadata(layers, image_json, conf["repo_tag"])
+        layout.close()
 
         print("Done.", file=sys.stderr)
 
@@ -110,10 +110,16 @@
 # layers are content-addressable and are not explicitly layered until
 # they are composed in to an Image.
 
+import io
+import re
 import sys
 import json
+import heapq
+import random
+import argparse
 import unittest
 
+from array import array
 from pprint import pprint
 from collections import defaultdict
 
@@ -130,15 +136,18 @@ def debug(msg, *args, **kwargs):
 
 # Find paths in the original dataset which are never referenced by
 # any other paths
+#
+# This is the set of paths for which any_refer_to is False, collected in
+# a single pass over the references instead of one pass per path.
 def find_roots(closures):
-    roots = [];
-
+    referenced = set()
     for closure in closures:
-        path = closure['path']
-        if not any_refer_to(path, closures):
-            roots.append(path)
+        for ref in closure['references']:
+            if ref != closure['path']:
+                referenced.add(ref)
 
-    return roots
+    return [closure['path'] for closure in closures
+            if closure['path'] not in referenced]
 
 class TestFindRoots(unittest.TestCase):
     def test_find_roots(self):
@@ -453,6 +462,410 @@ class TestGraphPopularityContest(unittest.TestCase):
             }
         )
 
+# Read the closures stored under `key` in a JSON document one at a time,
+# rather than json.load'ing the whole document. Only the closure being
+# read and the unread part of the current chunk of the file are held in
+# memory, which matters for the exportReferencesGraph of a large image.
+#
+# Values other than `key` at the top of the document are decoded and
+# dropped. A chunk which ends in the middle of a value is extended with
+# the next, at least as large, chunk of the file and the value decoded
+# again.
+json_whitespace = re.compile(r'[ \t\n\r]*')
+json_decoder = json.JSONDecoder()
+
+def iter_closures(f, key, chunk_size=1 << 20):
+    buf = ""
+    pos = 0
+
+    def fill():
+        nonlocal buf, pos
+        chunk = f.read(max(chunk_size, len(buf) - pos))
+        if not chunk:
+            return False
+        buf = buf[pos:] + chunk
+        pos = 0
+        return True
+
+    def peek():
+        nonlocal pos
+        while True:
+            pos = json_whitespace.match(buf, pos).end()
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                raise ValueError("unexpected end of JSON document")
+
+    def expect(char):
+        nonlocal pos
+        if peek() != char:
+            raise ValueError("expected {!r} at {!r}".format(char, buf[pos:pos + 20]))
+        pos += 1
+
+    def value():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                obj, end = json_decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if fill():
+                    continue
+                raise
+            # A number may continue in the next chunk.
+            if end == len(buf) and fill():
+                continue
+            pos = end
+            return obj
+
+    expect("{")
+    if peek() != "}":
+        while True:
+            name = value()
+            expect(":")
+            if name == key:
+                expect("[")
+                if peek() == "]":
+                    return
+                while True:
+                    yield value()
+                    if peek() != ",":
+                        expect("]")
+                        return
+                    pos += 1
+            value()
+            if peek() != ",":
+                break
+            pos += 1
+    expect("}")
+    raise KeyError(key)
+
+class TestIterClosures(unittest.TestCase):
+    document = json.dumps({
+        "before": { "graph": [ 1, 2, 3 ], "text": "]}\"," },
+        "number": 1234567,
+        "graph": [
+            {
+                "path": "/nix/store/foo",
+                "narSize": 123456,
+                "references": [ "/nix/store/foo", "/nix/store/bar" ]
+            },
+            {
+                "path": "/nix/store/bar",
+                "narSize": 7,
+                "references": [ ]
+            }
+        ],
+        "after": [ None, True, False ]
+    }, indent=1)
+
+    def test_matches_json_load(self):
+        for chunk_size in [ 1, 3, 64, 1 << 20 ]:
+            self.assertEqual(
+                list(iter_closures(io.StringIO(self.document), "graph", chunk_size)),
+                json.loads(self.document)["graph"]
+            )
+
+    def test_empty(self):
+        self.assertEqual(
+            list(iter_closures(io.StringIO('{"graph": [ ]}'), "graph")),
+            []
+        )
+
+    def test_missing_key(self):
+        with self.assertRaises(KeyError):
+            list(iter_closures(io.StringIO(self.document), "other", 5))
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            truncated = self.document[:self.document.index('"narSize": 7')]
+            list(iter_closures(io.StringIO(truncated), "graph", 5))
+
+# The references of every path, as numbers of the referenced paths.
+#
+# All of the references are kept in a single array('I'), with the
+# references of each path stored as a run within it, so that a large
+# closure doesn't cost a Python list and an int object per reference.
+class References:
+    def __init__(self):
+        self.start = array('I')
+        self.count = array('I')
+        self.refs = array('I')
+
+    def add_path(self):
+        self.start.append(0)
+        self.count.append(0)
+
+    def set_references(self, node, refs):
+        self.start[node] = len(self.refs)
+        self.count[node] = len(refs)
+        self.refs.extend(refs)
+
+    def __len__(self):
+        return len(self.start)
+
+    def __getitem__(self, node):
+        start = self.start[node]
+        return self.refs[start:start + self.count[node]]
+
+# Convert:
+#
+# [
+#    { path: /nix/store/foo, references: [ /nix/store/foo, /nix/store/bar, /nix/store/baz ] },
+#    { path: /nix/store/bar, references: [ /nix/store/bar, /nix/store/baz ] },
+#    { path: /nix/store/baz, references: [ /nix/store/baz, /nix/store/tux ] },
+#    { path: /nix/store/tux, references: [ /nix/store/tux ] }
+#  ]
+#
+# To:
+#    (
+#      [ /nix/store/foo, /nix/store/bar, /nix/store/baz, /nix/store/tux ],
+#      References of [ [ 1, 2 ], [ 2 ], [ 3 ], [ ] ]
+#    )
+#
+# That is, every path is numbered in order of first appearance, and the
+# references become lists of those numbers. Like make_lookup it drops
+# self-references, and it also drops duplicate references.
+#
+# The closures may be any iterable, such as iter_closures, and each
+# path string is stored once however often it is referenced. If `sizes`
+# is given, the narSize of each path is appended to it, or 0 for paths
+# which are only referenced.
+def make_adjacency(closures, sizes=None):
+    paths = []
+    index = {}
+    children = References()
+
+    def intern(path):
+        if path not in index:
+            index[path] = len(paths)
+            paths.append(path)
+            children.add_path()
+            if sizes is not None:
+                sizes.append(0)
+        return index[path]
+
+    for closure in closures:
+        node = intern(closure['path'])
+        if sizes is not None:
+            sizes[node] = closure.get('narSize', 0)
+        seen = set()
+        refs = []
+        for ref in closure['references']:
+            child = intern(ref)
+            if child != node and child not in seen:
+                seen.add(child)
+                refs.append(child)
+        children.set_references(node, refs)
+
+    return paths, children
+
+class TestMakeAdjacency(unittest.TestCase):
+    def test_returns_adjacency(self):
+        paths, children = make_adjacency([
+            {
+                "path": "/nix/store/foo",
+                "references": [
+                    "/nix/store/foo",
+                    "/nix/store/bar",
+                    "/nix/store/bar"
+                ]
+            },
+            {
+                "path": "/nix/store/bar",
+                "references": [
+                    "/nix/store/bar",
+                    "/nix/store/tux"
+                ]
+            },
+            {
+                "path": "/nix/store/hello",
+                "references": [
+                ]
+            }
+        ])
+        self.assertEqual(
+            paths,
+            [
+                "/nix/store/foo",
+                "/nix/store/bar",
+                "/nix/store/tux",
+                "/nix/store/hello"
+            ]
+        )
+        self.assertEqual(
+            [ list(refs) for refs in children ],
+            [ [ 1 ], [ 2 ], [ ], [ ] ]
+        )
+
+    def test_collects_sizes(self):
+        sizes = array('Q')
+        make_adjacency([
+            {
+                "path": "/nix/store/foo",
+                "narSize": 100,
+                "references": [
+                    "/nix/store/foo",
+                    "/nix/store/bar"
+                ]
+            },
+            {
+                "path": "/nix/store/bar",
+                "narSize": 20,
+                "references": [ ]
+            }
+        ], sizes)
+        self.assertEqual(list(sizes), [ 100, 20 ])
+
+# Order the nodes of an adjacency list so that every node comes after
+# all of the nodes referring to it, starting from the nodes nothing
+# refers to (the roots, as in find_roots).
+def topological_order(children):
+    indegree = [0] * len(children)
+    for refs in children:
+        for child in refs:
+            indegree[child] += 1
+
+    order = [node for node, degree in enumerate(indegree) if degree == 0]
+    for node in order:
+        for child in children[node]:
+            indegree[child] -= 1
+            if indegree[child] == 0:
+                order.append(child)
+
+    if len(order) != len(children):
+        raise ValueError("the reference graph contains a cycle")
+
+    return order
+
+class TestTopologicalOrder(unittest.TestCase):
+    def test_parents_first(self):
+        self.assertEqual(
+            topological_order([ [ 2, 1 ], [ 2 ], [ 3 ], [ ], [ 3 ] ]),
+            [ 0, 4, 1, 2, 3 ]
+        )
+    def test_cycle(self):
+        with self.assertRaises(ValueError):
+            topological_order([ [ 1 ], [ 0 ] ])
+
+# Compute the same popularity as graph_popularity_contest, without
+# building the duplicated tree.
+#
+# Unrolling the merging of counters described at the top of this file,
+# the popularity of a path works out to be
+#
+#     sum(paths_to(p) for p in [path] + ancestors(path))
+#
+# where paths_to(p) is the number of distinct paths from any root down
+# to p (1 for the roots themselves) and ancestors(path) is every path
+# which transitively refers to it.
+#
+# paths_to is counted in one pass over the topological order. The
+# ancestors of each path are kept as a bitset of positions in that
+# order, and the sum of paths_to over a bitset is taken one binary digit
+# of paths_to at a time, by counting the bits it has in common with the
+# set of positions whose paths_to has that digit set.
+def popularity_contest(paths, children):
+    order = topological_order(children)
+    position = [0] * len(order)
+    for i, node in enumerate(order):
+        position[node] = i
+
+    paths_to = [0] * len(order)
+    for node in order:
+        if paths_to[node] == 0:
+            paths_to[node] = 1
+        for child in children[node]:
+            paths_to[child] += paths_to[node]
+
+    planes = []
+    for node in order:
+        count = paths_to[node]
+        digit = 0
+        while count:
+            if count & 1:
+                while len(planes) <= digit:
+                    planes.append(bytearray((len(order) + 7) // 8))
+                byte, bit = divmod(position[node], 8)
+                planes[digit][byte] |= 1 << bit
+            count >>= 1
+            digit += 1
+    planes = [int.from_bytes(plane, "little") for plane in planes]
+
+    popularity = {}
+    ancestors = [0] * len(order)
+    for node in order:
+        reach = ancestors[node] | (1 << position[node])
+        ancestors[node] = 0
+        for child in children[node]:
+            ancestors[child] |= reach
+
+        popularity[paths[node]] = sum(
+            (reach & plane).bit_count() << digit
+            for digit, plane in enumerate(planes)
+        )
+
+    return popularity
+
+class TestPopularityContest(unittest.TestCase):
+    def contest_both_ways(self, closures):
+        subgraphs_cache.clear()
+        popularity_cache.clear()
+
+        lookup = make_lookup(closures)
+        full_graph = {}
+        for root in find_roots(closures):
+            full_graph[root] = make_graph_segment_from_root(root, lookup)
+        expected = dict(graph_popularity_contest(full_graph))
+
+        self.assertDictEqual(
+            popularity_contest(*make_adjacency(closures)),
+            expected
+        )
+
+    def test_counts_popularity(self):
+        self.assertDictEqual(
+            popularity_contest(
+                [
+                    "/nix/store/foo",
+                    "/nix/store/bar",
+                    "/nix/store/baz",
+                    "/nix/store/tux"
+                ],
+                [ [ 1, 2 ], [ 2 ], [ 3 ], [ ] ]
+            ),
+            {
+                   "/nix/store/foo": 1,
+                   "/nix/store/bar": 2,
+                   "/nix/store/baz": 4,
+                   "/nix/store/tux": 6,
+            }
+        )
+
+    def test_matches_graph_popularity_contest(self):
+        self.contest_both_ways([
+            { "path": "A", "references": [ "A", "B", "G" ] },
+            { "path": "B", "references": [ "B", "C", "E" ] },
+            { "path": "C", "references": [ "C", "D", "E" ] },
+            { "path": "D", "references": [ "D", "F" ] },
+            { "path": "E", "references": [ "E", "F" ] },
+            { "path": "F", "references": [ "F" ] },
+            { "path": "G", "references": [ "G" ] },
+        ])
+
+    def test_matches_graph_popularity_contest_random(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            size = rng.randint(1, 30)
+            names = [ "/nix/store/{}".format(i) for i in range(size) ]
+            rng.shuffle(names)
+            closures = []
+            for i, name in enumerate(names):
+                refs = [ ref for ref in names[i + 1:] if rng.random() < 0.3 ]
+                closures.append({ "path": name, "references": [ name ] + refs })
+            rng.shuffle(closures)
+            self.contest_both_ways(closures)
+
 # Emit a list of packages by popularity, most first:
 #
 # From:
@@ -509,13 +922,196 @@ def package_name(path):
     parts.append(start)
     return '-'.join(parts)
 
-def main():
-    filename = sys.argv[1]
-    key = sys.argv[2]
+# Split the paths in to at most `layers` layers, as the store_layers
+# of stream_layered_image.py, excluding the paths in `exclude`.
+#
+# Pulling an image only fetches the layers which changed since the last
+# pull, and a store path changes whenever it or anything it depends on
+# changes. If every path changes independently with probability
+# `change_rate` between two builds of an image, a layer is pulled again
+# with probability 1 - (1 - change_rate) ** n, where n is the number of
+# distinct paths in the closures of the paths in the layer.
+#
+# Starting from one layer per path, ordered by popularity, the pair of
+# neighbouring layers whose merge adds the fewest expected bytes pulled
+# (narSize times that probability) is merged until at most `layers`
+# remain. That keeps large, rarely changing paths like glibc in layers
+# of their own and bundles the frequently changing top of the closure,
+# which is where the popularity ordering alone puts them too. Without
+# narSize, every merge costs nothing and the result matches taking the
+# `layers` - 1 most popular paths and putting the rest in one layer.
+#
+# The closure of each layer is kept as a bitset over the paths, so the
+# cost of a merge is a bitwise or and a bit count.
+def layer_assignment(paths, children, sizes, layers, exclude=(), change_rate=0.05):
+    # Number the paths in reverse topological order, so that the bitset
+    # of a path only reaches as high as its own position.
+    closure = [0] * len(paths)
+    for position, node in enumerate(reversed(topological_order(children))):
+        reach = 1 << position
+        for child in children[node]:
+            reach |= closure[child]
+        closure[node] = reach
 
-    debug("Loading from {}", filename)
-    with open(filename) as f:
-        data = json.load(f)
+    index = {path: node for node, path in enumerate(paths)}
+    exclude = set(exclude)
+    ordered = [
+        index[path]
+        for path in order_by_popularity(popularity_contest(paths, children))
+        if path not in exclude
+    ]
+
+    unchanged = 1 - change_rate
+    def cost(size, reach):
+        return size * (1 - unchanged ** reach.bit_count())
+
+    groups = [ [ node ] for node in ordered ]
+    group_size = [ sizes[node] for node in ordered ]
+    group_reach = [ closure[node] for node in ordered ]
+    group_cost = [ cost(size, reach) for size, reach in zip(group_size, group_reach) ]
+    following = list(range(1, len(groups) + 1))
+    preceding = list(range(-1, len(groups) - 1))
+    # Bumped whenever a group or its following group changes, to
+    # invalidate the merges queued for it.
+    version = [0] * len(groups)
+
+    def merge_cost(g):
+        h = following[g]
+        return (cost(group_size[g] + group_size[h], group_reach[g] | group_reach[h])
+                - group_cost[g] - group_cost[h])
+
+    # On ties, merge towards the end of the popularity order first.
+    queue = [ (merge_cost(g), -g, 0) for g in range(len(groups) - 1) ]
+    heapq.heapify(queue)
+
+    remaining = len(groups)
+    while remaining > layers:
+        _, g, queued = heapq.heappop(queue)
+        g = -g
+        if queued != version[g]:
+            continue
+
+        h = following[g]
+        groups[g].extend(groups[h])
+        groups[h] = None
+        group_size[g] += group_size[h]
+        group_reach[g] |= group_reach[h]
+        group_reach[h] = 0
+        group_cost[g] = cost(group_size[g], group_reach[g])
+        version[h] = -1
+        remaining -= 1
+
+        following[g] = following[h]
+        if following[g] < len(groups):
+            preceding[following[g]] = g
+            version[g] += 1
+            heapq.heappush(queue, (merge_cost(g), -g, version[g]))
+        if preceding[g] >= 0:
+            p = preceding[g]
+            version[p] += 1
+            heapq.heappush(queue, (merge_cost(p), -p, version[p]))
+
+    return [ [ paths[node] for node in group ] for group in groups if group is not None ]
+
+class TestLayerAssignment(unittest.TestCase):
+    def assign(self, closures, layers, **kwargs):
+        sizes = array('Q')
+        paths, children = make_adjacency(closures, sizes)
+        return layer_assignment(paths, children, sizes, layers, **kwargs)
+
+    closures = [
+        { "path": "/nix/store/a-app1", "narSize": 1, "references": [ "/nix/store/a-app1", "/nix/store/b-lib" ] },
+        { "path": "/nix/store/b-app2", "narSize": 1, "references": [ "/nix/store/b-lib" ] },
+        { "path": "/nix/store/b-lib", "narSize": 10, "references": [ "/nix/store/c-libc" ] },
+        { "path": "/nix/store/c-libc", "narSize": 1000, "references": [ "/nix/store/c-libc" ] },
+    ]
+
+    def test_one_layer_per_path(self):
+        self.assertEqual(
+            self.assign(self.closures, 4),
+            [
+                [ "/nix/store/c-libc" ],
+                [ "/nix/store/b-lib" ],
+                [ "/nix/store/a-app1" ],
+                [ "/nix/store/b-app2" ]
+            ]
+        )
+
+    def test_keeps_large_stable_paths_apart(self):
+        self.assertEqual(
+            self.assign(self.closures, 2),
+            [
+                [ "/nix/store/c-libc" ],
+                [ "/nix/store/b-lib", "/nix/store/a-app1", "/nix/store/b-app2" ]
+            ]
+        )
+
+    def test_without_sizes(self):
+        closures = [ { "path": closure["path"], "references": closure["references"] }
+                     for closure in self.closures ]
+        self.assertEqual(
+            self.assign(closures, 3),
+            [
+                [ "/nix/store/c-libc" ],
+                [ "/nix/store/b-lib" ],
+                [ "/nix/store/a-app1", "/nix/store/b-app2" ]
+            ]
+        )
+
+    def test_exclude(self):
+        self.assertEqual(
+            self.assign(self.closures, 1, exclude=[ "/nix/store/a-app1" ]),
+            [
+                [ "/nix/store/c-libc", "/nix/store/b-lib", "/nix/store/b-app2" ]
+            ]
+        )
+
+    def test_covers_every_path_once(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            size = rng.randint(1, 30)
+            names = [ "/nix/store/{}".format(i) for i in range(size) ]
+            closures = []
+            for i, name in enumerate(names):
+                refs = [ ref for ref in names[i + 1:] if rng.random() < 0.3 ]
+                closures.append({
+                    "path": name,
+                    "narSize": rng.randint(0, 1000),
+                    "references": [ name ] + refs
+                })
+            layers = rng.randint(1, 10)
+            assigned = self.assign(closures, layers)
+            self.assertEqual(len(assigned), min(layers, size))
+            self.assertCountEqual(sum(assigned, []), names)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Order the paths of a references graph by popularity."
+    )
+    parser.add_argument("filename", help="structured attrs JSON file")
+    parser.add_argument("key", help="exportReferencesGraph key to read")
+    parser.add_argument(
+        "--layers",
+        type=int,
+        help="instead print a JSON list of at most this many layers of paths",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        help="path to leave out of the layers, may be repeated",
+    )
+    parser.add_argument(
+        "--change-rate",
+        type=float,
+        default=0.05,
+        help="assumed probability of any single path changing between builds",
+    )
+    args = parser.parse_args()
+    if args.layers is not None and args.layers < 1:
+        parser.error("--layers must be at least 1")
+    filename = args.filename
+    key = args.key
 
     # Data comes in as:
     # [
@@ -535,26 +1131,28 @@ def main():
     #   /nix/store/bar,
     #   /nix/store/foo,
     # ]
-    graph = data[key]
-
-    debug("Finding roots from {}", key)
-    roots = find_roots(graph);
-    debug("Making lookup for {}", key)
-    lookup = make_lookup(graph)
+    debug("Loading {} from {}", key, filename)
+    sizes = array('Q')
+    with open(filename) as f:
+        paths, children = make_adjacency(iter_closures(f, key), sizes)
 
-    full_graph = {}
-    for root in roots:
-        debug("Making full graph for {}", root)
-        full_graph[root] = make_graph_segment_from_root(root, lookup)
+    if args.layers is not None:
+        debug("Assigning layers")
+        print(json.dumps(layer_assignment(
+            paths, children, sizes, args.layers,
+            exclude=args.exclude, change_rate=args.change_rate
+        )))
+        return
 
     debug("Running contest")
-    contest = graph_popularity_contest(full_graph)
+    contest = popularity_contest(paths, children)
     debug("Ordering by popularity")
     ordered = order_by_popularity(contest)
     debug("Checking for missing paths")
+    seen = set(ordered)
     missing = []
-    for path in all_paths(graph):
-        if path not in ordered:
+    for path in paths:
+        if path not in seen:
             missing.append(path)
 
     ordered.extend(missing)
@@ -1,80 +1,161 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
+import json
+import mmap
 import os
 import pprint
+import struct
 import subprocess
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from fnmatch import fnmatch
 from collections import defaultdict
-from contextlib import contextmanager
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from itertools import chain
 from pathlib import Path, PurePath
-from typing import DefaultDict, Iterator, List, Optional, Set, Tuple
+from typing import DefaultDict, Dict, Iterator, List, Optional, Set, Tuple
 
-from elftools.common.exceptions import ELFError  # type: ignore
-from elftools.elf.dynamic import DynamicSection  # type: ignore
-from elftools.elf.elffile import ELFFile  # type: ignore
-from elftools.elf.enums import ENUM_E_TYPE, ENUM_EI_OSABI  # type: ignore
+from elftools.elf.enums import ENUM_E_MACHINE, ENUM_EI_OSABI  # type: ignore
 
 
-@contextmanager
-def open_elf(path: Path) -> Iterator[ELFFile]:
-    with path.open('rb') as stream:
-        yield ELFFile(stream)
+# The few parts of the ELF format needed here, see elf(5). They are read
+# straight from the program headers, which is all the dynamic loader
+# looks at too, rather than from the section headers.
+ELF_MAGIC = b'\x7fELF'
+ET_EXEC = 2
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+PN_XNUM = 0xffff
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
 
+E_MACHINE_NAMES = {value: name for name, value in ENUM_E_MACHINE.items() if isinstance(value, int)}
+EI_OSABI_NAMES = {value: name for name, value in ENUM_EI_OSABI.items() if isinstance(value, int)}
 
-def is_static_executable(elf: ELFFile) -> bool:
-    # Statically linked executables have an ELF type of EXEC but no INTERP.
-    return (elf.header["e_type"] == 'ET_EXEC'
-            and not elf.get_section_by_name(".interp"))
 
-
-def is_dynamic_executable(elf: ELFFile) -> bool:
-    # We do not require an ELF type of EXEC. This also catches
-    # position-independent executables, as they typically have an INTERP
-    # section but their ELF type is DYN.
-    return bool(elf.get_section_by_name(".interp"))
-
-
-def get_dependencies(elf: ELFFile) -> List[str]:
-    dependencies = []
-    # This convoluted code is here on purpose. For some reason, using
-    # elf.get_section_by_name(".dynamic") does not always return an
-    # instance of DynamicSection, but that is required to call iter_tags
-    for section in elf.iter_sections():
-        if isinstance(section, DynamicSection):
-            for tag in section.iter_tags('DT_NEEDED'):
-                dependencies.append(tag.needed)
-            break # There is only one dynamic section
-
-    return dependencies
-
-
-def get_rpath(elf: ELFFile) -> List[str]:
-    # This convoluted code is here on purpose. For some reason, using
-    # elf.get_section_by_name(".dynamic") does not always return an
-    # instance of DynamicSection, but that is required to call iter_tags
-    for section in elf.iter_sections():
-        if isinstance(section, DynamicSection):
-            for tag in section.iter_tags('DT_RUNPATH'):
-                return tag.runpath.split(':')
-
-            for tag in section.iter_tags('DT_RPATH'):
-                return tag.rpath.split(':')
-
-            break # There is only one dynamic section
-
-    return []
-
-
-def get_arch(elf: ELFFile) -> str:
-    return elf.get_machine_arch()
-
-
-def get_osabi(elf: ELFFile) -> str:
-    return elf.header["e_ident"]["EI_OSABI"]
+@dataclass
+class Elf:
+    e_type: int
+    arch: str                   # e.g. EM_X86_64
+    osabi: str                  # e.g. ELFOSABI_SYSV
+    num_segments: int
+    interpreter: Optional[str]  # PT_INTERP
+    dependencies: List[str]     # DT_NEEDED
+    soname: Optional[str]       # DT_SONAME
+    rpath: List[str]            # DT_RUNPATH, or else DT_RPATH
+
+    @property
+    def is_static_executable(self) -> bool:
+        # Statically linked executables have an ELF type of EXEC but no INTERP.
+        return self.e_type == ET_EXEC and self.interpreter is None
+
+    @property
+    def is_dynamic_executable(self) -> bool:
+        # We do not require an ELF type of EXEC. This also catches
+        # position-independent executables, as they typically have an INTERP
+        # segment but their ELF type is DYN.
+        return self.interpreter is not None
+
+
+def read_elf(path: Path) -> Optional[Elf]:
+    """
+    Reads the headers and the dynamic section of an ELF file, or returns
+    None if the file is not a well-formed ELF file.
+    """
+    with path.open('rb') as f:
+        if f.read(4) != ELF_MAGIC:
+            return None
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return parse_elf(data)
+        except (struct.error, ValueError, KeyError, IndexError):
+            return None
+
+
+def parse_elf(data: mmap.mmap) -> Elf:
+    ei_class, ei_data, ei_osabi = data[4], data[5], data[7]
+    endian = {1: '<', 2: '>'}[ei_data]
+    if ei_class == 1:
+        (e_type, e_machine, _, _, e_phoff, e_shoff, _, _, e_phentsize, e_phnum,
+         e_shentsize, _, _) = struct.unpack_from(endian + 'HHIIIIIHHHHHH', data, 16)
+    elif ei_class == 2:
+        (e_type, e_machine, _, _, e_phoff, e_shoff, _, _, e_phentsize, e_phnum,
+         e_shentsize, _, _) = struct.unpack_from(endian + 'HHIQQQIHHHHHH', data, 16)
+    else:
+        raise ValueError(f"unknown ELF class {ei_class}")
+
+    num_segments = e_phnum
+    if e_phnum == PN_XNUM:
+        # The real number is in sh_info of the first section header.
+        sh_info_offset = 28 if ei_class == 1 else 44
+        num_segments, = struct.unpack_from(endian + 'I', data, e_shoff + sh_info_offset)
+
+    # (p_type, p_offset, p_vaddr, p_filesz) of each program header
+    segments = []
+    for i in range(num_segments):
+        offset = e_phoff + i * e_phentsize
+        if ei_class == 1:
+            p_type, p_offset, p_vaddr, _, p_filesz = struct.unpack_from(endian + 'IIIII', data, offset)
+        else:
+            p_type, _, p_offset, p_vaddr, _, p_filesz = struct.unpack_from(endian + 'IIQQQQ', data, offset)
+        segments.append((p_type, p_offset, p_vaddr, p_filesz))
+
+    def string_at(offset: int) -> str:
+        end = data.find(b'\0', offset)
+        if end < 0:
+            raise ValueError("unterminated string")
+        return os.fsdecode(data[offset:end])
+
+    interpreter = None
+    dynamic: Dict[int, List[int]] = {DT_NEEDED: [], DT_SONAME: [], DT_RPATH: [], DT_RUNPATH: []}
+    strtab = None
+    for p_type, p_offset, _, p_filesz in segments:
+        if p_type in (PT_INTERP, PT_DYNAMIC) and p_offset + p_filesz > len(data):
+            raise ValueError("truncated ELF file")
+        if p_type == PT_INTERP:
+            # Separate debug info files keep the header, but not the contents.
+            if p_filesz > 0:
+                interpreter = os.fsdecode(data[p_offset:p_offset + p_filesz].split(b'\0')[0])
+        elif p_type == PT_DYNAMIC:
+            entry = endian + ('iI' if ei_class == 1 else 'qQ')
+            end = p_offset + p_filesz - p_filesz % struct.calcsize(entry)
+            for d_tag, d_val in struct.iter_unpack(entry, data[p_offset:end]):
+                if d_tag == DT_NULL:
+                    break
+                elif d_tag == DT_STRTAB:
+                    strtab = d_val
+                elif d_tag in dynamic:
+                    dynamic[d_tag].append(d_val)
+
+    def dynamic_strings(tag: int) -> List[str]:
+        if not dynamic[tag]:
+            return []
+        # DT_STRTAB is an address, find where it is loaded from.
+        for p_type, p_offset, p_vaddr, p_filesz in segments:
+            if p_type == PT_LOAD and p_vaddr <= strtab < p_vaddr + p_filesz:
+                return [string_at(strtab - p_vaddr + p_offset + offset) for offset in dynamic[tag]]
+        raise ValueError("string table is not loaded")
+
+    soname = dynamic_strings(DT_SONAME)
+    rpath = dynamic_strings(DT_RUNPATH) or dynamic_strings(DT_RPATH)
+
+    return Elf(
+        e_type=e_type,
+        arch=E_MACHINE_NAMES.get(e_machine, str(e_machine)),
+        osabi=EI_OSABI_NAMES.get(ei_osabi, str(ei_osabi)),
+        num_segments=num_segments,
+        interpreter=interpreter,
+        dependencies=dynamic_strings(DT_NEEDED),
+        soname=soname[0] if soname else None,
+        rpath=rpath[0].split(':') if rpath else [])
 
 
 def osabi_are_compatible(wanted: str, got: str) -> bool:
@@ -122,8 +203,143 @@ def glob(path: Path, pattern: str, recursive: bool) -> Iterator[Path]:
 cached_paths: Set[Path] = set()
 soname_cache: DefaultDict[Tuple[str, str], List[Tuple[Path, str]]] = defaultdict(list)
 
+# (soname, arch, directory, osabi) of a shared object, as added to soname_cache
+SonameEntry = Tuple[str, str, Path, str]
+
+
+def scan_lib_dir(lib_dir: Path, recursive: bool = False) -> Tuple[List[SonameEntry], List[Path], bool]:
+    """
+    Lists the shared objects of a library directory, and the directories
+    of their RPATHs. The last element tells whether everything listed
+    resolved to paths in the Nix store, and so will never change.
+    """
+    entries = []
+    rpaths = []
+    immutable = in_store(lib_dir.resolve())
+
+    for path in glob(lib_dir, "*.so*", recursive):
+        if not path.is_file():
+            continue
+
+        # As an optimisation, resolve the symlinks here, as the target is unique
+        # XXX: (layus, 2022-07-25) is this really an optimisation in all cases ?
+        # It could make the rpath bigger or break the fragile precedence of $out.
+        resolved = path.resolve()
+        immutable = immutable and in_store(resolved)
+        # Do not use resolved paths when names do not match
+        if resolved.name != path.name:
+            resolved = path
+
+        elf = read_elf(path)
+        if elf is None:
+            # Not an ELF file in the right format
+            continue
+
+        rpaths += [Path(p) for p in elf.rpath if p and '$ORIGIN' not in p]
+        entries.append((path.name, elf.arch, resolved.parent, elf.osabi))
 
-def populate_cache(initial: List[Path], recursive: bool =False) -> None:
+    return entries, rpaths, immutable
+
+
+def in_store(resolved: Path) -> bool:
+    return resolved.is_relative_to(store_dir)
+
+
+class SonameIndex:
+    """
+    An on-disk cache of scan_lib_dir for library directories in the Nix
+    store. Their contents never change, so they only need to be scanned
+    once across all runs sharing the index directory. Each directory is
+    stored in its own file, named after the hash of its store path.
+
+    A store path can still be deleted and built again with different
+    contents. So each entry records the inode and ctime of the library
+    directory and of the directories its libraries resolve to, which
+    change when they are created anew, and is only used while they match.
+    """
+
+    version = 3
+
+    def __init__(self, directory: Path, exclude: List[Path] = []):
+        self.directory = directory
+        # Paths which are in the store but still being built, such as all
+        # the outputs of the current derivation
+        self.exclude = [path.resolve() for path in exclude]
+
+    def _excluded(self, path: Path) -> bool:
+        resolved = path.resolve()
+        return any(path.is_relative_to(excluded) or resolved.is_relative_to(excluded)
+                   for excluded in self.exclude)
+
+    def _entry_file(self, lib_dir: Path) -> Optional[Path]:
+        if not lib_dir.is_absolute() or not lib_dir.exists():
+            return None
+        resolved = lib_dir.resolve()
+        if not in_store(resolved) or not lib_dir.is_relative_to(store_dir):
+            return None
+        if self._excluded(lib_dir):
+            return None
+        store_path = lib_dir.relative_to(store_dir).parts[0]
+        store_hash = store_path.split('-')[0]
+        key = hashlib.sha256(lib_dir.as_posix().encode()).hexdigest()[:32]
+        return self.directory / f"{store_hash}-{key}.json"
+
+    @staticmethod
+    def _stamps(directories: List[Path]) -> Optional[List[List]]:
+        stamps = []
+        for directory in directories:
+            try:
+                stat = directory.stat()
+            except OSError:
+                return None
+            stamps.append([directory.as_posix(), stat.st_ino, stat.st_ctime_ns])
+        return stamps
+
+    def lookup(self, lib_dir: Path) -> Optional[Tuple[List[SonameEntry], List[Path]]]:
+        entry_file = self._entry_file(lib_dir)
+        if entry_file is None:
+            return None
+        try:
+            with entry_file.open() as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("version") != self.version or entry.get("dir") != lib_dir.as_posix():
+            return None
+        recorded = entry["stamps"]
+        if self._stamps([Path(path) for path, _, _ in recorded]) != recorded:
+            return None
+        entries = [(name, arch, Path(parent), osabi)
+                   for name, arch, parent, osabi in entry["entries"]]
+        return entries, [Path(rpath) for rpath in entry["rpaths"]]
+
+    def insert(self, lib_dir: Path, entries: List[SonameEntry], rpaths: List[Path]) -> None:
+        entry_file = self._entry_file(lib_dir)
+        if entry_file is None:
+            return
+        # Libraries may be symlinks into a path which is still being built
+        if any(self._excluded(parent) for _, _, parent, _ in entries):
+            return
+        parents = dict.fromkeys(parent for _, _, parent, _ in entries)
+        stamps = self._stamps([lib_dir, *(p for p in parents if p != lib_dir)])
+        if stamps is None:
+            return
+        entry = {
+            "version": self.version,
+            "dir": lib_dir.as_posix(),
+            "stamps": stamps,
+            "entries": [[name, arch, parent.as_posix(), osabi]
+                        for name, arch, parent, osabi in entries],
+            "rpaths": [rpath.as_posix() for rpath in rpaths],
+        }
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f, separators=(",", ":"))
+        os.replace(tmp, entry_file)
+
+
+def populate_cache(initial: List[Path], recursive: bool =False, index: Optional[SonameIndex] = None) -> None:
     lib_dirs = list(initial)
 
     while lib_dirs:
@@ -134,30 +350,17 @@ def populate_cache(initial: List[Path], recursive: bool =False) -> None:
 
         cached_paths.add(lib_dir)
 
-        for path in glob(lib_dir, "*.so*", recursive):
-            if not path.is_file():
-                continue
-
-            # As an optimisation, resolve the symlinks here, as the target is unique
-            # XXX: (layus, 2022-07-25) is this really an optimisation in all cases ?
-            # It could make the rpath bigger or break the fragile precedence of $out.
-            resolved = path.resolve()
-            # Do not use resolved paths when names do not match
-            if resolved.name != path.name:
-                resolved = path
-
-            try:
-                with open_elf(path) as elf:
-                    osabi = get_osabi(elf)
-                    arch = get_arch(elf)
-                    rpath = [Path(p) for p in get_rpath(elf)
-                                     if p and '$ORIGIN' not in p]
-                    lib_dirs += rpath
-                    soname_cache[(path.name, arch)].append((resolved.parent, osabi))
+        cached = index.lookup(lib_dir) if index is not None else None
+        if cached is not None:
+            entries, rpaths = cached
+        else:
+            entries, rpaths, immutable = scan_lib_dir(lib_dir, recursive)
+            if index is not None and immutable:
+                index.insert(lib_dir, entries, rpaths)
 
-            except ELFError:
-                # Not an ELF file in the right format
-                pass
+        for name, arch, parent, osabi in entries:
+            soname_cache[(name, arch)].append((parent, osabi))
+        lib_dirs += rpaths
 
 
 def find_dependency(soname: str, soarch: str, soabi: str) -> Optional[Path]:
@@ -172,49 +375,55 @@ class Dependency:
     file: Path              # The file that contains the dependency
     name: Path              # The name of the dependency
     found: bool = False     # Whether it was found somewhere
+    directory: Optional[Path] = None  # Where it was found
 
 
-def auto_patchelf_file(path: Path, runtime_deps: list[Path], append_rpaths: List[Path] = [], extra_args: List[str] = []) -> list[Dependency]:
-    try:
-        with open_elf(path) as elf:
-
-            if is_static_executable(elf):
-                # No point patching these
-                print(f"skipping {path} because it is statically linked")
-                return []
-
-            if elf.num_segments() == 0:
-                # no segment (e.g. object file)
-                print(f"skipping {path} because it contains no segment")
-                return []
-
-            file_arch = get_arch(elf)
-            if interpreter_arch != file_arch:
-                # Our target architecture is different than this file's
-                # architecture, so skip it.
-                print(f"skipping {path} because its architecture ({file_arch})"
-                      f" differs from target ({interpreter_arch})")
-                return []
-
-            file_osabi = get_osabi(elf)
-            if not osabi_are_compatible(interpreter_osabi, file_osabi):
-                print(f"skipping {path} because its OS ABI ({file_osabi}) is"
-                      f" not compatible with target ({interpreter_osabi})")
-                return []
-
-            file_is_dynamic_executable = is_dynamic_executable(elf)
-
-            file_dependencies = map(Path, get_dependencies(elf))
-
-    except ELFError:
-        return []
-
+@dataclass
+class Patch:
+    file: Path                          # The file to patch
+    interpreter: Optional[Path] = None  # The interpreter to set, if any
+    rpath: Optional[str] = None         # The RPATH to set, if any
+
+    def patchelf_args(self) -> List[str]:
+        args = []
+        if self.interpreter is not None:
+            args += ["--set-interpreter", self.interpreter.as_posix()]
+        if self.rpath is not None:
+            args += ["--set-rpath", self.rpath]
+        return args
+
+
+def auto_patchelf_file(path: Path, elf: Optional[Elf], runtime_deps: list[Path], append_rpaths: List[Path] = []) -> Tuple[list[Dependency], Optional[Patch]]:
+    if elf is None:
+        return [], None
+
+    if elf.is_static_executable:
+        # No point patching these
+        print(f"skipping {path} because it is statically linked")
+        return [], None
+
+    if elf.num_segments == 0:
+        # no segment (e.g. object file)
+        print(f"skipping {path} because it contains no segment")
+        return [], None
+
+    if interpreter_arch != elf.arch:
+        # Our target architecture is different than this file's
+        # architecture, so skip it.
+        print(f"skipping {path} because its architecture ({elf.arch})"
+              f" differs from target ({interpreter_arch})")
+        return [], None
+
+    if not osabi_are_compatible(interpreter_osabi, elf.osabi):
+        print(f"skipping {path} because its OS ABI ({elf.osabi}) is"
+              f" not compatible with target ({interpreter_osabi})")
+        return [], None
+
+    patch = Patch(path)
     rpath = []
-    if file_is_dynamic_executable:
+    if elf.is_dynamic_executable:
         print("setting interpreter of", path)
-        subprocess.run(
-                ["patchelf", "--set-interpreter", interpreter_path.as_posix(), path.as_posix()] + extra_args,
-                check=True)
+        patch.interpreter = interpreter_path
         rpath += runtime_deps
 
     print("searching for dependencies of", path)
@@ -222,7 +431,7 @@ def auto_patchelf_file(path: Path, runtime_deps: list[Path], append_rpaths: List
     # Be sure to get the output of all missing dependencies instead of
     # failing at the first one, because it's more useful when working
     # on a new package where you don't yet know the dependencies.
-    for dep in file_dependencies:
+    for dep in map(Path, elf.dependencies):
         if dep.is_absolute() and dep.is_file():
             # This is an absolute path. If it exists, just use it.
             # Otherwise, we probably want this to produce an error when
@@ -234,9 +443,9 @@ def auto_patchelf_file(path: Path, runtime_deps: list[Path], append_rpaths: List
             # resolved by the linker.
             continue
 
-        if found_dependency := find_dependency(dep.name, file_arch, file_osabi):
+        if found_dependency := find_dependency(dep.name, elf.arch, elf.osabi):
             rpath.append(found_dependency)
-            dependencies.append(Dependency(path, dep, True))
+            dependencies.append(Dependency(path, dep, True, found_dependency))
             print(f"    {dep} -> found: {found_dependency}")
         else:
             dependencies.append(Dependency(path, dep, False))
@@ -249,35 +458,107 @@ def auto_patchelf_file(path: Path, runtime_deps: list[Path], append_rpaths: List
 
     if rpath:
         print("setting RPATH to:", rpath_str)
+        patch.rpath = rpath_str
+
+    return dependencies, patch
+
+
+def patchelf(patches: List[Patch], extra_args: List[str] = []) -> None:
+    # One patchelf invocation sets both the interpreter and the RPATH.
+    for patch in patches:
         subprocess.run(
-                ["patchelf", "--set-rpath", rpath_str, path.as_posix()] + extra_args,
+                ["patchelf"] + patch.patchelf_args() + [patch.file.as_posix()] + extra_args,
                 check=True)
 
-    return dependencies
 
+def apply_patches(patches: List[Patch], extra_args: List[str] = [], jobs: int = 1) -> None:
+    # Files are patched concurrently, except for hard links to the same
+    # file, which are patched one after the other to not lose updates.
+    by_inode: DefaultDict[Tuple[int, int], List[Patch]] = defaultdict(list)
+    for patch in patches:
+        stat = patch.file.stat()
+        by_inode[(stat.st_dev, stat.st_ino)].append(patch)
 
-def auto_patchelf(
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for _ in executor.map(lambda group: patchelf(group, extra_args), by_inode.values()):
+            pass
+
+
+# Files are recognised as unchanged since a previous plan by their inode,
+# size, modification time and status change time. Unlike the mtime, the
+# ctime can't be set back, so a file rewritten in place with the same size
+# and mtime still gets a new fingerprint.
+Fingerprint = Tuple[int, int, int, int]
+
+
+def fingerprint(path: Path) -> Fingerprint:
+    stat = path.stat()
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns
+
+
+def scan_files(paths: List[Path], jobs: int = 1) -> List[Optional[Elf]]:
+    if jobs <= 1 or len(paths) <= 1:
+        return list(map(read_elf, paths))
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(read_elf, paths, chunksize=64))
+
+
+@dataclass
+class PlannedFile:
+    file: Path
+    fingerprint: Fingerprint
+    elf: Optional[Elf]
+    patch: Optional[Patch]
+    dependencies: List[Dependency]
+
+
+def plan(
         paths_to_patch: List[Path],
         lib_dirs: List[Path],
         runtime_deps: List[Path],
         recursive: bool = True,
-        ignore_missing: List[str] = [],
         append_rpaths: List[Path] = [],
-        extra_args: List[str] = []) -> None:
-
-    if not paths_to_patch:
-        sys.exit("No paths to patch, stopping.")
-
+        jobs: int = 1,
+        index_cache: Optional[Path] = None,
+        exclude_from_index: List[Path] = [],
+        previous: List[PlannedFile] = []) -> List[PlannedFile]:
+    """
+    Decides how to patch every file, without patching anything. The ELF
+    headers of files which are unchanged since the `previous` plan are
+    not read again.
+    """
     # Add all shared objects of the current output path to the cache,
     # before lib_dirs, so that they are chosen first in find_dependency.
     populate_cache(paths_to_patch, recursive)
-    populate_cache(lib_dirs)
-
-    dependencies = []
-    for path in chain.from_iterable(glob(p, '*', recursive) for p in paths_to_patch):
-        if not path.is_symlink() and path.is_file():
-            dependencies += auto_patchelf_file(path, runtime_deps, append_rpaths, extra_args)
-
+    index = (SonameIndex(index_cache, exclude=paths_to_patch + exclude_from_index)
+             if index_cache else None)
+    populate_cache(lib_dirs, index=index)
+
+    files = [path for path in chain.from_iterable(glob(p, '*', recursive) for p in paths_to_patch)
+             if not path.is_symlink() and path.is_file()]
+    fingerprints = [fingerprint(path) for path in files]
+
+    # Parsing the ELF files is the expensive part, so it is done for all
+    # files at once in parallel. Resolving the dependencies needs the
+    # soname cache, and is done in order to keep the output readable.
+    known = {(planned.file, planned.fingerprint): planned.elf for planned in previous}
+    changed = [(path, fp) for path, fp in zip(files, fingerprints) if (path, fp) not in known]
+    scanned = scan_files([path for path, _ in changed], jobs)
+    known.update(zip(changed, scanned))
+
+    planned_files = []
+    for path, fp in zip(files, fingerprints):
+        elf = known[(path, fp)]
+        dependencies, patch = auto_patchelf_file(path, elf, runtime_deps, append_rpaths)
+        if patch is not None and patch.interpreter is None and patch.rpath is None:
+            patch = None
+        planned_files.append(PlannedFile(path, fp, elf, patch, dependencies))
+
+    return planned_files
+
+
+def check_missing(dependencies: List[Dependency], ignore_missing: List[str] = []) -> None:
     missing = [dep for dep in dependencies if not dep.found]
 
     # Print a summary of the missing dependencies at the end
@@ -298,6 +579,112 @@ def auto_patchelf(
                  '`--ignore-missing="foo.so.1 bar.so etc.so"`.')
 
 
+# Plans are stored as JSON, with paths as strings.
+PLAN_VERSION = 2
+
+
+def write_plan(path: Path, planned_files: List[PlannedFile]) -> None:
+    def optional_path(value: Optional[Path]) -> Optional[str]:
+        return value.as_posix() if value is not None else None
+
+    files = []
+    for planned in planned_files:
+        files.append({
+            "file": planned.file.as_posix(),
+            "fingerprint": list(planned.fingerprint),
+            "elf": asdict(planned.elf) if planned.elf is not None else None,
+            "interpreter": optional_path(planned.patch.interpreter) if planned.patch else None,
+            "rpath": planned.patch.rpath if planned.patch else None,
+            "dependencies": [
+                {"name": dep.name.as_posix(), "found": optional_path(dep.directory)}
+                for dep in planned.dependencies
+            ],
+        })
+
+    missing = [{"file": dep.file.as_posix(), "name": dep.name.as_posix()}
+               for planned in planned_files
+               for dep in planned.dependencies if not dep.found]
+
+    with path.open("w") as f:
+        json.dump({"version": PLAN_VERSION, "files": files, "missing": missing}, f, indent=2)
+        f.write("\n")
+
+
+def read_plan(path: Path) -> List[PlannedFile]:
+    with path.open() as f:
+        data = json.load(f)
+    if data.get("version") != PLAN_VERSION:
+        sys.exit(f"{path} is not a plan of this version of auto-patchelf")
+
+    planned_files = []
+    for entry in data["files"]:
+        file = Path(entry["file"])
+        patch = None
+        if entry["interpreter"] is not None or entry["rpath"] is not None:
+            interpreter = Path(entry["interpreter"]) if entry["interpreter"] is not None else None
+            patch = Patch(file, interpreter, entry["rpath"])
+        dependencies = [
+            Dependency(file, Path(dep["name"]), dep["found"] is not None,
+                       Path(dep["found"]) if dep["found"] is not None else None)
+            for dep in entry["dependencies"]
+        ]
+        planned_files.append(PlannedFile(
+            file,
+            (entry["fingerprint"][0], entry["fingerprint"][1],
+             entry["fingerprint"][2], entry["fingerprint"][3]),
+            Elf(**entry["elf"]) if entry["elf"] is not None else None,
+            patch,
+            dependencies))
+
+    return planned_files
+
+
+def apply_plan(
+        planned_files: List[PlannedFile],
+        ignore_missing: List[str] = [],
+        extra_args: List[str] = [],
+        jobs: int = 1) -> None:
+    # The patches were decided from the files as they were when planning.
+    # Check that none changed since, before patching any of them.
+    changed = []
+    for planned in planned_files:
+        try:
+            if fingerprint(planned.file) != planned.fingerprint:
+                changed.append(planned.file)
+        except FileNotFoundError:
+            changed.append(planned.file)
+    if changed:
+        for path in changed:
+            print(f"error: auto-patchelf: {path} changed since it was planned")
+        sys.exit('auto-patchelf failed because files changed since the plan was made.\n'
+                 'Run it again with --plan before using --apply.')
+
+    patches = [planned.patch for planned in planned_files if planned.patch is not None]
+    apply_patches(patches, extra_args, jobs)
+    check_missing([dep for planned in planned_files for dep in planned.dependencies],
+                  ignore_missing)
+
+
+def auto_patchelf(
+        paths_to_patch: List[Path],
+        lib_dirs: List[Path],
+        runtime_deps: List[Path],
+        recursive: bool = True,
+        ignore_missing: List[str] = [],
+        append_rpaths: List[Path] = [],
+        extra_args: List[str] = [],
+        jobs: int = 1,
+        index_cache: Optional[Path] = None,
+        exclude_from_index: List[Path] = []) -> None:
+
+    if not paths_to_patch:
+        sys.exit("No paths to patch, stopping.")
+
+    planned_files = plan(paths_to_patch, lib_dirs, runtime_deps, recursive,
+                         append_rpaths, jobs, index_cache, exclude_from_index)
+    apply_plan(planned_files, ignore_missing, extra_args, jobs)
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(
         prog="auto-patchelf",
@@ -334,6 +721,43 @@ def main() -> None:
         type=Path,
         help="Paths to append to all runtime paths unconditionally",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of files to scan and patch in parallel.",
+    )
+    parser.add_argument(
+        "--index-cache",
+        type=Path,
+        help="Directory in which to keep an index of the libraries found in"
+             " the Nix store, so that later runs don't need to read them again."
+             " No index is kept if this is not given.",
+    )
+    parser.add_argument(
+        "--exclude-from-index",
+        nargs="*",
+        type=Path,
+        default=[],
+        help="Paths in the Nix store which are still being built, such as the"
+             " outputs of the current derivation. Libraries in them are never"
+             " kept in the index. The paths to patch are always excluded.",
+    )
+    parser.add_argument(
+        "--plan",
+        type=Path,
+        metavar="PLAN",
+        help="Only decide how to patch the files, and write that to PLAN as"
+             " JSON, along with the dependencies which were not found. If PLAN"
+             " exists, files which are unchanged since are not read again.",
+    )
+    parser.add_argument(
+        "--apply",
+        type=Path,
+        metavar="PLAN",
+        help="Patch the files as decided in PLAN, which was written by --plan."
+             " Fails without patching anything if a file changed since.",
+    )
     parser.add_argument(
         "--extra-args",
         # Undocumented Python argparse feature: consume all remaining arguments
@@ -348,6 +772,35 @@ def main() -> None:
     args = parser.parse_args()
     pprint.pprint(vars(args))
 
+    if args.plan is not None and args.apply is not None:
+        parser.error("--plan and --apply can't be used together")
+
+    if args.apply is not None:
+        apply_plan(
+            read_plan(args.apply),
+            args.ignore_missing,
+            extra_args=args.extra_args,
+            jobs=args.jobs)
+        return
+
+    if args.plan is not None:
+        if not args.paths:
+            sys.exit("No paths to patch, stopping.")
+        planned_files = plan(
+            args.paths,
+            args.libs,
+            args.runtime_dependencies,
+            args.recursive,
+            append_rpaths=args.append_rpaths,
+            jobs=args.jobs,
+            index_cache=args.index_cache,
+            exclude_from_index=args.exclude_from_index,
+            previous=read_plan(args.plan) if args.plan.exists() else [])
+        write_plan(args.plan, planned_files)
+        missing = sum(not dep.found for planned in planned_files for dep in planned.dependencies)
+        print(f"auto-patchelf: wrote plan to {args.plan}, {missing} dependencies could not be satisfied")
+        return
+
     auto_patchelf(
         args.paths,
         args.libs,
@@ -355,22 +808,27 @@ def main() -> None:
         args.recursive,
         args.ignore_missing,
         append_rpaths=args.append_rpaths,
-        extra_args=args.extra_args)
+        extra_args=args.extra_args,
+        jobs=args.jobs,
+        index_cache=args.index_cache,
+        exclude_from_index=args.exclude_from_index)
 
 
 interpreter_path: Path  = None # type: ignore
 interpreter_osabi: str  = None # type: ignore
 interpreter_arch: str   = None # type: ignore
 libc_lib: Path          = None # type: ignore
+store_dir: Path         = Path(os.environ.get('NIX_STORE', '/nix/store'))
 
 if __name__ == "__main__":
     nix_support = Path(os.environ['NIX_BINTOOLS']) / 'nix-support'
     interpreter_path = Path((nix_support / 'dynamic-linker').read_text().strip())
     libc_lib = Path((nix_support / 'orig-libc').read_text().strip()) / 'lib'
 
-    with open_elf(interpreter_path) as interpreter:
-        interpreter_osabi = get_osabi(interpreter)
-        interpreter_arch = get_arch(interpreter)
+    interpreter = read_elf(interpreter_path)
+    if interpreter is not None:
+        interpreter_osabi = interpreter.osabi
+        interpreter_arch = interpreter.arch
 
     if interpreter_arch and interpreter_osabi and interpreter_path and libc_lib:
         main()
@@ -77,6 +77,14 @@ autoPatchelf() {
         fi
     done
 
+    # The outputs of this derivation are in the store, but still being
+    # built, so the libraries in them must not be kept in the index.
+    local -a outputPaths=()
+    local output
+    for output in $(getAllOutputNames); do
+        outputPaths+=("${!output}")
+    done
+
     @pythonInterpreter@ @autoPatchelfScript@                            \
         ${norecurse:+--no-recurse}                                      \
         --ignore-missing "${ignoreMissingDepsArray[@]}"                 \
@@ -85,6 +93,9 @@ autoPatchelf() {
                "${extraAutoPatchelfLibs[@]}"                            \
         --runtime-dependencies "${runtimeDependenciesArray[@]/%//lib}"  \
         --append-rpaths "${appendRunpathsArray[@]}"                     \
+        --jobs "${NIX_BUILD_CORES:-1}"                                  \
+        ${autoPatchelfIndexCache:+--index-cache "$autoPatchelfIndexCache"} \
+        --exclude-from-index "${outputPaths[@]}"                        \
         --extra-args "${patchelfFlagsArray[@]}"
 }
 
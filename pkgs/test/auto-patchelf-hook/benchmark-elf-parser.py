@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+# Compares the ELF reader of auto-patchelf.py with pyelftools, which it
+# replaces, on every file below the given directories: both must agree
+# on everything auto-patchelf looks at, and the time each takes is
+# printed.
+#
+# Usage: python3 benchmark-elf-parser.py /nix/store/...-some-package ...
+
+import importlib.util
+import sys
+import time
+from pathlib import Path
+
+from elftools.common.exceptions import ELFError  # type: ignore
+from elftools.elf.dynamic import DynamicSection  # type: ignore
+from elftools.elf.elffile import ELFFile  # type: ignore
+
+spec = importlib.util.spec_from_file_location(
+    "auto_patchelf",
+    Path(__file__).parent / "../../build-support/setup-hooks/auto-patchelf.py")
+assert spec is not None and spec.loader is not None
+auto_patchelf = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(auto_patchelf)
+
+
+def read_pyelftools(path):
+    # What auto-patchelf.py read with pyelftools before it had its own reader
+    try:
+        with path.open('rb') as stream:
+            elf = ELFFile(stream)
+            interp = bool(elf.get_section_by_name(".interp"))
+            dependencies = []
+            rpath = []
+            for section in elf.iter_sections():
+                if isinstance(section, DynamicSection):
+                    dependencies = [tag.needed for tag in section.iter_tags('DT_NEEDED')]
+                    runpath = [tag.runpath for tag in section.iter_tags('DT_RUNPATH')]
+                    old_rpath = [tag.rpath for tag in section.iter_tags('DT_RPATH')]
+                    if runpath or old_rpath:
+                        rpath = (runpath or old_rpath)[0].split(':')
+                    break
+            return (
+                elf.header["e_type"] == 'ET_EXEC' and not interp,
+                interp,
+                elf.num_segments(),
+                elf.header["e_machine"],
+                elf.header["e_ident"]["EI_OSABI"],
+                dependencies,
+                rpath,
+            )
+    except ELFError:
+        return None
+
+
+def read_raw(path):
+    elf = auto_patchelf.read_elf(path)
+    if elf is None:
+        return None
+    return (
+        elf.is_static_executable,
+        elf.is_dynamic_executable,
+        elf.num_segments,
+        elf.arch,
+        elf.osabi,
+        elf.dependencies,
+        elf.rpath,
+    )
+
+
+def main():
+    files = [path for directory in sys.argv[1:]
+             for path in Path(directory).rglob('*')
+             if not path.is_symlink() and path.is_file()]
+
+    results = {}
+    for name, reader in [("pyelftools", read_pyelftools), ("read_elf", read_raw)]:
+        start = time.perf_counter()
+        results[name] = [reader(path) for path in files]
+        elapsed = time.perf_counter() - start
+        elf_files = sum(result is not None for result in results[name])
+        print(f"{name:>10}: {elapsed:8.3f}s for {len(files)} files ({elf_files} ELF)")
+
+    mismatches = 0
+    for path, old, new in zip(files, results["pyelftools"], results["read_elf"]):
+        if old != new:
+            mismatches += 1
+            print(f"mismatch for {path}:\n  pyelftools: {old}\n  read_elf:   {new}")
+
+    if mismatches:
+        sys.exit(f"{mismatches} files differ")
+
+
+if __name__ == "__main__":
+    main()
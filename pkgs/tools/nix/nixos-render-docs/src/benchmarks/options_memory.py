@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# Measures how much memory writing an options document takes once all options are
+# rendered, for each output format: by returning the whole document from `finalize`
+# and by streaming it to the output file with `finalize_to`. Peak sizes are traced
+# allocations on top of the rendered options, not counting the options themselves.
+#
+# Usage: python3 benchmarks/options_memory.py path/to/options.json [format...]
+#
+# The full NixOS options.json is built by
+#   nix-build nixos/release.nix -A options
+
+import argparse
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, TextIO
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from nixos_render_docs import options
+
+def converters(infile: options.OptionsFile) -> dict[str, Callable[[], options.BaseConverter[Any]]]:
+    return {
+        'docbook': lambda: options.DocBookConverter({}, 'local', 'none', 'vars', 'opt-'),
+        'manpage': lambda: options.ManpageConverter('local', None, None),
+        'commonmark': lambda: options.CommonMarkConverter({}, 'local'),
+        'asciidoc': lambda: options.AsciiDocConverter({}, 'local'),
+        'html': lambda: options.HTMLConverter(
+            {}, 'local', 'vars', 'opt-',
+            options.HTMLConverter.xref_targets(infile.keys(), 'opt-', 'options.html')),
+    }
+
+def measure(write: Callable[[TextIO], None]) -> tuple[int, float]:
+    with tempfile.TemporaryFile('w') as f:
+        tracemalloc.start()
+        start = time.perf_counter()
+        write(f)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return (peak, elapsed)
+
+def main() -> None:
+    p = argparse.ArgumentParser()
+    p.add_argument('infile', type=Path)
+    p.add_argument('formats', nargs='*')
+    args = p.parse_args()
+
+    infile = options.OptionsFile(args.infile)
+    available = converters(infile)
+    formats = args.formats or list(available.keys())
+
+    mib = 1024 * 1024
+    print(f"{'format':<12}{'output MiB':>12}{'finalize MiB':>14}{'finalize_to MiB':>17}"
+          f"{'finalize s':>12}{'finalize_to s':>15}")
+    for name in formats:
+        md = available[name]()
+        md.add_options(infile)
+        size = len(md.finalize().encode())
+        def write_joined(f: TextIO) -> None:
+            f.write(md.finalize())
+        (joined, joined_time) = measure(write_joined)
+        (streamed, streamed_time) = measure(md.finalize_to)
+        print(f"{name:<12}{size / mib:>12.1f}{joined / mib:>14.1f}{streamed / mib:>17.1f}"
+              f"{joined_time:>12.2f}{streamed_time:>15.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+# Times rendering of already parsed markdown, which is mostly dispatching tokens to
+# renderer methods and joining their results. The sample document used by the tests
+# is repeated to get a document of useful size, parsing is not included.
+#
+# Usage: python3 benchmarks/render_dispatch.py [repeat] [renderer...]
+
+import argparse
+import sys
+import timeit
+from pathlib import Path
+from typing import Callable
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent.parent / "tests"))
+
+import nixos_render_docs as nrd
+from sample_md import sample1
+
+class HTMLRenderer(nrd.html.HTMLRenderer):
+    def _pull_image(self, src: str) -> str:
+        return src
+
+renderers: dict[str, Callable[[], nrd.md.Renderer]] = {
+    'asciidoc': lambda: nrd.asciidoc.AsciiDocRenderer({}),
+    'commonmark': lambda: nrd.commonmark.CommonMarkRenderer({}),
+    'docbook': lambda: nrd.docbook.DocBookRenderer({}),
+    'html': lambda: HTMLRenderer({}, {}),
+    'manpage': lambda: nrd.manpage.ManpageRenderer({}, {}),
+}
+
+class Parser(nrd.md.Converter[nrd.md.Renderer]):
+    pass
+
+def main() -> None:
+    p = argparse.ArgumentParser()
+    p.add_argument('repeat', type=int, nargs='?', default=50)
+    p.add_argument('renderers', nargs='*')
+    args = p.parse_args()
+
+    tokens = Parser()._parse("\n\n".join([ sample1 ] * args.repeat))
+    print(f"{len(tokens)} block tokens, "
+          f"{sum(len(t.children or []) for t in tokens)} inline tokens")
+    for name in args.renderers or renderers.keys():
+        r = renderers[name]()
+        best = min(timeit.repeat(lambda: r.render(tokens), number=10, repeat=5)) / 10
+        print(f"{name:<12}{best * 1000:>8.2f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -53,3 +53,5 @@ def main() -> None:
         traceback.print_exc()
         pretty_print_exc(e)
         sys.exit(1)
+    finally:
+        parallel.close()
@@ -0,0 +1,188 @@
+# persistent cache for incremental manual builds. parsing markdown is by far the most
+# expensive part of converting a manual, and most iterations on a manual touch only a
+# few files. we keep the token stream of every parsed file keyed by its contents, and
+# for every chunk that is rendered into a file of its own we record a key describing
+# everything that went into it (plus the files it read and wrote). chunks that are
+# found in the cache with all of their outputs still present are not rendered again.
+#
+# rendered options are cached separately, see OptionCache.
+#
+# nothing in here is shared between users or machines, so pickling tokens is fine.
+
+import dataclasses as dc
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import tempfile
+import time
+
+from pathlib import Path
+from typing import Any, Callable, Iterable, Optional
+
+import markdown_it
+import mdit_py_plugins
+from markdown_it.token import Token
+
+def _code_version() -> str:
+    # everything we cache depends on the exact code that produced it. hashing our own
+    # sources is cheap and catches local hacking on the renderer as well as updates.
+    h = hashlib.sha256(f"{markdown_it.__version__} {mdit_py_plugins.__version__}".encode())
+    for src in sorted(Path(__file__).parent.glob('*.py')):
+        h.update(src.name.encode())
+        h.update(src.read_bytes())
+    return h.hexdigest()
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    # concurrent builds may share a cache, readers must never see partial files.
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def digest_fragment(h: "hashlib._Hash", path: Path, src: str, tokens: Iterable[Token], *context: Any) -> None:
+    """
+    feed a parsed file into the hash object `h`. tokens are determined by their source and
+    the parsing context, except for includes: these must have been digested already.
+    """
+    h.update(repr((str(path), context)).encode())
+    h.update(src.encode())
+    for t in tokens:
+        if t.type.startswith('included_'):
+            h.update(repr((t.info, sorted(t.meta['include-args'].items()),
+                           t.meta.get('included-digest'), t.meta.get('source-digest'))).encode())
+
+@dc.dataclass
+class ChunkRecord:
+    """paths of written files (relative to the output directory) and read files with their hashes"""
+    outputs: list[str] = dc.field(default_factory=list)
+    inputs: dict[str, str] = dc.field(default_factory=dict)
+
+    def merge(self, other: 'ChunkRecord') -> None:
+        self.outputs += other.outputs
+        self.inputs |= other.inputs
+
+def hash_file_contents(content: bytes) -> str:
+    return hashlib.sha3_256(content).hexdigest()
+
+class ManualCache:
+    _parse_dir: Path
+    _chunk_dir: Path
+    _version: str
+
+    def __init__(self, directory: Path):
+        self._parse_dir = directory / "parse"
+        self._chunk_dir = directory / "chunks"
+        self._parse_dir.mkdir(parents=True, exist_ok=True)
+        self._chunk_dir.mkdir(parents=True, exist_ok=True)
+        self._version = _code_version()
+
+    def hasher(self) -> "hashlib._Hash":
+        return hashlib.sha256(self._version.encode())
+
+    def parse(self, src: str, parse: Callable[[str], list[Token]]) -> list[Token]:
+        h = self.hasher()
+        h.update(src.encode())
+        path = self._parse_dir / h.hexdigest()
+        try:
+            with open(path, 'rb') as f:
+                tokens: list[Token] = pickle.load(f)
+                return tokens
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+        tokens = parse(src)
+        # the caller will modify tokens, so we must save them right away.
+        _write_atomic(path, pickle.dumps(tokens, pickle.HIGHEST_PROTOCOL))
+        return tokens
+
+    def lookup_chunk(self, key: str, base_path: Path) -> Optional[ChunkRecord]:
+        try:
+            record = ChunkRecord(**json.loads((self._chunk_dir / key).read_text()))
+            for output in record.outputs:
+                if not (base_path / output).exists():
+                    return None
+            for input, digest in record.inputs.items():
+                if hash_file_contents(Path(input).read_bytes()) != digest:
+                    return None
+            return record
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def store_chunk(self, key: str, record: ChunkRecord) -> None:
+        _write_atomic(self._chunk_dir / key, json.dumps(dc.asdict(record)).encode())
+
+class OptionCache:
+    """
+    rendered options stored in an sqlite database, keyed by everything that goes into
+    rendering them. entries that were not used for `max_age` seconds are dropped when the
+    cache is closed, as are the least recently used entries if the cache has grown beyond
+    `max_size` bytes.
+    """
+
+    _db: sqlite3.Connection
+    _version: str
+    _now: float
+    _used: list[str]
+
+    def __init__(self, path: Path, *, max_age: Optional[float] = None, max_size: Optional[int] = None):
+        # concurrent builds may share a cache. sqlite locks the database for us, but
+        # we have to wait for other builds to finish their writes.
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS options"
+            "(key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS options_used ON options(used)")
+        self._max_age = max_age
+        self._max_size = max_size
+        self._version = _code_version()
+        self._now = time.time()
+        self._used = []
+
+    def key(self, *parts: str | bytes) -> str:
+        h = hashlib.sha256(self._version.encode())
+        for p in parts:
+            b = p.encode() if isinstance(p, str) else p
+            h.update(len(b).to_bytes(8, 'little'))
+            h.update(b)
+        return h.hexdigest()
+
+    def get(self, key: str) -> Any:
+        row = self._db.execute("SELECT value FROM options WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            value = pickle.loads(row[0])
+        except (EOFError, pickle.UnpicklingError):
+            return None
+        self._used.append(key)
+        return value
+
+    def put(self, entries: Iterable[tuple[str, Any]]) -> None:
+        rows = []
+        for (key, value) in entries:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            rows.append((key, data, len(data), self._now))
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO options VALUES (?, ?, ?, ?)", rows)
+
+    def close(self) -> None:
+        with self._db:
+            self._db.executemany("UPDATE options SET used = ? WHERE key = ?",
+                                 ((self._now, key) for key in self._used))
+            if self._max_age is not None:
+                self._db.execute("DELETE FROM options WHERE used < ?", (self._now - self._max_age,))
+            if self._max_size is not None:
+                excess = self._db.execute("SELECT TOTAL(size) FROM options").fetchone()[0] - self._max_size
+                evict = []
+                for (key, size) in self._db.execute("SELECT key, size FROM options ORDER BY used"):
+                    if excess <= 0:
+                        break
+                    evict.append((key,))
+                    excess -= size
+                self._db.executemany("DELETE FROM options WHERE key = ?", evict)
+        self._db.close()
@@ -49,16 +49,19 @@ class DocBookRenderer(Renderer):
     def renderInline(self, tokens: Sequence[Token]) -> str:
         # HACK to support docbook links and xrefs. link handling is only necessary because the docbook
         # manpage stylesheet converts - in urls to a mathematical minus, which may be somewhat incorrect.
+        # tokens may be shared with other renderers, so we change copies instead of the originals.
+        tokens = list(tokens)
         for i, token in enumerate(tokens):
             if token.type != 'link_open':
                 continue
-            token.tag = 'link'
+            tag = 'link'
             # turn [](#foo) into xrefs
             if token.attrs['href'][0:1] == '#' and tokens[i + 1].type == 'link_close': # type: ignore[index]
-                token.tag = "xref"
+                tag = "xref"
+            tokens[i] = token.copy(tag=tag)
             # turn <x> into links without contents
             if tokens[i + 1].type == 'text' and tokens[i + 1].content == token.attrs['href']:
-                tokens[i + 1].content = ''
+                tokens[i + 1] = tokens[i + 1].copy(content='')
 
         return super().renderInline(tokens)
 
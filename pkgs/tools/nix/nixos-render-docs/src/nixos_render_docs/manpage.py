@@ -79,14 +79,14 @@ class ManpageRenderer(Renderer):
     inline_code_is_quoted: bool = True
     link_footnotes: Optional[list[str]] = None
 
-    _href_targets: dict[str, str]
+    _href_targets: Mapping[str, str]
 
     _link_stack: list[str]
     _do_parbreak_stack: list[bool]
     _list_stack: list[List]
     _font_stack: list[str]
 
-    def __init__(self, manpage_urls: Mapping[str, str], href_targets: dict[str, str]):
+    def __init__(self, manpage_urls: Mapping[str, str], href_targets: Mapping[str, str]):
         super().__init__(manpage_urls)
         self._href_targets = href_targets
         self._link_stack = []
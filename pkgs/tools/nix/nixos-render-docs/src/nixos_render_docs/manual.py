@@ -1,5 +1,4 @@
 import argparse
-import hashlib
 import html
 import json
 import re
@@ -8,11 +7,12 @@ import xml.sax.saxutils as xml
 from abc import abstractmethod
 from collections.abc import Mapping, Sequence
 from pathlib import Path
-from typing import Any, Callable, cast, ClassVar, Generic, get_args, NamedTuple
+from typing import Any, Callable, cast, ClassVar, Generic, get_args, Iterable, NamedTuple, Optional
 
 from markdown_it.token import Token
 
-from . import md, options
+from . import md, options, parallel
+from .cache import ChunkRecord, digest_fragment, hash_file_contents, ManualCache
 from .docbook import DocBookRenderer, Heading, make_xml_id
 from .html import HTMLRenderer, UnresolvedXrefError
 from .manual_structure import check_structure, FragmentType, is_include, TocEntry, TocEntryType, XrefTarget
@@ -29,6 +29,7 @@ class BaseConverter(Converter[md.TR], Generic[md.TR]):
 
     _base_paths: list[Path]
     _current_type: list[TocEntryType]
+    _cache: Optional[ManualCache] = None
 
     def convert(self, infile: Path, outfile: Path) -> None:
         self._base_paths = [ infile ]
@@ -69,7 +70,7 @@ class BaseConverter(Converter[md.TR], Generic[md.TR]):
 
 
     def _parse(self, src: str, *, auto_id_prefix: None | str = None) -> list[Token]:
-        tokens = super()._parse(src)
+        tokens = self._cache.parse(src, super()._parse) if self._cache else super()._parse(src)
         if auto_id_prefix:
             def set_token_ident(token: Token, ident: str) -> None:
                 if "id" not in token.attrs:
@@ -113,6 +114,9 @@ class BaseConverter(Converter[md.TR], Generic[md.TR]):
     def _parse_included_blocks(self, token: Token, block_args: dict[str, str]) -> None:
         assert token.map
         included = token.meta['included'] = []
+        # caches need to know whether included content has changed. hashing the sources
+        # is much cheaper than hashing the parsed tokens.
+        digest = self._cache.hasher() if self._cache else None
         for (lnum, line) in enumerate(token.content.splitlines(), token.map[0] + 2):
             line = line.strip()
             path = self._base_paths[-1].parent / line
@@ -126,11 +130,16 @@ class BaseConverter(Converter[md.TR], Generic[md.TR]):
                         # include the current file number to prevent duplicate ids within include blocks
                         prefix = f"{block_args.get('auto-id-prefix')}-{lnum}"
 
-                    tokens = self._parse(f.read(), auto_id_prefix=prefix)
+                    src = f.read()
+                    tokens = self._parse(src, auto_id_prefix=prefix)
                     included.append((tokens, path))
+                    if digest:
+                        digest_fragment(digest, path, src, tokens, prefix, self._current_type[-1])
                 self._base_paths.pop()
             except Exception as e:
                 raise RuntimeError(f"processing included file {path} from line {lnum}") from e
+        if digest:
+            token.meta['included-digest'] = digest.hexdigest()
 
     def _parse_options(self, token: Token, block_args: dict[str, str]) -> None:
         assert token.map
@@ -158,7 +167,10 @@ class BaseConverter(Converter[md.TR], Generic[md.TR]):
             with open(self._base_paths[-1].parent / source, 'r') as f:
                 token.meta['id-prefix'] = id_prefix
                 token.meta['list-id'] = varlist_id
-                token.meta['source'] = json.load(f)
+                content = f.read()
+                token.meta['source'] = json.loads(content)
+                if self._cache:
+                    token.meta['source-digest'] = hash_file_contents(content.encode())
         except Exception as e:
             raise RuntimeError(f"processing options block in line {token.map[0] + 1}") from e
 
@@ -281,18 +293,37 @@ class HTMLParameters(NamedTuple):
     section_toc_depth: int
     media_dir: Path
 
+class DeferredChunk(NamedTuple):
+    key: Optional[str]
+    into: str
+    toc: TocEntry
+    fragments: Sequence[tuple[Sequence[Token], Path]]
+    tag: str
+    hlevel_offset: int
+    in_dir: Path
+
 class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
     _base_path: Path
     _in_dir: Path
     _html_params: HTMLParameters
+    _cache: Optional[ManualCache]
+    # hash of everything outside of a chunk that can influence its rendering. computed
+    # when the first chunk is rendered since the toc does not exist before that.
+    _cache_context: Optional[str] = None
+    # records of all chunks currently being rendered, innermost last
+    _chunk_records: list[ChunkRecord]
+    # chunks found while rendering the book, to be rendered once the book is done
+    _deferred_chunks: Optional[list[DeferredChunk]] = None
 
     def __init__(self, toplevel_tag: str, revision: str, html_params: HTMLParameters,
                  manpage_urls: Mapping[str, str], xref_targets: dict[str, XrefTarget],
-                 in_dir: Path, base_path: Path):
+                 in_dir: Path, base_path: Path, cache: Optional[ManualCache] = None):
         super().__init__(toplevel_tag, revision, manpage_urls, xref_targets)
         self._in_dir = in_dir
         self._base_path = base_path.absolute()
         self._html_params = html_params
+        self._cache = cache
+        self._chunk_records = []
 
     def _pull_image(self, src: str) -> str:
         src_path = Path(src)
@@ -301,12 +332,50 @@ class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
         # in an easily accessible (ie, not input-file-path-dependent) location without
         # having to maintain a mapping structure. hashing the file and using the hash
         # as both the path of the final image provides both.
-        content_hash = hashlib.sha3_256(content).hexdigest()
+        content_hash = hash_file_contents(content)
         target_name = f"{content_hash}{src_path.suffix}"
         target_path = self._base_path / self._html_params.media_dir / target_name
         target_path.write_bytes(content)
+        self._record_chunk_files(ChunkRecord(
+            [str(self._html_params.media_dir / target_name)],
+            {str((self._in_dir / src_path).absolute()): content_hash}))
         return f"./{self._html_params.media_dir}/{target_name}"
 
+    def _record_chunk_files(self, record: ChunkRecord) -> None:
+        # files used by a chunk are also used by all chunks containing it
+        for r in self._chunk_records:
+            r.merge(record)
+
+    def _chunk_key(self, cache: ManualCache, toc: TocEntry, token: Token) -> str:
+        if self._cache_context is None:
+            def walk(h: Any, entry: TocEntry) -> None:
+                h.update(repr((entry.kind, entry.target.id, entry.starts_new_chunk)).encode())
+                for child in entry.children:
+                    walk(h, child)
+                h.update(b"\0")
+            h = cache.hasher()
+            h.update(repr((self._revision, self._html_params, sorted(self._manpage_urls.items()),
+                           str(self._base_path))).encode())
+            # links and titles of all targets, including their numbering
+            h.update(repr(sorted(self._xref_targets.items())).encode())
+            walk(h, toc.root)
+            h.update(repr([ e.target.id for e in toc.root.examples + toc.root.figures ]).encode())
+            self._cache_context = h.hexdigest()
+        # examples and figures are numbered throughout the entire book. most of them will
+        # have ids and thus show up in the xref targets, but not all of them do.
+        def numbers(tokens: Sequence[Token]) -> Iterable[str]:
+            for (i, t) in enumerate(tokens):
+                if t.type in ('example_title_open', 'figure_title_open'):
+                    yield cast(list[Token], tokens[i + 1].children)[0].content
+                elif t.type.startswith('included_') and t.type != 'included_options':
+                    for sub, _path in t.meta['included']:
+                        yield from numbers(sub)
+        h = cache.hasher()
+        h.update(repr((self._cache_context, token.meta['include-args'], token.meta['included-digest'],
+                       self._toplevel_tag, self._hlevel_offset, str(self._in_dir),
+                       list(numbers([token])))).encode())
+        return h.hexdigest()
+
     def _push(self, tag: str, hlevel_offset: int) -> Any:
         result = (self._toplevel_tag, self._headings, self._attrspans, self._hlevel_offset, self._in_dir)
         self._hlevel_offset += hlevel_offset
@@ -324,7 +393,8 @@ class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
         subtitle = self.renderInline(tokens[4].children)
 
         toc = TocEntry.of(tokens[0])
-        return "\n".join([
+        self._deferred_chunks = []
+        result = "\n".join([
             self._file_header(toc),
             ' <div class="book">',
             '  <div class="titlepage">',
@@ -339,6 +409,9 @@ class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
             ' </div>',
             self._file_footer(toc),
         ])
+        chunks, self._deferred_chunks = self._deferred_chunks, None
+        self._render_deferred_chunks(chunks)
+        return result
 
     def _file_header(self, toc: TocEntry) -> str:
         prev_link, up_link, next_link = "", "", ""
@@ -520,7 +593,7 @@ class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
         return tag, style
 
     def _included_thing(self, tag: str, token: Token, tokens: Sequence[Token], i: int) -> str:
-        outer, inner = [], []
+        outer: list[str] = []
         # since books have no non-include content the toplevel book wrapper will not count
         # towards nesting depth. other types will have at least a title+id heading which
         # *does* count towards the nesting depth. chapters give a -1 to included sections
@@ -536,24 +609,80 @@ class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
         state = self._push(tag, hoffset)
         if into:
             toc = TocEntry.of(fragments[0][0][0])
-            inner.append(self._file_header(toc))
-            # we do not set _hlevel_offset=0 because docbook doesn't either.
+            key = self._chunk_key(self._cache, toc, token) if self._cache else None
+            if self._cache and key and (record := self._cache.lookup_chunk(key, self._base_path)):
+                # nothing that went into this chunk has changed, and neither has
+                # anything it wrote. rendering it again would produce the same files.
+                self._record_chunk_files(record)
+            elif self._deferred_chunks is not None:
+                self._deferred_chunks.append(DeferredChunk(
+                    key, into, toc, fragments, self._toplevel_tag, self._hlevel_offset, self._in_dir))
+            else:
+                self._render_chunk(key, into, toc, fragments)
         else:
-            inner = outer
+            self._render_fragments(outer, fragments)
+        self._pop(state)
+        return "".join(outer)
+
+    def _render_fragments(self, result: list[str], fragments: Sequence[tuple[Sequence[Token], Path]]) -> None:
         in_dir = self._in_dir
         for included, path in fragments:
             try:
                 self._in_dir = (in_dir / path).parent
-                inner.append(self.render(included))
+                result.append(self.render(included))
             except Exception as e:
                 raise RuntimeError(f"rendering {path}") from e
-        if into:
-            inner.append(self._file_footer(toc))
-            (self._base_path / into).write_text("".join(inner))
-        self._pop(state)
-        return "".join(outer)
+
+    def _render_chunk(self, key: Optional[str], into: str, toc: TocEntry,
+                      fragments: Sequence[tuple[Sequence[Token], Path]]) -> None:
+        if key is not None:
+            self._chunk_records.append(ChunkRecord([into]))
+        # we do not set _hlevel_offset=0 because docbook doesn't either.
+        result = [ self._file_header(toc) ]
+        self._render_fragments(result, fragments)
+        result.append(self._file_footer(toc))
+        (self._base_path / into).write_text("".join(result))
+        if self._cache is not None and key is not None:
+            record = self._chunk_records.pop()
+            self._cache.store_chunk(key, record)
+            self._record_chunk_files(record)
+
+    def _render_deferred_chunks(self, chunks: list[DeferredChunk]) -> None:
+        # option lists are usually the largest part of a manual and are already spread
+        # across all workers. chunk workers can't do that, so we render options first.
+        def render_options(tokens: Sequence[Token]) -> None:
+            for t in tokens:
+                if t.type == 'included_options':
+                    t.meta['rendered-options'] = self.included_options(t, tokens, 0)
+                elif t.type.startswith('included_'):
+                    for sub, _path in t.meta['included']:
+                        render_options(sub)
+        for chunk in chunks:
+            for included, _path in chunk.fragments:
+                render_options(included)
+        # all xref targets and the toc are known at this point, so every chunk can be
+        # rendered on its own. workers receive all of this only once.
+        parallel.map(self._chunk_worker_step, range(len(chunks)), 1,
+                     self._chunk_worker_init,
+                     (self._revision, self._html_params, self._manpage_urls, self._xref_targets,
+                      self._base_path, self._cache, chunks))
+
+    @classmethod
+    def _chunk_worker_init(cls, a: Any) -> tuple['ManualHTMLRenderer', list[DeferredChunk]]:
+        (revision, html_params, manpage_urls, xref_targets, base_path, cache, chunks) = a
+        return (cls('book', revision, html_params, manpage_urls, xref_targets, base_path, base_path, cache),
+                chunks)
+
+    @classmethod
+    def _chunk_worker_step(cls, s: tuple['ManualHTMLRenderer', list[DeferredChunk]], i: int) -> None:
+        (renderer, chunks) = s
+        chunk = chunks[i]
+        renderer._pop((chunk.tag, [], [], chunk.hlevel_offset, chunk.in_dir))
+        renderer._render_chunk(chunk.key, chunk.into, chunk.toc, chunk.fragments)
 
     def included_options(self, token: Token, tokens: Sequence[Token], i: int) -> str:
+        if (rendered := token.meta.get('rendered-options')) is not None:
+            return cast(str, rendered)
         conv = options.HTMLConverter(self._manpage_urls, self._revision,
                                      token.meta['list-id'], token.meta['id-prefix'],
                                      self._xref_targets)
@@ -578,9 +707,11 @@ class HTMLConverter(BaseConverter[ManualHTMLRenderer]):
         self._appendix_count += 1
         return _to_base26(self._appendix_count - 1)
 
-    def __init__(self, revision: str, html_params: HTMLParameters, manpage_urls: Mapping[str, str]):
+    def __init__(self, revision: str, html_params: HTMLParameters, manpage_urls: Mapping[str, str],
+                 cache: Optional[ManualCache] = None):
         super().__init__()
         self._revision, self._html_params, self._manpage_urls = revision, html_params, manpage_urls
+        self._cache = cache
         self._xref_targets = {}
         self._redirection_targets = set()
         # renderer not set on purpose since it has a dependency on the output path!
@@ -588,7 +719,7 @@ class HTMLConverter(BaseConverter[ManualHTMLRenderer]):
     def convert(self, infile: Path, outfile: Path) -> None:
         self._renderer = ManualHTMLRenderer(
             'book', self._revision, self._html_params, self._manpage_urls, self._xref_targets,
-            infile.parent, outfile.parent)
+            infile.parent, outfile.parent, self._cache)
         super().convert(infile, outfile)
 
     def _parse(self, src: str, *, auto_id_prefix: None | str = None) -> list[Token]:
@@ -758,6 +889,7 @@ def _build_cli_html(p: argparse.ArgumentParser) -> None:
     p.add_argument('--chunk-toc-depth', default=1, type=int)
     p.add_argument('--section-toc-depth', default=0, type=int)
     p.add_argument('--media-dir', default="media", type=Path)
+    p.add_argument('--cache-dir', default=None, type=Path)
     p.add_argument('infile', type=Path)
     p.add_argument('outfile', type=Path)
 
@@ -772,7 +904,8 @@ def _run_cli_html(args: argparse.Namespace) -> None:
             args.revision,
             HTMLParameters(args.generator, args.stylesheet, args.script, args.toc_depth,
                            args.chunk_toc_depth, args.section_toc_depth, args.media_dir),
-            json.load(manpage_urls))
+            json.load(manpage_urls),
+            ManualCache(args.cache_dir) if args.cache_dir else None)
         md.convert(args.infile, args.outfile)
 
 def build_cli(p: argparse.ArgumentParser) -> None:
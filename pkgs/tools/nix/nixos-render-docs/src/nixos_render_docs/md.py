@@ -137,23 +137,29 @@ class Renderer:
     def admonition_close(self, token: Token, tokens: Sequence[Token], i: int) -> str:
         return self._admonitions[self._admonition_stack.pop()][1](token, tokens, i)
 
+    # rendering is mostly dispatching tokens to rules, this is as hot as code gets. keep it
+    # a plain loop, closures and generators cost more than the rules themselves for most tokens.
     def render(self, tokens: Sequence[Token]) -> str:
-        def do_one(i: int, token: Token) -> str:
+        rules = self.rules
+        result = []
+        for i, token in enumerate(tokens):
             if token.type == "inline":
                 assert token.children is not None
-                return self.renderInline(token.children)
-            elif token.type in self.rules:
-                return self.rules[token.type](tokens[i], tokens, i)
+                result.append(self.renderInline(token.children))
+            elif (rule := rules.get(token.type)) is not None:
+                result.append(rule(token, tokens, i))
             else:
                 raise NotImplementedError("md token not supported yet", token)
-        return self._join_block(map(lambda arg: do_one(*arg), enumerate(tokens)))
+        return self._join_block(result)
     def renderInline(self, tokens: Sequence[Token]) -> str:
-        def do_one(i: int, token: Token) -> str:
-            if token.type in self.rules:
-                return self.rules[token.type](tokens[i], tokens, i)
+        rules = self.rules
+        result = []
+        for i, token in enumerate(tokens):
+            if (rule := rules.get(token.type)) is not None:
+                result.append(rule(token, tokens, i))
             else:
                 raise NotImplementedError("md token not supported yet", token)
-        return self._join_inline(map(lambda arg: do_one(*arg), enumerate(tokens)))
+        return self._join_inline(result)
 
     def text(self, token: Token, tokens: Sequence[Token], i: int) -> str:
         raise RuntimeError("md token not supported", token)
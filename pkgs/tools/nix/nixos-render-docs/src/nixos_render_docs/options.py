@@ -3,19 +3,23 @@ from __future__ import annotations
 import argparse
 import html
 import json
+import mmap
+import re
 import xml.sax.saxutils as xml
 
 from abc import abstractmethod
-from collections.abc import Mapping, Sequence
+from array import array
+from collections.abc import Iterable, Iterator, Mapping, Sequence
 from markdown_it.token import Token
 from pathlib import Path
-from typing import Any, Generic, Optional
+from typing import Any, Generic, Optional, TextIO
 from urllib.parse import quote
 
 
 from . import md
 from . import parallel
 from .asciidoc import AsciiDocRenderer, asciidoc_escape
+from .cache import OptionCache
 from .commonmark import CommonMarkRenderer
 from .docbook import DocBookRenderer, make_xml_id
 from .html import HTMLRenderer
@@ -33,16 +37,174 @@ def option_is(option: Option, key: str, typ: str) -> Optional[dict[str, str]]:
         return None
     return option[key] # type: ignore[return-value]
 
+# options files are only scanned for the boundaries of option values, which are then
+# decoded on access. the scanner works on the mapped bytes and does not validate values.
+_json_ws = re.compile(rb'[ \t\n\r]*')
+_json_string = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+# an option name and the colon after it
+_json_member = re.compile(rb'[ \t\n\r]*("[^"\\]*(?:\\.[^"\\]*)*")[ \t\n\r]*:[ \t\n\r]*', re.DOTALL)
+# the comma or brace after an option value
+_json_separator = re.compile(rb'[ \t\n\r]*([,}])')
+# everything up to the next bracket outside of strings, which is the first group
+_json_structure = re.compile(
+    rb'[^"[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"[\]{}]*)*([][{}])', re.DOTALL)
+# numbers, true, false and null
+_json_scalar = re.compile(rb'[^ \t\n\r,:\]}]+')
+
+def _skip_json_value(data: mmap.mmap, pos: int) -> Optional[int]:
+    c = data[pos:pos + 1]
+    if c == b'{' or c == b'[':
+        depth = 0
+        for m in _json_structure.finditer(data, pos):
+            if m[1] in b'{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return m.end()
+        return None
+    scalar = (_json_string if c == b'"' else _json_scalar).match(data, pos)
+    return scalar.end() if scalar else None
+
+class OptionsFile(Mapping[str, Any]):
+    """
+    an options.json file that is memory-mapped instead of loaded. options are decoded on
+    access, which allows workers to address options by index instead of having every
+    option sent to them. workers map the file themselves and decode only what they need.
+    """
+
+    _path: Path
+    _names: list[str]
+    _index: dict[str, int]
+    # byte offsets of the value of each option, as start/end pairs
+    _spans: array[int]
+    _data: mmap.mmap
+
+    def __init__(self, path: Path):
+        self._path = path
+        self._map()
+        self._names, self._spans = [], array('Q')
+        data = self._data
+        m = _json_ws.match(data)
+        assert m
+        pos = m.end()
+        if data[pos:pos + 1] != b'{':
+            raise ValueError(f"expected '{{' at offset {pos} of {path}")
+        m = _json_separator.match(data, pos + 1)
+        if m and m[1] == b'}':
+            pos = m.end()
+        else:
+            pos += 1
+            while True:
+                if (m := _json_member.match(data, pos)) is None:
+                    raise ValueError(f"expected option name at offset {pos} of {path}")
+                raw_name = m[1][1:-1]
+                self._names.append(json.loads(m[1]) if b'\\' in raw_name else raw_name.decode())
+                start = m.end()
+                if (end := _skip_json_value(data, start)) is None:
+                    raise ValueError(f"invalid option value at offset {start} of {path}")
+                self._spans.extend((start, end))
+                if (m := _json_separator.match(data, end)) is None:
+                    raise ValueError(f"expected ',' or '}}' at offset {end} of {path}")
+                pos = m.end()
+                if m[1] == b'}':
+                    break
+        m = _json_ws.match(data, pos)
+        assert m
+        if m.end() != len(data):
+            raise ValueError(f"unexpected data after offset {pos} of {path}")
+        self._index = { name: i for i, name in enumerate(self._names) }
+        if len(self._index) != len(self._names):
+            raise ValueError(f"duplicate options in {path}")
+
+    def _map(self) -> None:
+        with open(self._path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __getstate__(self) -> Any:
+        return (self._path, self._names, self._spans)
+    def __setstate__(self, state: Any) -> None:
+        (self._path, self._names, self._spans) = state
+        self._index = { name: i for i, name in enumerate(self._names) }
+        self._map()
+
+    def __len__(self) -> int:
+        return len(self._names)
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._names)
+    def __getitem__(self, name: str) -> Any:
+        return self.item(self._index[name])[1]
+
+    def item(self, i: int) -> tuple[str, Any]:
+        return (self._names[i], json.loads(self.raw(i)))
+
+    def raw(self, i: int) -> bytes:
+        return self._data[self._spans[2 * i]:self._spans[2 * i + 1]]
+
+# options are addressed by index in workers, either in an options file or in a list
+# of items if options were given as a plain mapping.
+_OptionSource = OptionsFile | list[tuple[str, Any]]
+
+def _option_item(source: _OptionSource, i: int) -> tuple[str, Any]:
+    return source.item(i) if isinstance(source, OptionsFile) else source[i]
+
+def _option_data(options: Mapping[str, Any], i: int, name: str) -> bytes:
+    if isinstance(options, OptionsFile):
+        return options.raw(i)
+    return json.dumps(options[name], sort_keys=True).encode()
+
+class _RecordingMapping(Mapping[str, Any]):
+    """
+    a view of a mapping that remembers which keys were looked up while `reads` is set.
+    renderers only look up single keys in their lookup tables, iterating is not recorded.
+    """
+
+    reads: Optional[dict[str, Any]] = None
+
+    def __init__(self, inner: Mapping[str, Any]):
+        self._inner = inner
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            value = self._inner[key]
+        except KeyError:
+            if self.reads is not None:
+                self.reads[key] = None
+            raise
+        if self.reads is not None:
+            self.reads[key] = value
+        return value
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._inner)
+    def __len__(self) -> int:
+        return len(self._inner)
+
+    def unchanged(self, reads: Mapping[str, Any]) -> bool:
+        return all(self._inner.get(k) == v for (k, v) in reads.items())
+
 class BaseConverter(Converter[md.TR], Generic[md.TR]):
     __option_block_separator__: str
 
     _options: dict[str, RenderedOption]
+    # the lookup table renderers consult while rendering options, if any. it is not part of
+    # cache keys for rendered options, the entries each option used are stored instead.
+    _lookups: Optional[_RecordingMapping] = None
+    # set while rendering an option for several converters at once. parsed tokens
+    # are shared between all of them, renderers must thus not modify tokens.
+    _parse_cache: Optional[dict[str, list[Token]]] = None
 
     def __init__(self, revision: str):
         super().__init__()
         self._options = {}
         self._revision = revision
 
+    def _parse(self, src: str) -> list[Token]:
+        if self._parse_cache is None:
+            return super()._parse(src)
+        if (tokens := self._parse_cache.get(src)) is None:
+            tokens = self._parse_cache[src] = super()._parse(src)
+        return tokens
+
     def _sorted_options(self) -> list[tuple[str, RenderedOption]]:
         keys = list(self._options.keys())
         keys.sort(key=lambda opt: [ (0 if p.startswith("enable") else 1 if p.startswith("package") else 2, p)
@@ -161,18 +323,109 @@ class BaseConverter(Converter[md.TR], Generic[md.TR]):
         except Exception as e:
             raise Exception(f"Failed to render option {name}") from e
 
+    # results are sent back to the main process, and one string is much cheaper
+    # to pickle than many. the lines will be joined just the same when finalizing.
+    @staticmethod
+    def _prejoin(r: RenderedOption) -> RenderedOption:
+        return r._replace(lines=[ "\n".join(r.lines) ]) if r.lines else r
+
     @classmethod
     def _parallel_render_step(cls, s: BaseConverter[md.TR], a: Any) -> RenderedOption:
-        return s._render_option(*a)
+        return cls._prejoin(s._render_option(*a))
 
-    def add_options(self, options: dict[str, Any]) -> None:
-        mapped = parallel.map(self._parallel_render_step, options.items(), 100,
-                              self._parallel_render_init_worker, self._parallel_render_prepare())
+    @classmethod
+    def _parallel_render_init_indexed(cls, a: Any) -> tuple[BaseConverter[md.TR], _OptionSource]:
+        return (cls._parallel_render_init_worker(a[0]), a[1])
+    @classmethod
+    def _parallel_render_step_indexed(cls, s: tuple[BaseConverter[md.TR], _OptionSource], i: int
+                                      ) -> RenderedOption:
+        return cls._prejoin(s[0]._render_option(*_option_item(s[1], i)))
+    @classmethod
+    def _parallel_render_step_recorded(cls, s: tuple[BaseConverter[md.TR], _OptionSource], i: int
+                                       ) -> tuple[RenderedOption, Optional[dict[str, Any]]]:
+        return s[0]._render_option_recorded(*_option_item(s[1], i))
+
+    def _render_option_recorded(self, name: str, option: dict[str, Any]
+                                ) -> tuple[RenderedOption, Optional[dict[str, Any]]]:
+        if self._lookups is None:
+            return (self._prejoin(self._render_option(name, option)), None)
+        try:
+            self._lookups.reads = {}
+            return (self._prejoin(self._render_option(name, option)), self._lookups.reads)
+        finally:
+            self._lookups.reads = None
+
+    # everything except the options themselves and `_lookups` that determines how options
+    # are rendered. this must change whenever rendered output would change.
+    def _cache_settings(self) -> Any:
+        return self._parallel_render_prepare()
+
+    def _cache_lookup(self, cache: OptionCache, settings: str, name: str, data: bytes
+                      ) -> tuple[str, Optional[RenderedOption]]:
+        key = cache.key(settings, name, data)
+        if (entry := cache.get(key)) is not None:
+            (option, reads) = entry
+            if reads is None or (self._lookups is not None and self._lookups.unchanged(reads)):
+                return (key, option)
+        return (key, None)
+
+    def _register_options(self, names: Iterable[str]) -> None:
+        """called with the names of all options before any of them are rendered."""
+        pass
+
+    def add_options(self, options: Mapping[str, Any], cache: Optional[OptionCache] = None) -> None:
+        self._register_options(options.keys())
+        if cache is not None:
+            self._add_options_cached(options, cache)
+            return
+        if isinstance(options, OptionsFile):
+            mapped = parallel.map(self._parallel_render_step_indexed, range(len(options)), 100,
+                                  self._parallel_render_init_indexed,
+                                  (self._parallel_render_prepare(), options))
+        else:
+            mapped = parallel.map(self._parallel_render_step, options.items(), 100,
+                                  self._parallel_render_init_worker, self._parallel_render_prepare())
         for (name, option) in zip(options.keys(), mapped):
             self._options[name] = option
 
+    def _add_options_cached(self, options: Mapping[str, Any], cache: OptionCache) -> None:
+        settings = cache.key(type(self).__qualname__, repr(self._cache_settings()))
+        names = list(options.keys())
+        keys, rendered = [], []
+        for (i, name) in enumerate(names):
+            key, option = self._cache_lookup(cache, settings, name, _option_data(options, i, name))
+            keys.append(key)
+            rendered.append(option)
+        missing = [ i for (i, option) in enumerate(rendered) if option is None ]
+        source = options if isinstance(options, OptionsFile) else list(options.items())
+        mapped = parallel.map(self._parallel_render_step_recorded, missing, 100,
+                              self._parallel_render_init_indexed,
+                              (self._parallel_render_prepare(), source))
+        for (i, entry) in zip(missing, mapped):
+            rendered[i] = entry[0]
+        cache.put((keys[i], entry) for (i, entry) in zip(missing, mapped))
+        for (name, option) in zip(names, rendered):
+            assert option is not None
+            self._options[name] = option
+
     @abstractmethod
-    def finalize(self) -> str: raise NotImplementedError()
+    def _finalize_lines(self) -> Iterator[str]: raise NotImplementedError()
+
+    def finalize(self) -> str:
+        return "\n".join(self._finalize_lines())
+
+    def finalize_to(self, f: TextIO) -> None:
+        """like `finalize`, but writes to `f` as the output is produced instead of returning it."""
+        sep = ""
+        for l in self._finalize_lines():
+            f.write(sep)
+            f.write(l)
+            sep = "\n"
+
+# the docbook-compatible renderers never emit compact lists. tokens may be shared between
+# converters (see MultiConverter), so we must not change the list token itself.
+def _not_compact(token: Token) -> Token:
+    return token.copy(meta=token.meta | { 'compact': False })
 
 class OptionDocsRestrictions:
     def heading_open(self, token: Token, tokens: Sequence[Token], i: int) -> str:
@@ -187,11 +440,9 @@ class OptionDocsRestrictions:
 class OptionsDocBookRenderer(OptionDocsRestrictions, DocBookRenderer):
     # TODO keep optionsDocBook diff small. remove soon if rendering is still good.
     def ordered_list_open(self, token: Token, tokens: Sequence[Token], i: int) -> str:
-        token.meta['compact'] = False
-        return super().ordered_list_open(token, tokens, i)
+        return super().ordered_list_open(_not_compact(token), tokens, i)
     def bullet_list_open(self, token: Token, tokens: Sequence[Token], i: int) -> str:
-        token.meta['compact'] = False
-        return super().bullet_list_open(token, tokens, i)
+        return super().bullet_list_open(_not_compact(token), tokens, i)
 
 class DocBookConverter(BaseConverter[OptionsDocBookRenderer]):
     __option_block_separator__ = ""
@@ -240,17 +491,18 @@ class DocBookConverter(BaseConverter[OptionsDocBookRenderer]):
         return [ "</simplelist>" ]
 
     def finalize(self, *, fragment: bool = False) -> str:
-        result = []
+        return "\n".join(self._finalize_lines(fragment=fragment))
 
+    def _finalize_lines(self, *, fragment: bool = False) -> Iterator[str]:
         if not fragment:
-            result.append('<?xml version="1.0" encoding="UTF-8"?>')
+            yield '<?xml version="1.0" encoding="UTF-8"?>'
         if self._document_type == 'appendix':
-            result += [
+            yield from [
                 '<appendix xmlns="http://docbook.org/ns/docbook"',
                 '          xml:id="appendix-configuration-options">',
                 '  <title>Configuration Options</title>',
             ]
-        result += [
+        yield from [
             '<variablelist xmlns:xlink="http://www.w3.org/1999/xlink"',
             '               xmlns:nixos="tag:nixos.org"',
             '               xmlns="http://docbook.org/ns/docbook"',
@@ -259,24 +511,22 @@ class DocBookConverter(BaseConverter[OptionsDocBookRenderer]):
 
         for (name, opt) in self._sorted_options():
             id = make_xml_id(self._id_prefix + name)
-            result += [
+            yield from [
                 "<varlistentry>",
                 # NOTE adding extra spaces here introduces spaces into xref link expansions
                 (f"<term xlink:href={xml.quoteattr('#' + id)} xml:id={xml.quoteattr(id)}>" +
                  f"<option>{xml.escape(name)}</option></term>"),
                 "<listitem>"
             ]
-            result += opt.lines
-            result += [
+            yield from opt.lines
+            yield from [
                 "</listitem>",
                 "</varlistentry>"
             ]
 
-        result.append("</variablelist>")
+        yield "</variablelist>"
         if self._document_type == 'appendix':
-            result.append("</appendix>")
-
-        return "\n".join(result)
+            yield "</appendix>"
 
 class OptionsManpageRenderer(OptionDocsRestrictions, ManpageRenderer):
     pass
@@ -295,7 +545,8 @@ class ManpageConverter(BaseConverter[OptionsManpageRenderer]):
                  _options_by_id: Optional[dict[str, str]] = None):
         super().__init__(revision)
         self._options_by_id = _options_by_id or {}
-        self._renderer = OptionsManpageRenderer({}, self._options_by_id)
+        self._lookups = _RecordingMapping(self._options_by_id)
+        self._renderer = OptionsManpageRenderer({}, self._lookups)
         self._header = header
         self._footer = footer
 
@@ -310,16 +561,19 @@ class ManpageConverter(BaseConverter[OptionsManpageRenderer]):
     def _parallel_render_init_worker(cls, a: Any) -> ManpageConverter:
         return cls(a[0], a[1], a[2], **a[3])
 
+    def _cache_settings(self) -> Any:
+        # header and footer are only used by finalize
+        return self._revision
+
     def _render_option(self, name: str, option: dict[str, Any]) -> RenderedOption:
         links = self._renderer.link_footnotes = []
         result = super()._render_option(name, option)
         self._renderer.link_footnotes = None
         return result._replace(links=links)
 
-    def add_options(self, options: dict[str, Any]) -> None:
-        for (k, v) in options.items():
+    def _register_options(self, names: Iterable[str]) -> None:
+        for k in names:
             self._options_by_id[f'#{make_xml_id(f"opt-{k}")}'] = k
-        return super().add_options(options)
 
     def _render_code(self, option: dict[str, Any], key: str) -> list[str]:
         try:
@@ -349,13 +603,11 @@ class ManpageConverter(BaseConverter[OptionsManpageRenderer]):
     def _decl_def_footer(self) -> list[str]:
         return []
 
-    def finalize(self) -> str:
-        result = []
-
+    def _finalize_lines(self) -> Iterator[str]:
         if self._header is not None:
-            result += self._header
+            yield from self._header
         else:
-            result += [
+            yield from [
                 r'''.TH "CONFIGURATION\&.NIX" "5" "01/01/1980" "NixOS" "NixOS Reference Pages"''',
                 r'''.\" disable hyphenation''',
                 r'''.nh''',
@@ -377,14 +629,14 @@ class ManpageConverter(BaseConverter[OptionsManpageRenderer]):
             ]
 
         for (name, opt) in self._sorted_options():
-            result += [
+            yield from [
                 ".PP",
                 f"\\fB{man_escape(name)}\\fR",
                 ".RS 4",
             ]
-            result += opt.lines
+            yield from opt.lines
             if links := opt.links:
-                result.append(self.__option_block_separator__)
+                yield self.__option_block_separator__
                 md_links = ""
                 for i in range(0, len(links)):
                     md_links += "\n" if i > 0 else ""
@@ -392,21 +644,19 @@ class ManpageConverter(BaseConverter[OptionsManpageRenderer]):
                         md_links += f"{i+1}. see the {{option}}`{self._options_by_id[links[i]]}` option"
                     else:
                         md_links += f"{i+1}. " + md_escape(links[i])
-                result.append(self._render(md_links))
+                yield self._render(md_links)
 
-            result.append(".RE")
+            yield ".RE"
 
         if self._footer is not None:
-            result += self._footer
+            yield from self._footer
         else:
-            result += [
+            yield from [
                 r'''.SH "AUTHORS"''',
                 r'''.PP''',
                 r'''Eelco Dolstra and the Nixpkgs/NixOS contributors''',
             ]
 
-        return "\n".join(result)
-
 class OptionsCommonMarkRenderer(OptionDocsRestrictions, CommonMarkRenderer):
     pass
 
@@ -437,15 +687,11 @@ class CommonMarkConverter(BaseConverter[OptionsCommonMarkRenderer]):
     def _decl_def_footer(self) -> list[str]:
         return []
 
-    def finalize(self) -> str:
-        result = []
-
+    def _finalize_lines(self) -> Iterator[str]:
         for (name, opt) in self._sorted_options():
-            result.append(f"## {md_escape(name)}\n")
-            result += opt.lines
-            result.append("\n\n")
-
-        return "\n".join(result)
+            yield f"## {md_escape(name)}\n"
+            yield from opt.lines
+            yield "\n\n"
 
 class OptionsAsciiDocRenderer(OptionDocsRestrictions, AsciiDocRenderer):
     pass
@@ -477,24 +723,18 @@ class AsciiDocConverter(BaseConverter[OptionsAsciiDocRenderer]):
     def _decl_def_footer(self) -> list[str]:
         return []
 
-    def finalize(self) -> str:
-        result = []
-
+    def _finalize_lines(self) -> Iterator[str]:
         for (name, opt) in self._sorted_options():
-            result.append(f"== {asciidoc_escape(name)}\n")
-            result += opt.lines
-            result.append("\n\n")
-
-        return "\n".join(result)
+            yield f"== {asciidoc_escape(name)}\n"
+            yield from opt.lines
+            yield "\n\n"
 
 class OptionsHTMLRenderer(OptionDocsRestrictions, HTMLRenderer):
     # TODO docbook compat. must be removed together with the matching docbook handlers.
     def ordered_list_open(self, token: Token, tokens: Sequence[Token], i: int) -> str:
-        token.meta['compact'] = False
-        return super().ordered_list_open(token, tokens, i)
+        return super().ordered_list_open(_not_compact(token), tokens, i)
     def bullet_list_open(self, token: Token, tokens: Sequence[Token], i: int) -> str:
-        token.meta['compact'] = False
-        return super().bullet_list_open(token, tokens, i)
+        return super().bullet_list_open(_not_compact(token), tokens, i)
     def fence(self, token: Token, tokens: Sequence[Token], i: int) -> str:
         info = f" {html.escape(token.info, True)}" if token.info != "" else ""
         return f'<pre><code class="programlisting{info}">{html.escape(token.content)}</code></pre>'
@@ -508,7 +748,8 @@ class HTMLConverter(BaseConverter[OptionsHTMLRenderer]):
         self._xref_targets = xref_targets
         self._varlist_id = varlist_id
         self._id_prefix = id_prefix
-        self._renderer = OptionsHTMLRenderer(manpage_urls, self._xref_targets)
+        self._lookups = _RecordingMapping(self._xref_targets)
+        self._renderer = OptionsHTMLRenderer(manpage_urls, self._lookups)
 
     def _parallel_render_prepare(self) -> Any:
         return (self._renderer._manpage_urls, self._revision,
@@ -517,6 +758,9 @@ class HTMLConverter(BaseConverter[OptionsHTMLRenderer]):
     def _parallel_render_init_worker(cls, a: Any) -> HTMLConverter:
         return cls(*a)
 
+    def _cache_settings(self) -> Any:
+        return (self._renderer._manpage_urls, self._revision)
+
     def _related_packages_header(self) -> list[str]:
         return [
             '<p><span class="emphasis"><em>Related packages:</em></span></p>',
@@ -542,10 +786,8 @@ class HTMLConverter(BaseConverter[OptionsHTMLRenderer]):
     def _decl_def_footer(self) -> list[str]:
         return [ "</table>" ]
 
-    def finalize(self) -> str:
-        result = []
-
-        result += [
+    def _finalize_lines(self) -> Iterator[str]:
+        yield from [
             '<div class="variablelist">',
             f'<a id="{html.escape(self._varlist_id, True)}"></a>',
             ' <dl class="variablelist">',
@@ -554,7 +796,7 @@ class HTMLConverter(BaseConverter[OptionsHTMLRenderer]):
         for (name, opt) in self._sorted_options():
             id = make_xml_id(self._id_prefix + name)
             target = self._xref_targets[id]
-            result += [
+            yield from [
                 '<dt>',
                 ' <span class="term">',
                 # docbook compat, these could be one tag
@@ -566,17 +808,120 @@ class HTMLConverter(BaseConverter[OptionsHTMLRenderer]):
                 '</dt>',
                 '<dd>',
             ]
-            result += opt.lines
-            result += [
+            yield from opt.lines
+            yield from [
                 "</dd>",
             ]
 
-        result += [
+        yield from [
             " </dl>",
             "</div>"
         ]
 
-        return "\n".join(result)
+    @staticmethod
+    def xref_targets(names: Iterable[str], id_prefix: str, path: str) -> dict[str, XrefTarget]:
+        """xref targets for options rendered into the page at `path`, as the manual creates them"""
+        result = {}
+        for opt in names:
+            id = make_xml_id(f"{id_prefix}{opt}")
+            name = html.escape(opt)
+            result[id] = XrefTarget(id, f'<code class="option">{name}</code>', name, None, path)
+        return result
+
+class MultiConverter:
+    """
+    renders options with several converters in one pass. markdown in each option is parsed
+    only once and the tokens are shared by all converters, which is safe because renderers
+    do not modify tokens. rendered options are added to each converter as usual and can be
+    retrieved with their own `finalize`.
+    """
+
+    _converters: Sequence[BaseConverter[Any]]
+
+    def __init__(self, converters: Sequence[BaseConverter[Any]]):
+        self._converters = converters
+
+    def _parallel_render_prepare(self) -> Any:
+        return [ (type(c), c._parallel_render_prepare()) for c in self._converters ]
+    @classmethod
+    def _parallel_render_init_worker(cls, a: Any) -> MultiConverter:
+        return cls([ typ._parallel_render_init_worker(s) for (typ, s) in a ])
+
+    def _render_option(self, name: str, option: dict[str, Any], which: Optional[Sequence[int]] = None
+                       ) -> list[tuple[RenderedOption, Optional[dict[str, Any]]]]:
+        converters = self._converters if which is None else [ self._converters[i] for i in which ]
+        # only parsed tokens of the current option are kept, caching more than that costs
+        # a lot of memory and gains little. options rarely share their docs.
+        parsed: dict[str, list[Token]] = {}
+        try:
+            for c in converters:
+                c._parse_cache = parsed
+            return [ c._render_option_recorded(name, option) for c in converters ]
+        finally:
+            for c in converters:
+                c._parse_cache = None
+
+    @classmethod
+    def _parallel_render_step(cls, s: MultiConverter, a: Any) -> list[RenderedOption]:
+        return [ r for (r, _) in s._render_option(*a) ]
+
+    @classmethod
+    def _parallel_render_init_indexed(cls, a: Any) -> tuple[MultiConverter, _OptionSource]:
+        return (cls._parallel_render_init_worker(a[0]), a[1])
+    @classmethod
+    def _parallel_render_step_indexed(cls, s: tuple[MultiConverter, _OptionSource], i: int
+                                      ) -> list[RenderedOption]:
+        return [ r for (r, _) in s[0]._render_option(*_option_item(s[1], i)) ]
+    @classmethod
+    def _parallel_render_step_recorded(cls, s: tuple[MultiConverter, _OptionSource],
+                                       a: tuple[int, list[int]]
+                                       ) -> list[tuple[RenderedOption, Optional[dict[str, Any]]]]:
+        return s[0]._render_option(*_option_item(s[1], a[0]), a[1])
+
+    def add_options(self, options: Mapping[str, Any], cache: Optional[OptionCache] = None) -> None:
+        for c in self._converters:
+            c._register_options(options.keys())
+        if cache is not None:
+            self._add_options_cached(options, cache)
+            return
+        mapped: list[list[RenderedOption]]
+        if isinstance(options, OptionsFile):
+            mapped = parallel.map(self._parallel_render_step_indexed, range(len(options)), 100,
+                                  self._parallel_render_init_indexed,
+                                  (self._parallel_render_prepare(), options))
+        else:
+            mapped = parallel.map(self._parallel_render_step, options.items(), 100,
+                                  self._parallel_render_init_worker, self._parallel_render_prepare())
+        for (name, rendered) in zip(options.keys(), mapped):
+            for (c, option) in zip(self._converters, rendered):
+                c._options[name] = option
+
+    def _add_options_cached(self, options: Mapping[str, Any], cache: OptionCache) -> None:
+        settings = [ cache.key(type(c).__qualname__, repr(c._cache_settings())) for c in self._converters ]
+        names = list(options.keys())
+        keys: list[list[str]] = []
+        rendered: list[list[Optional[RenderedOption]]] = []
+        for (i, name) in enumerate(names):
+            data = _option_data(options, i, name)
+            found = [ c._cache_lookup(cache, cs, name, data) for (c, cs) in zip(self._converters, settings) ]
+            keys.append([ k for (k, _) in found ])
+            rendered.append([ r for (_, r) in found ])
+        missing = [ (i, [ ci for (ci, r) in enumerate(rs) if r is None ])
+                    for (i, rs) in enumerate(rendered) if None in rs ]
+        source = options if isinstance(options, OptionsFile) else list(options.items())
+        mapped = parallel.map(self._parallel_render_step_recorded, missing, 100,
+                              self._parallel_render_init_indexed,
+                              (self._parallel_render_prepare(), source))
+        new = []
+        for ((i, which), entries) in zip(missing, mapped):
+            for (ci, entry) in zip(which, entries):
+                rendered[i][ci] = entry[0]
+                new.append((keys[i][ci], entry))
+        cache.put(new)
+        for (name, rs) in zip(names, rendered):
+            for (c, option) in zip(self._converters, rs):
+                assert option is not None
+                c._options[name] = option
 
 def _build_cli_db(p: argparse.ArgumentParser) -> None:
     p.add_argument('--manpage-urls', required=True)
@@ -606,7 +951,22 @@ def _build_cli_asciidoc(p: argparse.ArgumentParser) -> None:
     p.add_argument("infile")
     p.add_argument("outfile")
 
-def _run_cli_db(args: argparse.Namespace) -> None:
+def _build_cli_multi(p: argparse.ArgumentParser) -> None:
+    p.add_argument('--manpage-urls', required=True)
+    p.add_argument('--revision', required=True)
+    p.add_argument('--varlist-id', help="used for docbook and html outputs")
+    p.add_argument('--id-prefix', help="used for docbook and html outputs")
+    p.add_argument('--docbook', metavar='OUTFILE')
+    p.add_argument('--document-type', help="used for docbook output")
+    p.add_argument('--manpage', metavar='OUTFILE')
+    p.add_argument("--header", type=Path, help="used for manpage output")
+    p.add_argument("--footer", type=Path, help="used for manpage output")
+    p.add_argument('--commonmark', metavar='OUTFILE')
+    p.add_argument('--asciidoc', metavar='OUTFILE')
+    p.add_argument('--html', metavar='OUTFILE')
+    p.add_argument("infile")
+
+def _run_cli_db(args: argparse.Namespace, cache: Optional[OptionCache]) -> None:
     with open(args.manpage_urls, 'r') as manpage_urls:
         md = DocBookConverter(
             json.load(manpage_urls),
@@ -615,12 +975,11 @@ def _run_cli_db(args: argparse.Namespace) -> None:
             varlist_id = args.varlist_id,
             id_prefix = args.id_prefix)
 
-        with open(args.infile, 'r') as f:
-            md.add_options(json.load(f))
+        md.add_options(OptionsFile(Path(args.infile)), cache)
         with open(args.outfile, 'w') as f:
-            f.write(md.finalize())
+            md.finalize_to(f)
 
-def _run_cli_manpage(args: argparse.Namespace) -> None:
+def _run_cli_manpage(args: argparse.Namespace, cache: Optional[OptionCache]) -> None:
     header = None
     footer = None
 
@@ -638,44 +997,104 @@ def _run_cli_manpage(args: argparse.Namespace) -> None:
         footer = footer,
     )
 
-    with open(args.infile, 'r') as f:
-        md.add_options(json.load(f))
+    md.add_options(OptionsFile(Path(args.infile)), cache)
     with open(args.outfile, 'w') as f:
-        f.write(md.finalize())
+        md.finalize_to(f)
 
-def _run_cli_commonmark(args: argparse.Namespace) -> None:
+def _run_cli_commonmark(args: argparse.Namespace, cache: Optional[OptionCache]) -> None:
     with open(args.manpage_urls, 'r') as manpage_urls:
         md = CommonMarkConverter(json.load(manpage_urls), revision = args.revision)
 
-        with open(args.infile, 'r') as f:
-            md.add_options(json.load(f))
+        md.add_options(OptionsFile(Path(args.infile)), cache)
         with open(args.outfile, 'w') as f:
-            f.write(md.finalize())
+            md.finalize_to(f)
 
-def _run_cli_asciidoc(args: argparse.Namespace) -> None:
+def _run_cli_asciidoc(args: argparse.Namespace, cache: Optional[OptionCache]) -> None:
     with open(args.manpage_urls, 'r') as manpage_urls:
         md = AsciiDocConverter(json.load(manpage_urls), revision = args.revision)
 
-        with open(args.infile, 'r') as f:
-            md.add_options(json.load(f))
+        md.add_options(OptionsFile(Path(args.infile)), cache)
         with open(args.outfile, 'w') as f:
-            f.write(md.finalize())
+            md.finalize_to(f)
+
+def _run_cli_multi(args: argparse.Namespace, cache: Optional[OptionCache]) -> None:
+    def require(*names: str) -> None:
+        for name in names:
+            if getattr(args, name.replace('-', '_')) is None:
+                raise RuntimeError(f"--{name} is required for the requested outputs")
+
+    with open(args.manpage_urls, 'r') as manpage_urls:
+        urls = json.load(manpage_urls)
+    infile = OptionsFile(Path(args.infile))
+
+    outputs: list[tuple[str, BaseConverter[Any]]] = []
+    if args.docbook is not None:
+        require('document-type', 'varlist-id', 'id-prefix')
+        outputs.append((args.docbook, DocBookConverter(
+            urls,
+            revision = args.revision,
+            document_type = args.document_type,
+            varlist_id = args.varlist_id,
+            id_prefix = args.id_prefix)))
+    if args.manpage is not None:
+        header = args.header.read_text().splitlines() if args.header is not None else None
+        footer = args.footer.read_text().splitlines() if args.footer is not None else None
+        outputs.append((args.manpage, ManpageConverter(
+            revision = args.revision,
+            header = header,
+            footer = footer)))
+    if args.commonmark is not None:
+        outputs.append((args.commonmark, CommonMarkConverter(urls, revision = args.revision)))
+    if args.asciidoc is not None:
+        outputs.append((args.asciidoc, AsciiDocConverter(urls, revision = args.revision)))
+    if args.html is not None:
+        require('varlist-id', 'id-prefix')
+        targets = HTMLConverter.xref_targets(infile.keys(), args.id_prefix, Path(args.html).name)
+        outputs.append((args.html, HTMLConverter(
+            urls, args.revision, args.varlist_id, args.id_prefix, targets)))
+    if not outputs:
+        raise RuntimeError("no outputs requested")
+
+    MultiConverter([ md for (_, md) in outputs ]).add_options(infile, cache)
+    for (outfile, md) in outputs:
+        with open(outfile, 'w') as f:
+            md.finalize_to(f)
 
 def build_cli(p: argparse.ArgumentParser) -> None:
+    p.add_argument('--cache', type=Path, metavar='FILE',
+                   help="cache rendered options in FILE, rendering only options that changed")
+    p.add_argument('--cache-max-age', type=float, default=30, metavar='DAYS',
+                   help="drop cached options not used for this many days")
+    p.add_argument('--cache-max-size', type=float, default=512, metavar='MB',
+                   help="drop least recently used cached options to stay below this size")
     formats = p.add_subparsers(dest='format', required=True)
     _build_cli_db(formats.add_parser('docbook'))
     _build_cli_manpage(formats.add_parser('manpage'))
     _build_cli_commonmark(formats.add_parser('commonmark'))
     _build_cli_asciidoc(formats.add_parser('asciidoc'))
+    _build_cli_multi(formats.add_parser('multi'))
 
 def run_cli(args: argparse.Namespace) -> None:
+    cache = None
+    if args.cache is not None:
+        cache = OptionCache(args.cache, max_age=args.cache_max_age * 24 * 60 * 60,
+                            max_size=int(args.cache_max_size * 1024 * 1024))
+    try:
+        _run_cli(args, cache)
+    finally:
+        if cache is not None:
+            cache.close()
+
+def _run_cli(args: argparse.Namespace, cache: Optional[OptionCache]) -> None:
     if args.format == 'docbook':
-        _run_cli_db(args)
+        _run_cli_db(args, cache)
     elif args.format == 'manpage':
-        _run_cli_manpage(args)
+        _run_cli_manpage(args, cache)
     elif args.format == 'commonmark':
-        _run_cli_commonmark(args)
+        _run_cli_commonmark(args, cache)
     elif args.format == 'asciidoc':
-        _run_cli_asciidoc(args)
+        _run_cli_asciidoc(args, cache)
+    elif args.format == 'multi':
+        _run_cli_multi(args, cache)
     else:
         raise RuntimeError('format not hooked up', args)
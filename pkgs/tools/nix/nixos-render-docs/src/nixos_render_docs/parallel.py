@@ -3,6 +3,10 @@
 # the GIL prohibits this.
 
 import multiprocessing
+import multiprocessing.pool
+import os
+import pickle
+import tempfile
 
 from typing import Any, Callable, Iterable, Optional, TypeVar
 
@@ -13,27 +17,56 @@ A = TypeVar('A')
 
 pool_processes: Optional[int] = None
 
+# the pool is kept alive across calls to map so workers are started only once per
+# invocation, no matter how many documents are converted. it is recreated when the
+# number of processes changes.
+_pool: Optional[multiprocessing.pool.Pool] = None
+_pool_size: Optional[int] = None
+_map_count = 0
+
 # this thing is impossible to type because there's so much global state involved.
 # wrapping in a class to get access to Generic[] parameters is not sufficient
 # because mypy is too weak, and unnecessarily obscures how much global state is
 # needed in each worker to make this whole brouhaha work.
+_map_worker_job: Any = None
 _map_worker_fn: Any = None
-_map_worker_state_fn: Any = None
-_map_worker_state_arg: Any = None
-
-def _map_worker_init(*args: Any) -> None:
-    global _map_worker_fn, _map_worker_state_fn, _map_worker_state_arg
-    (_map_worker_fn, _map_worker_state_fn, _map_worker_state_arg) = args
-
-# NOTE: the state argument is never passed by any caller, we only use it as a localized
-# cache for the created state in lieu of another global. it is effectively a global though.
-def _map_worker_step(arg: Any, state: Any = []) -> Any:
-    global _map_worker_fn, _map_worker_state_fn, _map_worker_state_arg
-    # if a Pool initializer throws it'll just be retried, leading to endless loops.
-    # doing the proper initialization only on first use avoids this.
-    if not state:
-        state.append(_map_worker_state_fn(_map_worker_state_arg))
-    return _map_worker_fn(state[0], arg)
+_map_worker_state: Any = None
+
+def _map_worker_init() -> None:
+    global pool_processes
+    # pool workers are daemonic processes and can't have children of their own,
+    # nested maps must run in the worker itself.
+    pool_processes = None
+
+def _map_worker_step(arg: tuple[tuple[int, str], Any]) -> Any:
+    global _map_worker_job, _map_worker_fn, _map_worker_state
+    (job, item) = arg
+    # each map writes its function and state to a file that workers read when they see
+    # the first item of that map. if creating the state throws we'll try again on the next
+    # item, the map has failed anyway.
+    if job != _map_worker_job:
+        _map_worker_job, _map_worker_fn, _map_worker_state = None, None, None
+        with open(job[1], 'rb') as f:
+            (fn, state_fn, state_arg) = pickle.load(f)
+        _map_worker_fn, _map_worker_state = fn, state_fn(state_arg)
+        _map_worker_job = job
+    return _map_worker_fn(_map_worker_state, item)
+
+def _get_pool() -> multiprocessing.pool.Pool:
+    global _pool, _pool_size
+    if _pool is None or _pool_size != pool_processes:
+        close()
+        _pool = multiprocessing.Pool(pool_processes, _map_worker_init)
+        _pool_size = pool_processes
+    return _pool
+
+def close() -> None:
+    """shut down the worker pool, if one was started."""
+    global _pool, _pool_size
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+    _pool, _pool_size = None, None
 
 def map(fn: Callable[[S, T], R], d: Iterable[T], chunk_size: int,
         state_fn: Callable[[A], S], state_arg: A) -> list[R]:
@@ -47,12 +80,20 @@ def map(fn: Callable[[S, T], R], d: Iterable[T], chunk_size: int,
 
     **NOTE**: all data types that potentially cross a process boundary (so, all of them) must be
     pickle-able. this excludes lambdas, bound functions, local functions, and a number of other
-    types depending on their exact internal structure. *theoretically* the pool constructor
-    can transfer non-pickleable data to worker processes, but this only works when using the
-    `fork` spawn method (and is thus not available on darwin or windows).
+    types depending on their exact internal structure. `state_arg` is pickled only once per call
+    and read by each worker, so large states are cheap as long as `d` stays small.
     """
+    global _map_count
     if pool_processes is None:
         state = state_fn(state_arg)
         return [ fn(state, i) for i in d ]
-    with multiprocessing.Pool(pool_processes, _map_worker_init, (fn, state_fn, state_arg)) as p:
-        return list(p.imap(_map_worker_step, d, chunk_size))
+    pool = _get_pool()
+    _map_count += 1
+    fd, path = tempfile.mkstemp(prefix="nixos-render-docs-")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((fn, state_fn, state_arg), f, pickle.HIGHEST_PROTOCOL)
+        job = (_map_count, path)
+        return list(pool.imap(_map_worker_step, ((job, i) for i in d), chunk_size))
+    finally:
+        os.unlink(path)
@@ -2,6 +2,11 @@ from typing import Any
 
 _frozen_classes: dict[type, type] = {}
 
+def _unpickle_frozen(cls: type) -> Any:
+    result: Any = object.__new__(cls)
+    result.freeze()
+    return result
+
 # make a derived class freezable (ie, disallow modifications).
 # we do this by changing the class of an instance at runtime when freeze()
 # is called, providing a derived class that is exactly the same except
@@ -14,8 +19,14 @@ class Freezeable:
         if not (frozen := _frozen_classes.get(cls)):
             def __setattr__(instance: Any, n: str, v: Any) -> None:
                 raise TypeError(f'{cls.__name__} is frozen')
+            # frozen classes can't be found by name, so pickle would not know how to
+            # recreate instances. we can restore the state of instances without going
+            # through __setattr__ since pickle updates __dict__ directly.
+            def __reduce_ex__(instance: Any, protocol: Any) -> Any:
+                return (_unpickle_frozen, (cls,), instance.__dict__)
             frozen = type(cls.__name__, (cls,), {
                 '__setattr__': __setattr__,
+                '__reduce_ex__': __reduce_ex__,
             })
             _frozen_classes[cls] = frozen
         self.__class__ = frozen
@@ -0,0 +1,69 @@
+from pathlib import Path
+
+from nixos_render_docs.cache import ManualCache
+from nixos_render_docs.manual import HTMLConverter, HTMLParameters
+
+def write_manual(base: Path) -> None:
+    (base / "manual.md").write_text("""
+# Manual {#book}
+## Version 1
+
+```{=include=} chapters html:into-file=//one.html
+one.md
+```
+
+```{=include=} chapters html:into-file=//two.html
+two.md
+```
+""")
+    (base / "one.md").write_text("# One {#one}\n\nfirst chapter, see [](#two).\n")
+    (base / "two.md").write_text(
+        "# Two {#two}\n\n::: {.example}\n### foo\nexample\n:::\n")
+
+def convert(base: Path, cache: ManualCache | None) -> None:
+    md = HTMLConverter("1.0.0", HTMLParameters("", [], [], 2, 2, 2, Path("media")), {}, cache)
+    md.convert(base / "manual.md", base / "out" / "index.html")
+
+def outputs(base: Path) -> dict[str, str]:
+    return { p.name: p.read_text() for p in sorted((base / "out").iterdir()) }
+
+def test_cached_output_matches(tmp_path: Path) -> None:
+    write_manual(tmp_path)
+    (tmp_path / "out").mkdir()
+    convert(tmp_path, None)
+    expected = outputs(tmp_path)
+    cache = ManualCache(tmp_path / "cache")
+    convert(tmp_path, cache)
+    assert outputs(tmp_path) == expected
+    convert(tmp_path, cache)
+    assert outputs(tmp_path) == expected
+
+def test_unchanged_chunks_are_skipped(tmp_path: Path) -> None:
+    write_manual(tmp_path)
+    (tmp_path / "out").mkdir()
+    cache = ManualCache(tmp_path / "cache")
+    convert(tmp_path, cache)
+    (tmp_path / "out" / "one.html").write_text("not rendered again")
+    (tmp_path / "out" / "two.html").write_text("not rendered again")
+
+    (tmp_path / "two.md").write_text(
+        "# Two {#two}\n\n::: {.example}\n### foo\nchanged example\n:::\n")
+    convert(tmp_path, cache)
+    assert (tmp_path / "out" / "one.html").read_text() == "not rendered again"
+    assert "changed example" in (tmp_path / "out" / "two.html").read_text()
+
+    # titles are used in other chunks, changing them must render those again.
+    (tmp_path / "two.md").write_text(
+        "# Second {#two}\n\n::: {.example}\n### foo\nchanged example\n:::\n")
+    convert(tmp_path, cache)
+    assert "Second" in (tmp_path / "out" / "one.html").read_text()
+
+def test_missing_outputs_are_rendered(tmp_path: Path) -> None:
+    write_manual(tmp_path)
+    (tmp_path / "out").mkdir()
+    cache = ManualCache(tmp_path / "cache")
+    convert(tmp_path, cache)
+    expected = outputs(tmp_path)
+    (tmp_path / "out" / "one.html").unlink()
+    convert(tmp_path, cache)
+    assert outputs(tmp_path) == expected
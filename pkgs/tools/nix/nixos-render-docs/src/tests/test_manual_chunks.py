@@ -0,0 +1,60 @@
+import pickle
+from pathlib import Path
+
+import pytest
+
+from nixos_render_docs import parallel
+from nixos_render_docs.manual import HTMLConverter, HTMLParameters
+from nixos_render_docs.manual_structure import TocEntry, XrefTarget
+
+def write_manual(base: Path) -> None:
+    (base / "manual.md").write_text("""
+# Manual {#book}
+## Version 1
+
+```{=include=} chapters html:into-file=//one.html
+one.md
+```
+
+```{=include=} parts html:into-file=//two.html
+two.md
+```
+""")
+    (base / "one.md").write_text("# One {#one}\n\nfirst chapter, see [](#three).\n")
+    (base / "two.md").write_text("""# Two {#two}
+
+```{=include=} chapters html:into-file=//three.html
+three.md
+```
+""")
+    (base / "three.md").write_text(
+        "# Three {#three}\n\n::: {.example}\n### foo\nexample, see [](#one)\n:::\n")
+
+def render(base: Path, out: str) -> dict[str, str]:
+    (base / out).mkdir()
+    md = HTMLConverter("1.0.0", HTMLParameters("", [], [], 2, 2, 2, Path("media")), {})
+    md.convert(base / "manual.md", base / out / "index.html")
+    return { p.name: p.read_text() for p in sorted((base / out).iterdir()) }
+
+def test_parallel_chunks(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    write_manual(tmp_path)
+    serial = render(tmp_path, "serial")
+    assert list(serial.keys()) == [ "index.html", "one.html", "three.html", "two.html" ]
+    monkeypatch.setattr(parallel, 'pool_processes', 2)
+    try:
+        assert render(tmp_path, "parallel") == serial
+    finally:
+        parallel.close()
+
+def test_pickle_frozen_toc() -> None:
+    root = TocEntry('book', XrefTarget('book', "Book", None, None, "index.html"))
+    child = TocEntry('chapter', XrefTarget('one', "One", None, None, "one.html"), parent=root)
+    root.children.append(child)
+    root.freeze()
+    child.freeze()
+
+    copy = pickle.loads(pickle.dumps(root))
+    assert copy.children[0].parent is copy
+    assert copy.children[0].target == child.target
+    with pytest.raises(TypeError):
+        copy.kind = 'part'
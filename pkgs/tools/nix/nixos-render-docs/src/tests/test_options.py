@@ -1,7 +1,32 @@
 import nixos_render_docs
 
+import dataclasses
+import io
+import json
+import pickle
 from markdown_it.token import Token
+from pathlib import Path
 import pytest
+from typing import Any
+
+from nixos_render_docs.cache import OptionCache
+
+options = {
+    "foo.enable": {
+        "loc": ["foo", "enable"],
+        "description": "Whether to enable *föö*.",
+        "type": "boolean",
+        "default": {"_type": "literalExpression", "text": "false"},
+        "declarations": ["nixos/modules/foo.nix"],
+    },
+    "bar": {
+        "loc": ["bar"],
+        "description": "Some ✨bar✨, see {option}`foo.enable`.",
+        "type": "string",
+        "example": {"_type": "literalExpression", "text": "\"baz\""},
+        "declarations": [],
+    },
+}
 
 def test_option_headings() -> None:
     c = nixos_render_docs.options.DocBookConverter({}, 'local', 'none', 'vars', 'opt-')
@@ -12,3 +37,110 @@ def test_option_headings() -> None:
         type='heading_open', tag='h1', nesting=1, attrs={}, map=[0, 1], level=0, children=None,
         content='', markup='#', info='', meta={}, block=True, hidden=False
     )
+
+def test_options_file(tmp_path: Path) -> None:
+    (tmp_path / "options.json").write_text(json.dumps(options, indent=2, ensure_ascii=False))
+    f = nixos_render_docs.options.OptionsFile(tmp_path / "options.json")
+    assert dict(f.items()) == options
+    assert list(f.keys()) == list(options.keys())
+    copy = pickle.loads(pickle.dumps(f))
+    assert copy.item(1) == ("bar", options["bar"])
+
+    (tmp_path / "options.json").write_text('{"foo": 1} []')
+    with pytest.raises(ValueError):
+        nixos_render_docs.options.OptionsFile(tmp_path / "options.json")
+
+def test_options_file_render(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    (tmp_path / "options.json").write_text(json.dumps(options))
+    c = nixos_render_docs.options.CommonMarkConverter({}, 'local')
+    c.add_options(options)
+    expected = c.finalize()
+    monkeypatch.setattr(nixos_render_docs.parallel, 'pool_processes', 2)
+    try:
+        c = nixos_render_docs.options.CommonMarkConverter({}, 'local')
+        c.add_options(nixos_render_docs.options.OptionsFile(tmp_path / "options.json"))
+        assert c.finalize() == expected
+    finally:
+        nixos_render_docs.parallel.close()
+
+def test_multi_converter() -> None:
+    opts = options | {
+        "baz": {
+            "loc": ["baz"],
+            "description": "- see <https://example.com>\n- and [](#opt-bar)\n",
+            "type": "list of string",
+        },
+    }
+    targets = nixos_render_docs.options.HTMLConverter.xref_targets(opts.keys(), 'opt-', 'options.html')
+    def converters() -> list[nixos_render_docs.options.BaseConverter[Any]]:
+        return [
+            nixos_render_docs.options.DocBookConverter({}, 'local', 'none', 'vars', 'opt-'),
+            nixos_render_docs.options.ManpageConverter('local', None, None),
+            nixos_render_docs.options.CommonMarkConverter({}, 'local'),
+            nixos_render_docs.options.AsciiDocConverter({}, 'local'),
+            nixos_render_docs.options.HTMLConverter({}, 'local', 'vars', 'opt-', targets),
+        ]
+    expected = []
+    for c in converters():
+        c.add_options(opts)
+        expected.append(c.finalize())
+    multi = converters()
+    nixos_render_docs.options.MultiConverter(multi).add_options(opts)
+    assert [ c.finalize() for c in multi ] == expected
+
+    for (c, e) in zip(multi, expected):
+        f = io.StringIO()
+        c.finalize_to(f)
+        assert f.getvalue() == e
+
+def test_option_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    def render(opts: dict[str, Any], cache: OptionCache | None) -> str:
+        c = nixos_render_docs.options.ManpageConverter('local', None, None)
+        c.add_options(opts, cache)
+        return c.finalize()
+
+    rendered: list[str] = []
+    convert_one = nixos_render_docs.options.BaseConverter._convert_one
+    def record(self: Any, option: dict[str, Any]) -> list[str]:
+        rendered.append(option['loc'][0])
+        return convert_one(self, option)
+    monkeypatch.setattr(nixos_render_docs.options.BaseConverter, '_convert_one', record)
+
+    cache = OptionCache(tmp_path / "cache.db")
+    expected = render(options, None)
+    assert render(options, cache) == expected
+    rendered.clear()
+    assert render(options, cache) == expected
+    assert rendered == []
+
+    changed = options | { "foo.enable": options["foo.enable"] | { "type": "bool" } }
+    expected = render(changed, None)
+    rendered.clear()
+    assert render(changed, cache) == expected
+    assert rendered == [ "foo" ]
+
+    # links are resolved while rendering, options must be rendered again when their link
+    # targets change even if the options themselves did not.
+    linked = { "baz": { "loc": ["baz"], "description": "see [](#opt-foo.enable)" } }
+    def render_html(title: str) -> str:
+        targets = nixos_render_docs.options.HTMLConverter.xref_targets(
+            [ "baz", "foo.enable" ], 'opt-', 'options.html')
+        targets['opt-foo.enable'] = dataclasses.replace(targets['opt-foo.enable'], title_html=title)
+        c = nixos_render_docs.options.HTMLConverter({}, 'local', 'vars', 'opt-', targets)
+        c.add_options(linked, cache)
+        return c.finalize()
+    assert "first" in render_html("first")
+    rendered.clear()
+    assert "first" in render_html("first")
+    assert rendered == []
+    assert "second" in render_html("second")
+    assert rendered == [ "baz" ]
+    cache.close()
+
+def test_option_cache_eviction(tmp_path: Path) -> None:
+    cache = OptionCache(tmp_path / "cache.db", max_size=0)
+    cache.put([ ("a", 1) ])
+    cache.close()
+    cache = OptionCache(tmp_path / "cache.db")
+    assert cache.get("a") is None
+    cache.close()